@@ -0,0 +1,176 @@
+"""
+Memory-mapped access to the ESRI BIL (EHdr) rasters exchanged with GLUC.
+
+Both r.out.gdal (format=EHdr) and GLUC write a plain text header file
+(<name>.hdr) next to the raw band-interleaved-by-line data file.  The
+functions here parse the header and map the data file directly into
+a NumPy array with shape (NROWS, NCOLS) so model inputs and outputs can
+be processed without an intermediate GRASS import.
+"""
+import os
+import numpy
+
+
+# (PIXELTYPE, NBITS) -> numpy type, byte order is applied separately
+_TYPES = {
+    ('UNSIGNEDINT', 8): numpy.uint8,
+    ('UNSIGNEDINT', 16): numpy.uint16,
+    ('UNSIGNEDINT', 32): numpy.uint32,
+    ('SIGNEDINT', 8): numpy.int8,
+    ('SIGNEDINT', 16): numpy.int16,
+    ('SIGNEDINT', 32): numpy.int32,
+    ('FLOAT', 32): numpy.float32,
+    ('FLOAT', 64): numpy.float64,
+    }
+
+
+def hdr_name(bilname):
+    """return the header filename associated with a BIL file"""
+    return os.path.splitext(bilname)[0] + '.hdr'
+
+
+def read_header(bilname):
+    """Parse the header of a BIL file.
+
+    Tags are returned upper-case.  The dimensional tags (NROWS, NCOLS,
+    NBITS, NBANDS) are converted to ints and the extent tags to floats.
+
+    Returns:
+      dict: header tags
+    """
+    hdr = {}
+    with open(hdr_name(bilname)) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                hdr[fields[0].upper()] = fields[1]
+
+    for tag in ('NROWS', 'NCOLS', 'NBITS'):
+        if tag not in hdr:
+            raise RuntimeError('BIL header %s missing %s' %
+                               (hdr_name(bilname), tag))
+        hdr[tag] = int(hdr[tag])
+    hdr['NBANDS'] = int(hdr.get('NBANDS', 1))
+    for tag in ('ULXMAP', 'ULYMAP', 'XDIM', 'YDIM', 'NODATA'):
+        if tag in hdr:
+            hdr[tag] = float(hdr[tag])
+
+    return hdr
+
+
+def header_dtype(hdr):
+    """return the numpy dtype described by a BIL header"""
+
+    # unsigned is the EHdr default when PIXELTYPE is not given
+    ptype = hdr.get('PIXELTYPE', 'UNSIGNEDINT').upper()
+    try:
+        dtype = numpy.dtype(_TYPES[(ptype, hdr['NBITS'])])
+    except KeyError:
+        raise RuntimeError('unsupported BIL type %s/%d' %
+                           (ptype, hdr['NBITS']))
+
+    if hdr.get('BYTEORDER', 'I').upper() == 'M':
+        return dtype.newbyteorder('>')
+    else:
+        return dtype.newbyteorder('<')
+
+
+def open_bil(bilname, mode='r'):
+    """Memory-map a single band BIL file.
+
+    Args:
+      bilname (str): name of the BIL data file
+      mode (str): numpy.memmap mode ('r', 'r+', or 'c')
+
+    Returns:
+      numpy.memmap: array with shape (rows, cols)
+    """
+    hdr = read_header(bilname)
+    if hdr['NBANDS'] != 1:
+        raise RuntimeError('%s: only single band BIL files supported'
+                           % bilname)
+
+    return numpy.memmap(bilname, dtype=header_dtype(hdr), mode=mode,
+                        shape=(hdr['NROWS'], hdr['NCOLS']))
+
+
+def valid(data, hdr):
+    """return a boolean array marking cells that are not NODATA"""
+
+    ok = numpy.ones(data.shape, dtype=bool)
+    if 'NODATA' in hdr:
+        ok &= data != hdr['NODATA']
+    if data.dtype.kind == 'f':
+        ok &= numpy.isfinite(data)
+    return ok
+
+
+def write_bil(bilname, data, like=None, **tags):
+    """Write an array as a single band BIL file and header.
+
+    Args:
+      bilname (str): name of the BIL data file
+      data (array): 2D array to be written
+      like (dict): optional header used for the extent tags
+      tags: additional header tags (ULXMAP, NODATA, etc.) which override
+        values copied from <like>
+    """
+    data = numpy.asarray(data)
+    rows, cols = data.shape
+    dtype = data.dtype.newbyteorder('<')
+    if dtype.kind == 'f':
+        ptype = 'FLOAT'
+    elif dtype.kind == 'i':
+        ptype = 'SIGNEDINT'
+    else:
+        ptype = 'UNSIGNEDINT'
+
+    hdr = [
+        ('BYTEORDER', 'I'),
+        ('LAYOUT', 'BIL'),
+        ('NROWS', rows),
+        ('NCOLS', cols),
+        ('NBANDS', 1),
+        ('NBITS', dtype.itemsize * 8),
+        ('BANDROWBYTES', dtype.itemsize * cols),
+        ('TOTALROWBYTES', dtype.itemsize * cols),
+        ('PIXELTYPE', ptype),
+        ]
+    extent = dict((k, v) for k, v in (like or {}).items()
+                  if k in ('ULXMAP', 'ULYMAP', 'XDIM', 'YDIM', 'NODATA'))
+    extent.update(tags)
+    for tag in ('ULXMAP', 'ULYMAP', 'XDIM', 'YDIM', 'NODATA'):
+        if tag in extent:
+            hdr.append((tag, '%f' % extent[tag]))
+
+    with open(hdr_name(bilname), 'w') as f:
+        for tag, value in hdr:
+            f.write('%-14s %s\n' % (tag, value))
+
+    data.astype(dtype, copy=False).tofile(bilname)
+
+
+def crop(bilname, window):
+    """Replace a BIL file with a window of its rows and columns.
+
+    The file is removed before the window is written so links to shared
+    or cached exports are replaced rather than modified.
+
+    Args:
+      bilname (str): name of the BIL data file
+      window (tuple): first row, last row + 1, first column, and last
+        column + 1 of the window
+    """
+    r0, r1, c0, c1 = window
+    hdr = read_header(bilname)
+    data = numpy.array(open_bil(bilname)[r0:r1, c0:c1])
+
+    tags = {}
+    if 'ULXMAP' in hdr and 'XDIM' in hdr:
+        tags['ULXMAP'] = hdr['ULXMAP'] + c0 * hdr['XDIM']
+    if 'ULYMAP' in hdr and 'YDIM' in hdr:
+        tags['ULYMAP'] = hdr['ULYMAP'] - r0 * hdr['YDIM']
+
+    os.remove(bilname)
+    os.remove(hdr_name(bilname))
+    write_bil(bilname, data, like=hdr, **tags)
@@ -10,9 +10,18 @@ id     -- id (cat) of the city
 output -- the output layer name
 """
 import sys,os
+import math
 from optparse import OptionParser
 import grass.script as grass
 
+# the numpy engine computes the travel times in memory (see costdist.py)
+try:
+    import numpy
+    import costdist
+    import gridio
+except ImportError:
+    numpy = None
+
 
 usage = "usage: %prog [options] <cities>"
 
@@ -64,6 +73,49 @@ def make_city_tt(cities, cat, overland='overlandTravelTime30',
         xover=xover, start_rast='ctmp', output='tt', max_cost=maxcost)
 
 
+def class_masks(cities, classes):
+    """Locate the centres of each class on the current region.
+
+    Args:
+      cities (str): cities vector layer
+      classes (dict): cat -> CLASS of each centre
+
+    Returns:
+      dict: CLASS -> boolean array marking the cells holding a centre
+    """
+    region = grass.region()
+    rows, cols = int(region['rows']), int(region['cols'])
+    masks = dict((int(c), numpy.zeros((rows, cols), dtype=bool))
+                 for c in classes.values())
+
+    points = grass.read_command('v.out.ascii', input=cities,
+                                format='point', fs='|')
+    for line in points.splitlines():
+        x, y, cat = line.split('|')[:3]
+        if cat not in classes:
+            continue
+        r = int(math.floor((region['n'] - float(y)) / region['nsres']))
+        c = int(math.floor((float(x) - region['w']) / region['ewres']))
+        if 0 <= r < rows and 0 <= c < cols:
+            masks[int(classes[cat])][r, c] = True
+    return masks
+
+
+def read_cost(layer):
+    """read a cost layer as float64 with nulls as NaN"""
+    a = numpy.array(gridio.load(layer, dtype=numpy.float64))
+    a[a == gridio.NULL] = numpy.nan
+    return a
+
+
+def array_tt(cost, mask, maxcost='180', buffer=180.0):
+    """Travel time from the buffered centres in mask, the in memory
+    equivalent of make_city_tt."""
+    region = grass.region()
+    return costdist.travel_time(cost, mask, int(maxcost), region['nsres'],
+                                region['ewres'], buffer)
+
+
 def main():
 
     os.environ['GRASS_MESSAGE_FORMAT'] = 'silent'
@@ -85,6 +137,9 @@ def main():
         help='rebuild city travel time maps even if one exists')
     parse.add_option('-m', '--mode', default="max",
         help='operate in either max or gravity mode (default=max)')
+    parse.add_option('-e', '--engine', default='numpy' if numpy else 'grass',
+        help='compute travel times in memory (numpy) or with r.multicost '
+             '(grass), default=%default')
 
     opts, args = parse.parse_args()
     if len(args) != 1:
@@ -101,9 +156,28 @@ def main():
     else:
         parse.error("option mode must be max or gravity")
 
+    if opts.engine not in ('numpy', 'grass'):
+        parse.error("option engine must be numpy or grass")
+    elif opts.engine == 'numpy' and numpy is None:
+        parse.error("the numpy engine requires numpy")
+
     # if the cat ID of the city has been given just create the city map
     # NOTE: short-circuits the rest of the script!
-    if opts.cat:
+    if opts.cat and opts.engine == 'numpy':
+        # the region make_city_tt sets for r.multicost
+        grass.run_command('g.region', res=30)
+        classes = dict((c, cls) for c, cls in grass.parse_command(
+            'v.db.select', flags='c', map=cities, column='cat,CLASS',
+            fs='=').items() if cls == opts.cat)
+        cost = read_cost('overlandTravelTime30')
+        mask = class_masks(cities, classes).get(int(opts.cat),
+                                                numpy.zeros(cost.shape, bool))
+        tt = array_tt(cost, mask, maxcost=opts.maxtime)
+        gridio.write('city%s_tt' % opts.cat, numpy.ma.masked_invalid(tt))
+        grass.message('city%s_tt: city travel time created.' % opts.cat)
+        sys.exit(0)
+
+    elif opts.cat:
         tt = make_city_tt(cities, opts.cat, maxcost=opts.maxtime)
         grass.run_command('g.rename', rast='%s,city%s_tt' % (tt,opts.cat))
         grass.message('city%s_tt: city travel time created.' % opts.cat)
@@ -172,6 +246,37 @@ def main():
     print dest, "created."
     """
 
+    # travel times are computed and folded into the attractor in memory
+    # and only written when preserved
+    if opts.engine == 'numpy':
+        # the region make_city_tt sets for r.multicost
+        grass.run_command('g.region', res=30)
+        region = grass.region()
+        cost = read_cost('overlandTravelTime30')
+        masks = class_masks(cities, numClass)
+
+        sources, names = [], []
+        for classVal, aveVal in zip(classUniList, classAveList):
+            print "Class =  ", classVal, ", Average = " , aveVal
+            citytt = 'city%s_tt' % classVal
+            names.append(citytt)
+            if opts.rebuild or citytt not in ttmaps:
+                sources.append((masks[classVal], aveVal))
+            else:
+                sources.append((None, aveVal,
+                                lambda name=citytt: read_cost(name)))
+
+        def keep(i, tt):
+            gridio.write(names[i], numpy.ma.masked_invalid(tt))
+
+        result = costdist.attraction(cost, sources, int(opts.maxtime),
+            mode=opts.mode, nsres=region['nsres'], ewres=region['ewres'],
+            keep=keep if opts.preserve else None)
+        gridio.write(dest, result)
+        normalize(dest)
+        print dest, "created."
+        return
+
     for i in range(len(classUniList)):
         classVal = classUniList[i]
         aveVal = classAveList[i]
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+In-process cumulative cost (travel time) surfaces for the attractor maps.
+
+cities.py builds the cities and employment attractors by running
+r.multicost once per class and folding each travel time map into the
+attractor with r.mapcalc.  accumulate reproduces r.multicost on NumPy
+arrays so every class can be computed and folded in memory without
+writing a travel time raster per class.
+
+Semantics follow grass.r.multicost (raster/r.multicost/main.c):
+
+  - costs move between the 8 neighbours as the mean of the two cell
+    costs times 1, ns_res/ew_res, or the diagonal factor
+  - every non-null start cell starts at 0, null cost cells are never
+    entered (start cells keep 0)
+  - the search stops at the first cell beyond max_cost (0 = no limit),
+    cells reached from within the limit keep their tentative cost
+
+r.multicost accepts a second (interstate) cost layer and crossover cells
+but its bounds check rejects every neighbour on the second layer, so the
+output depends only on the overland layer and crossover cells merely
+repeat the relaxation of the overland cell.  m2 and xover are accepted
+for compatibility and, as in r.multicost, do not change the result.
+
+The search is a bucketed Dijkstra: cells whose cost is within the
+smallest edge cost of the current minimum cannot improve each other, so
+each bucket is finalized and relaxed with array operations.  Each cell's
+cost is computed with the same floating point operations as r.multicost
+so results match exactly.
+
+Usage:
+  costdist.py compare [options]
+"""
+import sys
+import math
+import heapq
+from optparse import OptionParser
+
+import numpy
+
+
+# neighbour offsets and the factor applied to each, in r.multicost order
+NEIGHBORS = [(0, -1, 'ew'), (0, 1, 'ew'), (-1, 0, 'ns'), (1, 0, 'ns'),
+             (-1, -1, 'diag'), (-1, 1, 'diag'), (1, 1, 'diag'), (1, -1, 'diag')]
+
+
+def factors(nsres=30.0, ewres=30.0):
+    """return the ew, ns, and diagonal cost factors used by r.multicost"""
+    ew = 1.0
+    ns = nsres / ewres
+    return dict(ew=ew, ns=ns, diag=math.sqrt(ns * ns + ew * ew))
+
+
+def accumulate(cost, start, maxcost=0, nsres=30.0, ewres=30.0,
+               m2=None, xover=None):
+    """Compute a cumulative cost surface equivalent to r.multicost.
+
+    Args:
+      cost (array): cost of traversing each cell, NaN for null
+      start (array): boolean mask of the start cells
+      maxcost (int): maximum cumulative cost, 0 for no limit
+      nsres (float): north-south resolution of the region
+      ewres (float): east-west resolution of the region
+      m2 (array): second cost layer (see module notes)
+      xover (array): crossover cells (see module notes)
+
+    Returns:
+      numpy.ndarray: float64 cumulative cost, NaN where not reached
+    """
+    cost = numpy.asarray(cost, dtype=numpy.float64)
+    nrows, ncols = cost.shape
+    flatcost = cost.ravel()
+    fac = factors(nsres, ewres)
+    limit = float(int(maxcost)) if maxcost else numpy.inf
+
+    out = numpy.empty(cost.size, dtype=numpy.float64)
+    out.fill(numpy.nan)
+    done = numpy.zeros(cost.size, dtype=bool)
+
+    idx = numpy.flatnonzero(numpy.asarray(start, dtype=bool))
+    if not len(idx):
+        raise ValueError('no start cells')
+    out[idx] = 0.0
+
+    # bucket width: no edge costs less than the smallest cell cost times
+    # the smallest factor, shrunk so rounding never merges two buckets
+    valid = flatcost[~numpy.isnan(flatcost)]
+    delta = valid.min() * min(fac.values()) if len(valid) else 0.0
+    delta *= 1.0 - 1e-9
+    key = (lambda v: numpy.floor(v / delta)) if delta > 0 else \
+          (lambda v: v)
+
+    buckets = {}
+    heap = []
+    def push(cells):
+        keys = key(out[cells])
+        for k in numpy.unique(keys):
+            if k not in buckets:
+                buckets[k] = []
+                heapq.heappush(heap, k)
+            buckets[k].append(cells[keys == k])
+    push(idx)
+
+    while heap:
+        cells = numpy.unique(numpy.concatenate(buckets.pop(heapq.heappop(heap))))
+        cells = cells[~done[cells]]
+        if not len(cells):
+            continue
+        vals = out[cells]
+        if vals.min() > limit:
+            break
+        cells = cells[vals <= limit]
+        done[cells] = True
+
+        # null cost cells (including null start cells) are not expanded
+        cells = cells[~numpy.isnan(flatcost[cells])]
+        rows, cols = numpy.divmod(cells, ncols)
+
+        nbs, cands = [], []
+        for dr, dc, f in NEIGHBORS:
+            r, c = rows + dr, cols + dc
+            ok = (r >= 0) & (r < nrows) & (c >= 0) & (c < ncols)
+            src = cells[ok]
+            nb = r[ok] * ncols + c[ok]
+            cand = out[src] + ((flatcost[nb] + flatcost[src]) / 2.0) * fac[f]
+            ok = ~numpy.isnan(cand) & ~done[nb]
+            nbs.append(nb[ok])
+            cands.append(cand[ok])
+
+        nb = numpy.concatenate(nbs)
+        cand = numpy.concatenate(cands)
+        if not len(nb):
+            continue
+
+        # lowest candidate for each neighbour that improves its cost
+        order = numpy.lexsort((cand, nb))
+        nb, cand = nb[order], cand[order]
+        first = numpy.ones(len(nb), dtype=bool)
+        first[1:] = nb[1:] != nb[:-1]
+        nb, cand = nb[first], cand[first]
+        old = out[nb]
+        better = numpy.isnan(old) | (cand < old)
+        nb = nb[better]
+        out[nb] = cand[better]
+        if len(nb):
+            push(nb)
+
+    return out.reshape(cost.shape)
+
+
+def buffer_mask(mask, dist, nsres=30.0, ewres=30.0):
+    """Grow a boolean mask by every cell whose centre is within dist of
+    a masked cell centre, as the zones of 'r.buffer dist=<dist>'."""
+    mask = numpy.asarray(mask, dtype=bool)
+    out = mask.copy()
+    nrows, ncols = mask.shape
+    rr, cc = int(dist // nsres), int(dist // ewres)
+    for dr in range(-rr, rr + 1):
+        for dc in range(-cc, cc + 1):
+            if (dr or dc) and (dr * nsres) ** 2 + (dc * ewres) ** 2 \
+                    <= dist * dist * (1.0 + 1e-9):
+                dst = out[max(dr, 0):nrows + min(dr, 0),
+                          max(dc, 0):ncols + min(dc, 0)]
+                dst |= mask[max(-dr, 0):nrows + min(-dr, 0),
+                            max(-dc, 0):ncols + min(-dc, 0)]
+    return out
+
+
+def fold(dest, tt, pop, mode='max'):
+    """Fold a travel time surface into an attractor array in place.
+
+    Equivalent to the cities.py r.mapcalc expressions
+      max:  dest = max(dest, if(isnull(tt), 0.0, pop/(tt+0.1)^2))
+      grav: dest = dest + if(isnull(tt), 0.0, pop/(tt+0.1)^2)
+    """
+    att = numpy.where(numpy.isnan(tt), 0.0, pop / (tt + 0.1) ** 2)
+    if mode == 'max':
+        numpy.maximum(dest, att, out=dest)
+    else:
+        dest += att
+    return dest
+
+
+def travel_time(cost, mask, maxcost=0, nsres=30.0, ewres=30.0,
+                buffer=180.0):
+    """Travel time from the centres in mask buffered by buffer meters, as
+    'r.buffer' followed by r.multicost.  r.multicost fails without start
+    cells, leaving no travel times (all NaN)."""
+    if not numpy.any(mask):
+        return numpy.full(numpy.shape(cost), numpy.nan)
+    start = buffer_mask(mask, buffer, nsres, ewres)
+    return accumulate(cost, start, maxcost, nsres, ewres)
+
+
+def attraction(cost, sources, maxcost=0, mode='max', nsres=30.0,
+               ewres=30.0, buffer=180.0, keep=None):
+    """Compute a cities attractor for a set of classes in memory.
+
+    The travel time of each class is folded into the attractor as soon
+    as it is computed, so no travel time surface outlives its class.
+
+    Args:
+      cost (array): overland travel time per cell, NaN for null
+      sources (list): (mask, pop) for each class, mask marks the cells
+        of the class centres, or (None, pop, load) where load returns
+        the travel time of a class computed earlier
+      maxcost (int): travel time limit (minutes)
+      mode (str): 'max' or 'grav'
+      buffer (float): distance the centres are buffered by (meters)
+      keep (callable): called with (index, travel time) for each class
+        whose travel time was computed
+
+    Returns:
+      numpy.ndarray: float64 attractor (before normalization)
+    """
+    dest = numpy.zeros(numpy.shape(cost), dtype=numpy.float64)
+    for i, source in enumerate(sources):
+        if source[0] is None:
+            tt = source[2]()
+        else:
+            tt = travel_time(cost, source[0], maxcost, nsres, ewres, buffer)
+            if keep:
+                keep(i, tt)
+        fold(dest, tt, source[1], mode)
+    return dest
+
+
+def compare(rows=200, cols=300, seed=1, maxcost=60, keep=False):
+    """Compare accumulate with r.multicost on a synthetic network.
+
+    A random overland surface crossed by fast roads, an interstate
+    surface, crossover cells, and a few start cells are written to
+    GRASS in a temporary region, r.multicost is run on them, and the
+    output is compared with accumulate cell by cell.
+
+    Returns:
+      (int, float): cells differing in null-ness and the largest
+        absolute difference of the cells reached by both
+    """
+    import grass.script as grass
+    import gridio
+
+    rnd = numpy.random.RandomState(seed)
+    cost = 1.8 / rnd.uniform(2.0, 8.0, (rows, cols))
+    for r in rnd.randint(0, rows, 6):
+        cost[r, :] = 1.8 / 55.0
+    for c in rnd.randint(0, cols, 6):
+        cost[:, c] = 1.8 / 55.0
+    cost[rnd.uniform(size=cost.shape) < 0.02] = numpy.nan
+    m2 = numpy.full(cost.shape, numpy.nan)
+    m2[rows // 2, :] = 1.8 / 100.0
+    xover = numpy.zeros(cost.shape)
+    xover[rows // 2, ::25] = 1
+    start = numpy.zeros(cost.shape, dtype=bool)
+    start[rnd.randint(0, rows, 4), rnd.randint(0, cols, 4)] = True
+
+    names = dict((n, 'costdist_cmp_' + n) for n in
+                 ('cost', 'm2', 'xover', 'start', 'out'))
+    grass.use_temp_region()
+    try:
+        grass.run_command('g.region', n=rows * 30, s=0, e=cols * 30, w=0,
+                          res=30)
+        gridio.write(names['cost'], numpy.ma.masked_invalid(cost))
+        gridio.write(names['m2'], numpy.ma.masked_invalid(m2))
+        gridio.write(names['xover'], xover.astype(numpy.int32))
+        gridio.write(names['start'],
+                     numpy.ma.masked_array(start.astype(numpy.int32), ~start))
+        if grass.run_command('r.multicost', input=names['cost'],
+                m2=names['m2'], xover=names['xover'],
+                start_rast=names['start'], output=names['out'],
+                max_cost=maxcost, overwrite=True, quiet=True):
+            raise RuntimeError('r.multicost failed')
+
+        expected = gridio.load(names['out'], dtype=numpy.float64)
+        expected = numpy.where(expected == gridio.NULL, numpy.nan, expected)
+    finally:
+        if not keep:
+            grass.run_command('g.remove', quiet=True,
+                              rast=','.join(names.values()))
+        grass.del_temp_region()
+
+    result = accumulate(cost, start, maxcost, m2=m2, xover=xover)
+    nulls = numpy.isnan(result) != numpy.isnan(expected)
+    both = ~numpy.isnan(result) & ~numpy.isnan(expected)
+    diff = numpy.abs(result[both] - expected[both])
+    return int(nulls.sum()), float(diff.max()) if len(diff) else 0.0
+
+
+def main():
+    usage = 'usage: %prog compare [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--rows', type='int', default=200,
+        help='rows in the synthetic region (default=200)')
+    parser.add_option('-c', '--cols', type='int', default=300,
+        help='columns in the synthetic region (default=300)')
+    parser.add_option('-s', '--seed', type='int', default=1,
+        help='random seed of the synthetic network (default=1)')
+    parser.add_option('-m', '--maxcost', type='int', default=60,
+        help='max_cost passed to r.multicost (default=60)')
+    parser.add_option('-k', '--keep', default=False, action='store_true',
+        help='keep the costdist_cmp_* layers')
+    (opts, args) = parser.parse_args()
+    if args != ['compare']:
+        parser.error('unknown command')
+
+    nulls, diff = compare(opts.rows, opts.cols, opts.seed, opts.maxcost,
+                          opts.keep)
+    print 'null mismatches: %d' % nulls
+    print 'max difference:  %g' % diff
+    sys.exit(1 if nulls or diff > 1e-9 else 0)
+
+
+if __name__ == '__main__':
+    main()
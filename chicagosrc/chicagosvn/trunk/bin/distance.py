@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Exact distance attractors computed from a single read of the inputs.
+
+water_att and forest_att were built with r.buffer using twelve 30 m
+rings and an r.mapcalc that turned the ring number into meters (390 m
+beyond the last ring), and roadBuffer with 23 rings.  The distances are
+now the exact Euclidean distances between cell centres, capped at the
+same limit, so the SFA curves are evaluated on continuous distances.
+
+The distance to the nearest feature within the cap is found with a
+bounded two pass transform: the vertical distance to the nearest feature
+in each column, then the minimum over the columns within the cap of the
+horizontal offset combined with that vertical distance.  Both passes are
+array operations over blocks of rows (plus the rows within the cap on
+either side) so the work is linear in the number of cells.
+
+Usage:
+  distance.py [layer ...]   (default water_att forest_att)
+"""
+import sys
+import math
+
+import numpy
+
+import gridio
+
+
+# ring distances used by the roadBuffer zones (as 'r.buffer distance=')
+ROAD_RINGS = numpy.arange(30.0, 691.0, 30.0)
+
+# output layer -> (input layer, feature classes or None for any non-zero
+#   value, distance cap in meters, zone rings or None for distances)
+LAYERS = {
+    'water_att': ('landcover', (11,), 390.0, None),
+    'forest_att': ('landcover', (41, 42, 43, 91), 390.0, None),
+    'roadBuffer': ('otherroads', None, ROAD_RINGS[-1], ROAD_RINGS),
+    }
+
+
+def transform(features, cap, nsres=30.0, ewres=30.0):
+    """Compute the capped distance to the nearest feature cell.
+
+    Args:
+      features (array): boolean mask of the feature cells
+      cap (float): distances beyond cap are returned as cap
+      nsres (float): north-south resolution of the region
+      ewres (float): east-west resolution of the region
+
+    Returns:
+      numpy.ndarray: float64 distance in meters
+    """
+    features = numpy.asarray(features, dtype=bool)
+    nrows, ncols = features.shape
+    far = numpy.inf
+
+    # vertical distance to the nearest feature in the column
+    vert = numpy.where(features, 0.0, far)
+    for dr in range(1, int(math.ceil(cap / nsres)) + 1):
+        if dr >= nrows:
+            break
+        d = dr * nsres
+        up = numpy.where(features[dr:], d, far)
+        down = numpy.where(features[:-dr], d, far)
+        numpy.minimum(vert[:-dr], up, out=vert[:-dr])
+        numpy.minimum(vert[dr:], down, out=vert[dr:])
+
+    # combine with the horizontal offset of each column within the cap
+    sq = vert * vert
+    best = sq.copy()
+    for dc in range(1, int(math.ceil(cap / ewres)) + 1):
+        if dc >= ncols:
+            break
+        h = (dc * ewres) ** 2
+        numpy.minimum(best[:, :-dc], sq[:, dc:] + h, out=best[:, :-dc])
+        numpy.minimum(best[:, dc:], sq[:, :-dc] + h, out=best[:, dc:])
+
+    return numpy.minimum(numpy.sqrt(best), cap)
+
+
+def zones(dist, rings):
+    """Convert distances to r.buffer zones: 1 for the features, n+1 for
+    cells within the nth ring, and 0 (null) beyond the last ring."""
+    z = numpy.searchsorted(rings, dist, side='left') + 2
+    z[dist == 0.0] = 1
+    z[dist > rings[-1]] = 0
+    return z.astype(numpy.int32)
+
+
+def features(values, classes):
+    """return mask of the cells holding one of the classes (any non-zero
+    value when classes is None), nulls are never features"""
+    valid = values != gridio.NULL
+    if classes is None:
+        return valid & (values != 0)
+    return valid & numpy.in1d(values.ravel(), classes).reshape(values.shape)
+
+
+def run(layers=('water_att', 'forest_att'), rows=512):
+    """Compute distance layers reading each input once.
+
+    Args:
+      layers (list): output layers, keys of LAYERS
+      rows (int): number of rows processed at a time
+    """
+    import grass.script as grass
+    region = grass.region()
+    nsres, ewres = region['nsres'], region['ewres']
+
+    inputs, outputs = {}, {}
+    for name in layers:
+        source, classes, cap, rings = LAYERS[name]
+        if source not in inputs:
+            inputs[source] = gridio.load(source, dtype=numpy.int32)
+        outputs[name] = gridio.empty(dtype=numpy.int32 if rings is not None
+                                     else numpy.float64)
+
+    nrows = int(region['rows'])
+    halo = int(math.ceil(max(LAYERS[n][2] for n in layers) / nsres))
+    for r in xrange(0, nrows, rows):
+        lo, hi = max(r - halo, 0), min(r + rows + halo, nrows)
+        blocks = dict((s, a[lo:hi]) for s, a in inputs.items())
+        for name in layers:
+            source, classes, cap, rings = LAYERS[name]
+            d = transform(features(blocks[source], classes), cap, nsres, ewres)
+            d = d[r - lo:r - lo + min(rows, nrows - r)]
+            outputs[name][r:r + len(d)] = d if rings is None \
+                else zones(d, rings)
+
+    for name in layers:
+        if LAYERS[name][3] is not None:
+            # zone 0 marks the cells beyond the last ring
+            z = outputs[name]
+            gridio.write(name, numpy.ma.masked_equal(z, 0))
+        else:
+            gridio.write(name, outputs[name])
+
+
+def main():
+    layers = sys.argv[1:] or ['water_att', 'forest_att']
+    for name in layers:
+        if name not in LAYERS:
+            sys.stderr.write(__doc__)
+            sys.exit(1)
+    run(layers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Cache of BIL files exported from GRASS raster layers for GLUC.
+
+Each projection needs boundary, landcover, nogrowth, and density BILs
+but most of them are exports of the same few layers (landcoverBase or
+landcoverRedev, nogrowth or zero, regional densities copied per
+projection).  BILExports remembers the modification stamp and content
+digest of each exported layer in <root>/manifest.json and keeps one
+export per distinct raster content.  Requested exports are hard linked
+from the cache so unchanged layers are never rewritten.
+
+NOTE: grass.script can only be imported once GISBASE is set so the import
+is deferred until the first export.
+"""
+import os
+import hashlib
+import json
+import shutil
+from glob import glob
+
+
+def _grass():
+    from grass.script import core
+    return core
+
+
+class BILExports:
+    """Exports GRASS raster layers as EHdr BIL files reusing previous
+    exports of identical rasters.
+
+    Attributes:
+      root (str): directory holding the cached exports and manifest
+    """
+
+    def __init__(self, root='gluc/Exports'):
+        self.root = root
+        self.fname = os.path.join(root, 'manifest.json')
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        try:
+            with open(self.fname) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            self.manifest = dict(layers={}, exports={})
+
+    def _save(self):
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(self.fname + '.tmp', self.fname)
+
+    def _files(self, layer):
+        """return fully qualified name and the (label, file) pairs defining
+        a raster layer (including the region, which determines the export)"""
+        grass = _grass()
+        d = grass.find_file(layer, element='cell')
+        if not d['name']:
+            raise RuntimeError('raster layer %s not found' % layer)
+
+        mapset = os.path.dirname(os.path.dirname(d['file']))
+        env = grass.gisenv()
+        files = [('WIND', os.path.join(env['GISDBASE'],
+                  env['LOCATION_NAME'], env['MAPSET'], 'WIND'))]
+        for element in ('cell', 'fcell', 'cellhd'):
+            files.append((element, os.path.join(mapset, element, d['name'])))
+        misc = os.path.join(mapset, 'cell_misc', d['name'])
+        if os.path.isdir(misc):
+            files += [('cell_misc/' + f, os.path.join(misc, f))
+                      for f in sorted(os.listdir(misc))]
+
+        return d['fullname'], [f for f in files if os.path.isfile(f[1])]
+
+    def _stamp(self, files):
+        return ';'.join('%s:%d:%f' % (f, os.path.getsize(f),
+                        os.path.getmtime(f)) for f in files)
+
+    def _digest(self, files):
+        """content digest independent of the layer name and mapset"""
+        h = hashlib.sha1()
+        for label, fname in files:
+            h.update(label)
+            with open(fname, 'rb') as f:
+                for block in iter(lambda: f.read(1024*1024), ''):
+                    h.update(block)
+        return h.hexdigest()
+
+    def export(self, layer, output, type='Byte'):
+        """Export a raster layer as a BIL file.
+
+        Args:
+          layer (str): GRASS raster layer
+          output (str): name of the BIL file to be created
+          type (str): GDAL data type passed to r.out.gdal
+
+        Returns:
+          bool: True if a cached export was reused
+        """
+        fullname, files = self._files(layer)
+        key = '%s:%s' % (fullname, type)
+
+        # the digest is only computed when the layer has been modified
+        stamp = self._stamp([f for label, f in files])
+        entry = self.manifest['layers'].get(key, {})
+        if entry.get('stamp') != stamp:
+            entry = dict(stamp=stamp, digest=self._digest(files))
+            self.manifest['layers'][key] = entry
+
+        # cached exports are verified in case a link was overwritten
+        name = '%s_%s' % (entry['digest'], type)
+        cached = os.path.join(self.root, name + '.bil')
+        reused = os.path.exists(cached) and \
+            self.manifest['exports'].get(name) == self._stamp([cached])
+        if not reused:
+            for fname in glob(os.path.join(self.root, name + '.*')):
+                os.remove(fname)
+            if _grass().run_command('r.out.gdal', input=layer,
+                    output=cached, format='EHdr', type=type, quiet=True):
+                raise RuntimeError('unable to export %s to %s' %
+                                   (layer, output))
+            self.manifest['exports'][name] = self._stamp([cached])
+        self._save()
+
+        # link the cached export and the files GDAL wrote along side it
+        base = os.path.splitext(output)[0]
+        for fname in glob(os.path.join(self.root, name + '.*')):
+            target = base + fname[len(os.path.join(self.root, name)):]
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(fname, target)
+            except OSError:
+                shutil.copy(fname, target)
+
+        return reused
@@ -53,6 +53,7 @@ class LEAMsite:
     def __init__(self, site, user, passwd):
         self.site = site
         self.error = False
+        self.staged = {}
         self.b = Browser()
         self.b.set_handle_robots(False)
 
@@ -92,13 +93,26 @@ class LEAMsite:
         return True
 
 
+    def stage(self, staged):
+        """Serve URLs from local copies rather than the site.
+
+        <staged> maps each URL to a local file already downloaded (see
+        prefetch.py).  Only plain GET requests made through getURL are
+        served from the staged files.
+        """
+        self.staged.update(staged)
+
+
     def getURL(self, url, data=None, filename=None):
         """Simple interface for retrieving the contents of a URL
            and writing it to a file or returning it as stringIO.
         """
         #sys.stderr.write('getURL %s\n' % url)
 
-        rsp = self.b.open(url, data)
+        if data is None and url in self.staged:
+            rsp = open(self.staged[url], 'rb')
+        else:
+            rsp = self.b.open(url, data)
 
         if filename:
             f = file(filename, 'wb')
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Streamed composition of the probability maps.
+
+probmaps.make builds probmap_com and probmap_res as products of the
+score layers, each score and each product written as a full raster by
+its own r.recode or r.mapcalc, then replaces the nulls of the probmaps
+with 0.  compose reads every attractor once, a block of rows at a time,
+computes the scores (weights and SFA curves included), multiplies them
+in place, applies the ComProb.sfa recode of probmap_com for probmap_res,
+and writes probmap_res, probmap_com, and optionally their GLUC BIL
+exports.  Score layers and probmap_com_score are only written when
+requested.
+
+The weights and SFA directory are read from probmaps.make so both
+builds use the same values.  The semantics follow the probmaps.make
+targets: any null score makes the probmap null (0 after r.null), scores
+raised to a weight are null where r.mapcalc pow() is null, and recoded
+scores have the type r.recode gives them.
+
+Usage:
+  probmap.py [-m makefile] [-k layer,...] [res.bil com.bil]
+"""
+import os
+import sys
+from optparse import OptionParser
+
+import numpy
+
+import bil
+import gridio
+import sfa
+import makesched
+
+
+# score layer -> (attractor layer, SFA file, weight variable), either of
+#   the last two may be None
+SCORES = [
+    ('cities_res_score', 'cities_att', None, 'W_CITIES_RES'),
+    ('cities_com_score', 'cities_att', None, 'W_CITIES_COM'),
+    ('emp_res_score', 'emp_att', 'EmpAttRes.sfa', 'W_EMP_RES'),
+    ('emp_com_score', 'emp_att', 'EmpAttCom.sfa', 'W_EMP_COM'),
+    ('transport_res_score', 'transport_att', 'TransportAttRes.sfa',
+     'W_TRANS_RES'),
+    ('transport_com_score', 'transport_att', 'TransportAttCom.sfa',
+     'W_TRANS_COM'),
+    ('special_res_score', 'special_res', None, 'W_SPECIAL_RES'),
+    ('special_com_score', 'special_com', None, 'W_SPECIAL_COM'),
+    ('forest_score', 'forest_att', 'ForestAttMeters.sfa', None),
+    ('water_score', 'water_att', 'WaterAttMeters.sfa', None),
+    ('slope_score', 'slope_att', 'Slope.sfa', None),
+    ]
+
+SHARED = ['forest_score', 'water_score', 'slope_score']
+COM = ['cities_com_score', 'emp_com_score', 'transport_com_score',
+       'special_com_score'] + SHARED
+RES = ['cities_res_score', 'emp_res_score', 'transport_res_score',
+       'special_res_score'] + SHARED
+
+# intermediate layers that can be kept
+INTERMEDIATE = [s[0] for s in SCORES] + ['probmap_com_score']
+
+
+def settings(makefile='bin/probmaps.make', **weights):
+    """return the probmaps.make variables with weights overridden"""
+    variables = makesched.read_variables(makefile)
+    variables.update((k, str(v)) for k, v in weights.items())
+    return variables
+
+
+def region_header():
+    """return the BIL extent tags of the current region"""
+    import grass.script as grass
+    r = grass.region()
+    return dict(ULXMAP=r['w'] + r['ewres'] / 2.0,
+                ULYMAP=r['n'] - r['nsres'] / 2.0,
+                XDIM=r['ewres'], YDIM=r['nsres'])
+
+
+class Scorer:
+    """Computes score layers from blocks of attractor values.
+
+    Args:
+      variables (dict): probmaps.make variables (weights and GRAPHS)
+      types (dict): GRASS type of each attractor layer
+    """
+
+    def __init__(self, variables, types):
+        graphs = variables.get('GRAPHS', './SFA')
+        self.specs = {}
+        for name, layer, fname, weight in SCORES:
+            rules = sfa.read_rules(os.path.join(graphs, fname)) \
+                if fname else None
+            w = float(variables[weight]) if weight else None
+            self.specs[name] = (layer, rules, w)
+        self.types = types
+
+    def score(self, name, blocks):
+        """Compute a score for a block.
+
+        Args:
+          name (str): score layer
+          blocks (dict): attractor layer -> float64 values, NaN for null
+
+        Returns:
+          numpy.ndarray: float64 score, NaN for null
+        """
+        layer, rules, weight = self.specs[name]
+        v = blocks[layer]
+        if rules:
+            v = sfa.recode(rules, v, self.types[layer])
+        if weight is not None:
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                v = numpy.power(v, weight)
+            v[~numpy.isfinite(v)] = numpy.nan
+        return v
+
+
+def compose(variables=None, bils=None, keep=(), rows=1024, inputs=None):
+    """Build probmap_res and probmap_com in a single pass.
+
+    Args:
+      variables (dict): probmaps.make variables (see settings)
+      bils (tuple): names of the res and com BIL files to be written
+      keep (list): intermediate layers to be written as well
+      rows (int): number of rows processed at a time
+      inputs (dict): attractor or score layer -> (array, GRASS type) used
+        instead of reading the attractor or computing the score, null
+        cells are NaN or NULL
+    """
+    variables = variables or settings()
+    keep = [k for k in keep if k in INTERMEDIATE]
+    inputs = dict(inputs or {})
+    for layer in set(s[1] for s in SCORES if s[0] not in inputs):
+        if layer not in inputs:
+            inputs[layer] = (gridio.load(layer, dtype=numpy.float64),
+                             sfa.datatype(layer))
+
+    scorer = Scorer(variables, dict((k, t) for k, (a, t) in inputs.items()))
+    comprob = sfa.read_rules(os.path.join(variables.get('GRAPHS', './SFA'),
+                                          'ComProb.sfa'))
+
+    res = gridio.empty(dtype=numpy.float64)
+    com = gridio.empty(dtype=numpy.float64)
+    kept = dict((k, gridio.empty(dtype=numpy.float64)) for k in keep)
+
+    for r in xrange(0, res.shape[0], rows):
+        blocks = {}
+        for layer, (a, t) in inputs.items():
+            x = numpy.asarray(a[r:r + rows], dtype=numpy.float64)
+            blocks[layer] = numpy.where(x == gridio.NULL, numpy.nan, x)
+
+        scores = {}
+        def get(name):
+            if name in blocks:
+                return blocks[name]
+            if name not in scores:
+                scores[name] = scorer.score(name, blocks)
+            return scores[name]
+
+        c = get(COM[0]).copy()
+        for name in COM[1:]:
+            c *= get(name)
+        p = sfa.recode(comprob, c)
+        scores['probmap_com_score'] = p
+        p = p.copy()
+        for name in RES:
+            p *= get(name)
+
+        # probmaps.make replaces the nulls with 0 (r.null null=0.0)
+        res[r:r + rows] = numpy.where(numpy.isnan(p), 0.0, p)
+        com[r:r + rows] = numpy.where(numpy.isnan(c), 0.0, c)
+        for name, a in kept.items():
+            v = get(name)
+            a[r:r + rows] = numpy.where(numpy.isnan(v), gridio.NULL, v)
+
+    gridio.write('probmap_res', res)
+    gridio.write('probmap_com', com)
+    for name, a in kept.items():
+        gridio.write(name, a)
+
+    if bils:
+        hdr = region_header()
+        for fname, a in zip(bils, (res, com)):
+            bil.write_bil(fname, a.astype(numpy.float32), **hdr)
+
+
+def main():
+    usage = 'usage: %prog [-m makefile] [-k layer,...] [res.bil com.bil]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-m', '--makefile', default='bin/probmaps.make',
+        help='makefile defining the weights (default=bin/probmaps.make)')
+    parser.add_option('-k', '--keep', default='',
+        help='comma separated intermediate layers to be written ' +
+             '(%s)' % ', '.join(INTERMEDIATE))
+    (opts, args) = parser.parse_args()
+    if len(args) not in (0, 2):
+        parser.error('both BIL files are required')
+
+    keep = [k for k in opts.keep.split(',') if k]
+    for k in keep:
+        if k not in INTERMEDIATE:
+            parser.error('unknown intermediate layer ' + k)
+    compose(settings(opts.makefile), bils=args or None, keep=keep)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,10 @@ r.out.gdal input=empcell output=empcell.gtif type=Byte
 r.out.gdal input=year output=year.gtif type=Byte
 python bin/leamsite.py -u $1 --putsimmap year.gtif ./results/year.map -t 'Year'
 
-r.neighbors -c input=ppcell output=ppcell_heat method=sum size=11
-r.neighbors -c input=empcell output=empcell_heat method=sum size=11
+python bin/convolve.py sum -c -s 11 ppcell ppcell_heat || \
+  r.neighbors -c input=ppcell output=ppcell_heat method=sum size=11
+python bin/convolve.py sum -c -s 11 empcell empcell_heat || \
+  r.neighbors -c input=empcell output=empcell_heat method=sum size=11
 
 
 #rm raster_results.zip
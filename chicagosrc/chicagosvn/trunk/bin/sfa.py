@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Score attractor layers with the SFA curves.
+
+Each *_score target ran r.recode with a rules file from SFA/ (often
+followed by an r.mapcalc raising the score to a weight), reading the
+attractor once per score.  The rules are compiled once into sorted
+breakpoints and evaluated on NumPy arrays, so every score of an
+attractor (e.g. the res and com scores) is computed from a single read.
+
+The rules follow the r.recode format, one 'lo:hi:vlo[:vhi]' interval per
+line (vhi defaults to vlo), and the GRASS 6.4 fpreclass semantics:
+
+  - a value within [lo, hi] is interpolated linearly from vlo to vhi,
+    where intervals overlap the rule listed last is used
+  - '*:hi:v' gives v to every value <= hi and 'lo:*:v' to every value
+    >= lo, only when no other interval applies
+  - values not covered by any rule are null
+  - the output has the type of the input layer (integer input gives
+    truncated integer scores as r.recode)
+
+Without numpy each score is built with r.recode and r.mapcalc.
+
+Usage:
+  sfa.py input output:rules[:weight] [output:rules[:weight] ...]
+"""
+import sys
+import hashlib
+
+try:
+    import numpy
+    import gridio
+except ImportError:
+    numpy = None
+
+
+_compiled = {}
+
+
+class Rules:
+    """SFA rules compiled into sorted breakpoints.
+
+    Attributes:
+      points (array): sorted finite interval limits
+      at (array): rule used for a value equal to each point (-1 for none)
+      between (array): rule used for the values between consecutive
+        points, between[i] covers points[i-1] < x < points[i]
+      lo, hi, vlo, vhi (array): the interval and values of each rule
+      left, right (tuple): (limit, value) of the open-ended rules or None
+    """
+
+    def __init__(self, text):
+        rules, self.left, self.right = [], None, None
+        for line in text.splitlines():
+            line = line.split('#')[0].strip()
+            if not line or line.lower() == 'end':
+                continue
+            f = line.split(':')
+            if len(f) == 3:
+                f.append(f[2])
+            if len(f) != 4:
+                raise ValueError('bad SFA rule: ' + line)
+            if f[0].strip() == '*':
+                self.left = (float(f[1]), float(f[2]))
+            elif f[1].strip() == '*':
+                self.right = (float(f[0]), float(f[2]))
+            else:
+                lo, hi, vlo, vhi = [float(v) for v in f]
+                if lo > hi:
+                    lo, hi, vlo, vhi = hi, lo, vhi, vlo
+                rules.append((lo, hi, vlo, vhi))
+
+        self.lo, self.hi, self.vlo, self.vhi = \
+            [numpy.array(v, dtype=numpy.float64) for v in
+             (zip(*rules) if rules else ([], [], [], []))]
+        self.points = numpy.unique(numpy.concatenate((self.lo, self.hi)))
+
+        # the last rule covering each point and each gap between points
+        mids = (self.points[:-1] + self.points[1:]) / 2.0
+        self.at = numpy.empty(len(self.points), dtype=numpy.int32)
+        self.at.fill(-1)
+        self.between = numpy.empty(len(self.points) + 1, dtype=numpy.int32)
+        self.between.fill(-1)
+        for i in range(len(rules)):
+            self.at[(self.points >= self.lo[i]) &
+                    (self.points <= self.hi[i])] = i
+            self.between[1:-1][(mids > self.lo[i]) & (mids < self.hi[i])] = i
+
+    def __call__(self, x):
+        """Evaluate the rules.
+
+        Args:
+          x (array): values, NaN for null
+
+        Returns:
+          numpy.ndarray: float64 scores, NaN for null
+        """
+        x = numpy.asarray(x, dtype=numpy.float64)
+        out = numpy.empty(x.shape)
+        out.fill(numpy.nan)
+
+        if len(self.points):
+            i = numpy.searchsorted(self.points, x)
+            j = numpy.minimum(i, len(self.points) - 1)
+            rule = numpy.where(self.points[j] == x, self.at[j],
+                               self.between[i])
+            hit = rule >= 0
+            r = rule[hit]
+            lo, hi, vlo, vhi = self.lo[r], self.hi[r], self.vlo[r], self.vhi[r]
+            # same arithmetic as fpreclass_interpolate
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                v = (x[hit] - lo) / (hi - lo) * (vhi - vlo) + vlo
+            out[hit] = numpy.where((vlo == vhi) | (lo == hi), vlo, v)
+        else:
+            hit = numpy.zeros(x.shape, dtype=bool)
+
+        if self.left:
+            m = ~hit & (x <= self.left[0])
+            out[m] = self.left[1]
+            hit |= m
+        if self.right:
+            m = ~hit & (x >= self.right[0])
+            out[m] = self.right[1]
+        return out
+
+
+def read_rules(fname):
+    """return the compiled Rules of an SFA file, cached by its content"""
+    with open(fname) as f:
+        text = f.read()
+    key = hashlib.sha1(text).hexdigest()
+    if key not in _compiled:
+        _compiled[key] = Rules(text)
+    return _compiled[key]
+
+
+def datatype(layer):
+    """return the GRASS type of a raster layer (CELL, FCELL, or DCELL)"""
+    import grass.script as grass
+    return grass.raster_info(layer)['datatype']
+
+
+def recode(rules, x, dtype='DCELL'):
+    """Evaluate the rules as r.recode of a layer of a GRASS type.
+
+    Returns:
+      numpy.ndarray: float64 scores (truncated for CELL and rounded to
+        float32 for FCELL), NaN for null
+    """
+    v = rules(x)
+    if dtype == 'CELL':
+        v = numpy.trunc(v)
+    elif dtype == 'FCELL':
+        v = v.astype(numpy.float32).astype(numpy.float64)
+    return v
+
+
+def score(layer, outputs, rows=1024):
+    """Compute the scores of an attractor layer in a single read.
+
+    Args:
+      layer (str): GRASS layer to be scored
+      outputs (list): (output layer, SFA file, weight) for each score,
+        the score is raised to the weight (None to skip)
+      rows (int): number of rows processed at a time
+    """
+    if numpy is None:
+        return _grass_score(layer, outputs)
+
+    gtype = datatype(layer)
+    dtype = dict(CELL=numpy.int32, FCELL=numpy.float32).get(gtype,
+                                                            numpy.float64)
+    rules = [read_rules(fname) for _, fname, _ in outputs]
+    src = gridio.load(layer, dtype=numpy.float64)
+    dest = [gridio.empty(dtype=numpy.float64) for _ in outputs]
+
+    for r in xrange(0, src.shape[0], rows):
+        x = numpy.asarray(src[r:r + rows])
+        x = numpy.where(x == gridio.NULL, numpy.nan, x)
+        for i, (_, _, weight) in enumerate(outputs):
+            v = recode(rules[i], x, gtype)
+            if weight is not None:
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    v = numpy.power(v, weight)
+            dest[i][r:r + rows] = numpy.where(numpy.isfinite(v), v,
+                                              gridio.NULL)
+
+    for (name, _, weight), a in zip(outputs, dest):
+        if dtype is numpy.float64 or weight is not None:
+            gridio.write(name, a)
+        else:
+            gridio.write(name, a.astype(dtype))
+
+
+def _grass_score(layer, outputs):
+    """score a layer with r.recode and r.mapcalc"""
+    import grass.script as grass
+    for name, fname, weight in outputs:
+        tmp = name if weight is None else name + '_sfa'
+        grass.run_command('r.recode', input=layer, output=tmp, rules=fname,
+                          overwrite=True, quiet=True)
+        if weight is not None:
+            grass.mapcalc('%s=pow(%s,%s)' % (name, tmp, weight),
+                          overwrite=True, quiet=True)
+            grass.run_command('g.remove', rast=tmp, quiet=True)
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    outputs = []
+    for arg in sys.argv[2:]:
+        f = arg.split(':')
+        if len(f) not in (2, 3):
+            sys.stderr.write(__doc__)
+            sys.exit(1)
+        outputs.append((f[0], f[1], float(f[2]) if len(f) == 3 else None))
+    score(sys.argv[1], outputs)
+
+
+if __name__ == '__main__':
+    main()
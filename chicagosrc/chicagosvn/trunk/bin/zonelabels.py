@@ -0,0 +1,254 @@
+"""
+Label raster of the projection zones.
+
+Each zone was rasterized by getLayerMask with v.to.rast and r.null, added
+to the subzones layer by processProjections with an r.mapcalc, and read
+again as a full region mask by the sanity check, the boundary export,
+and the window of the projection.  ZoneLabels rasterizes each zone once
+with GDAL, over the cells of the zone's extent only, and keeps the mask
+of its bounding window.  build labels the zones in projection order and
+writes a single integer label raster (0 outside of every zone) which is
+the union used as the regional nogrowth.
+
+Cells are assigned to a zone when their centre is within a polygon, as
+with v.to.rast.  Cells claimed by more than one zone take the label of
+the last zone, as later projections take precedence when merged, and
+are reported as overlaps.  The mask of each zone is kept whole so
+overlaps never change the boundary of a projection.
+"""
+import math
+
+import numpy
+from osgeo import gdal, ogr, osr
+
+import bil
+import gridio
+
+
+def _traditional(srs):
+    """use x/y axis order (GDAL 3 follows the authority, e.g. lat/lon)"""
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+
+def rasterize(shapefile, region, srs):
+    """Rasterize the polygons of a shapefile over the cells of their extent.
+
+    Args:
+      shapefile (str): name of the shapefile
+      region (dict): GRASS region (as grass.region)
+      srs (str): WKT of the GRASS location, the polygons are transformed
+        when the shapefile has a different coordinate system
+
+    Returns:
+      (numpy.ndarray, int, int): boolean mask and the region row and
+        column of its first cell, the mask is empty when the polygons
+        are outside of the region
+    """
+    target = osr.SpatialReference()
+    target.ImportFromWkt(srs)
+    _traditional(target)
+
+    src = ogr.Open(shapefile)
+    if not src:
+        raise RuntimeError('unable to open shapefile ' + shapefile)
+    layer = src.GetLayer(0)
+    transform = None
+    source = layer.GetSpatialRef()
+    if source is not None and not source.IsSame(target):
+        _traditional(source)
+        transform = osr.CoordinateTransformation(source, target)
+
+    mem = ogr.GetDriverByName('Memory').CreateDataSource('zone')
+    zone = mem.CreateLayer('zone', srs=target)
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        if transform:
+            geom.Transform(transform)
+        f = ogr.Feature(zone.GetLayerDefn())
+        f.SetGeometry(geom)
+        zone.CreateFeature(f)
+
+    empty = (numpy.zeros((0, 0), dtype=bool), 0, 0)
+    if not zone.GetFeatureCount():
+        return empty
+
+    # cells of the region covering the extent of the polygons
+    nsres, ewres = region['nsres'], region['ewres']
+    nrows, ncols = int(region['rows']), int(region['cols'])
+    xmin, xmax, ymin, ymax = zone.GetExtent()
+    r0 = max(int(math.floor((region['n'] - ymax) / nsres)), 0)
+    r1 = min(int(math.ceil((region['n'] - ymin) / nsres)), nrows)
+    c0 = max(int(math.floor((xmin - region['w']) / ewres)), 0)
+    c1 = min(int(math.ceil((xmax - region['w']) / ewres)), ncols)
+    if r0 >= r1 or c0 >= c1:
+        return empty
+
+    ds = gdal.GetDriverByName('MEM').Create('', c1 - c0, r1 - r0, 1,
+                                            gdal.GDT_Byte)
+    ds.SetGeoTransform((region['w'] + c0 * ewres, ewres, 0.0,
+                        region['n'] - r0 * nsres, 0.0, -nsres))
+    ds.SetProjection(srs)
+    if gdal.RasterizeLayer(ds, [1], zone, burn_values=[1]):
+        raise RuntimeError('unable to rasterize shapefile ' + shapefile)
+    return ds.GetRasterBand(1).ReadAsArray() != 0, r0, c0
+
+
+class Zone:
+    """Mask of a zone within its bounding window.
+
+    Attributes:
+      key (str): zone identifier (the boundary of the projection)
+      window (tuple): first row, last row + 1, first column, and last
+        column + 1 of the zone cells, None for an empty zone
+      cells (int): number of zone cells
+      label (int): value of the zone in the label raster, 0 until built
+    """
+
+    def __init__(self, key, mask, row=0, col=0):
+        self.key = key
+        self.label = 0
+        self.window, self.cells, self.packed = None, 0, None
+
+        rows = numpy.flatnonzero(mask.any(axis=1))
+        cols = numpy.flatnonzero(mask.any(axis=0))
+        if not len(rows):
+            return
+        mask = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        self.window = (int(row + rows[0]), int(row + rows[-1] + 1),
+                       int(col + cols[0]), int(col + cols[-1] + 1))
+        self.cells = int(numpy.count_nonzero(mask))
+        self.packed = numpy.packbits(mask, axis=1)
+
+    def mask(self):
+        """return the boolean mask of the zone window"""
+        if self.window is None:
+            return numpy.zeros((0, 0), dtype=bool)
+        ncols = self.window[3] - self.window[2]
+        return numpy.unpackbits(self.packed, axis=1)[:, :ncols] != 0
+
+
+class ZoneLabels:
+    """Zones of the projections and their label raster.
+
+    Attributes:
+      layer (str): GRASS label raster written by build
+      zones (dict): key -> Zone
+      overlaps (dict): (key, key) -> number of cells claimed by both
+        zones, the second zone holds the label
+      labels (array): label raster written by build, None until built
+    """
+
+    def __init__(self, layer='subzones', region=None, srs=None):
+        if region is None or srs is None:
+            import grass.script as grass
+            region = region or grass.region()
+            srs = srs or grass.read_command('g.proj', flags='wf')
+        self.layer = layer
+        self.region = region
+        self.srs = srs
+        self.shape = (int(self.region['rows']), int(self.region['cols']))
+        self.zones = {}
+        self.overlaps = {}
+        self.labels = None
+
+    def add(self, key, shapefile):
+        """Rasterize a shapefile as the zone <key> and return the Zone."""
+        mask, row, col = rasterize(shapefile, self.region, self.srs)
+        self.zones[key] = Zone(key, mask, row, col)
+        return self.zones[key]
+
+    def zone(self, key):
+        """return the Zone of a key"""
+        return self.zones[key]
+
+    def window(self, key, margin=0):
+        """Bounding window of a zone plus a margin.
+
+        Returns:
+          tuple: see Zone.window, None when the zone is empty or the
+            window covers the region
+        """
+        z = self.zones[key]
+        if z.window is None:
+            return None
+        r0, r1, c0, c1 = z.window
+        nrows, ncols = self.shape
+        window = (max(r0 - margin, 0), min(r1 + margin, nrows),
+                  max(c0 - margin, 0), min(c1 + margin, ncols))
+        if window == (0, nrows, 0, ncols):
+            return None
+        return window
+
+    def mask(self, key, window=None):
+        """return the mask of a zone over a window (default=the region)"""
+        r0, r1, c0, c1 = window or (0, self.shape[0], 0, self.shape[1])
+        out = numpy.zeros((r1 - r0, c1 - c0), dtype=bool)
+        z = self.zones[key]
+        if z.window is None:
+            return out
+
+        # intersection of the zone and requested windows
+        zr0, zr1, zc0, zc1 = z.window
+        lo, hi = max(zr0, r0), min(zr1, r1)
+        left, right = max(zc0, c0), min(zc1, c1)
+        if lo < hi and left < right:
+            out[lo - r0:hi - r0, left - c0:right - c0] = \
+                z.mask()[lo - zr0:hi - zr0, left - zc0:right - zc0]
+        return out
+
+    def build(self, keys):
+        """Label the zones in order and write the label raster.
+
+        Args:
+          keys (list): zones in projection order, labelled 1..n
+
+        Returns:
+          dict: overlaps, see ZoneLabels.overlaps
+        """
+        labels = gridio.empty(dtype=numpy.int32)
+        labels[...] = 0
+        self.overlaps = {}
+        for label, key in enumerate(keys, 1):
+            z = self.zones[key]
+            z.label = label
+            if z.window is None:
+                continue
+            r0, r1, c0, c1 = z.window
+            m = z.mask()
+            win = labels[r0:r1, c0:c1]
+            prior = numpy.bincount(win[m], minlength=label)
+            for other in numpy.flatnonzero(prior[1:]) + 1:
+                self.overlaps[(keys[other - 1], key)] = int(prior[other])
+            win[m] = label
+
+        gridio.write(self.layer, labels)
+        self.labels = labels
+        return self.overlaps
+
+    def header(self, window=None):
+        """return the BIL extent tags of a window (default=the region)"""
+        r0, r1, c0, c1 = window or (0, self.shape[0], 0, self.shape[1])
+        return dict(
+            ULXMAP=self.region['w'] + (c0 + 0.5) * self.region['ewres'],
+            ULYMAP=self.region['n'] - (r0 + 0.5) * self.region['nsres'],
+            XDIM=self.region['ewres'], YDIM=self.region['nsres'])
+
+    def write_union_bil(self, base, bilname):
+        """Write a Byte BIL file of the region set to 1 where <base> (an
+        array of the region) is non-zero or any zone was labelled."""
+        union = (base != 0) | (self.labels > 0)
+        bil.write_bil(bilname, union.astype(numpy.uint8), **self.header())
+
+    def write_bil(self, key, bilname, window=None):
+        """Write the mask of a zone as a Byte BIL file (1 within the zone,
+        0 elsewhere) covering a window (default=the region)."""
+        bil.write_bil(bilname, self.mask(key, window).astype(numpy.uint8),
+                      **self.header(window))
+
+    def write(self, key):
+        """Write the mask of a zone as the GRASS raster <key> (0/1)."""
+        gridio.write(key, self.mask(key).astype(numpy.int32))
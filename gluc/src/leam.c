@@ -198,6 +198,40 @@ void parseOptions(int argc, char *argv[])
     }
 }
 
+/* seconds elapsed between two timevals */
+static double elapsed(struct timeval *from, struct timeval *to)
+{
+    return (to->tv_sec - from->tv_sec) + (to->tv_usec - from->tv_usec) / 1e6;
+}
+
+/* Per Rank Timing - gather the io, compute, and barrier wait times of
+** every rank and print one line per rank on rank 0.  The lines are
+** read by startup.py and recorded in the run profile.
+*/
+static void reportRankTiming(int *gridrows, struct timeval *start,
+                struct timeval *ioend, struct timeval *done,
+                struct timeval *end)
+{
+    int i;
+    double mine[3], *all = NULL;
+
+    mine[0] = elapsed(start, ioend);
+    mine[1] = elapsed(ioend, done);
+    mine[2] = elapsed(done, end);
+
+    if (myrank == 0)
+        all = (double *)getMem(sizeof (double) * 3 * nproc, "ranktiming");
+    MPI_Gather(mine, 3, MPI_DOUBLE, all, 3, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+
+    if (myrank == 0)  {
+        for (i=0; i<nproc; i+=1)
+            printf("rank %d rows %d-%d io %.3f compute %.3f wait %.3f\n",
+                i, gridrows[i], gridrows[i+1]-1,
+                all[3*i], all[3*i+1], all[3*i+2]);
+        freeMem(all);
+    }
+}
+
 /* quickArgs is checked before anything else.  If the program invocation
 ** only requires a usage statement then print that message and exit.
 */
@@ -228,7 +262,7 @@ int main(int argc, char *argv[])
 {
     int i;
     int rows, cols, *gridrows;
-    struct timeval start, ioend, end;
+    struct timeval start, ioend, done, end;
 
     /* check for invokations only requiring usage and version info */
     quickArgs(argc, argv);
@@ -304,8 +338,11 @@ int main(int argc, char *argv[])
     ** calling MPI_Finalize because the number of active processes
     ** following MPI_Finalize is undefined!
     */
+    gettimeofday(&done, NULL);
     MPI_Barrier(MPI_COMM_WORLD);
     gettimeofday(&end, NULL);
+    if (timing)
+        reportRankTiming(gridrows, &start, &ioend, &done, &end);
     if (timing && myrank == 0)  {
         printf("\n===== Timing Information ======\n");
         if (end.tv_usec - start.tv_usec < 0)  {
@@ -4,9 +4,52 @@ from Products.Five import BrowserView
 from Products.CMFCore.utils import getToolByName
 
 from leam.luc import lucMessageFactory as _
+from leam.luc import lease
 from leam.luc.interfaces import IModel
+from leam.luc.jobqueue import get_queue
 
 import json
+import time
+import threading
+import transaction
+import logging
+log = logging.getLogger(__name__)
+
+# longest a long-poll is held in seconds, each held request occupies a
+# ZServer thread
+MAX_WAIT = 60
+
+# interval between checks of the queue while a long-poll is held
+WAIT_INTERVAL = 1.0
+
+# most long-polls held at once, further polls return EMPTY at once so
+# waiting workers cannot take all the ZServer threads.  Each held poll
+# keeps a thread sleeping for up to MAX_WAIT, so keep it well below the
+# zserver-threads of zope.conf (4 by default), set with
+#
+#   <product-config leam.luc>
+#       max_waiters 1
+#   </product-config>
+#
+# and 0 disables the long-poll.
+MAX_WAITERS = 1
+
+
+def max_waiters():
+    """return the max_waiters of the leam.luc product-config"""
+    try:
+        from App.config import getConfiguration
+    except ImportError:
+        return MAX_WAITERS
+    config = getattr(getConfiguration(), 'product_config', None) or {}
+    try:
+        return max(int(config.get('leam.luc', {}).get('max_waiters',
+                                                      MAX_WAITERS)), 0)
+    except ValueError:
+        log.error('invalid max_waiters in the leam.luc product-config')
+        return MAX_WAITERS
+
+_waiters = threading.BoundedSemaphore(max_waiters())
 
 
 class IPopQueue(Interface):
@@ -34,16 +77,57 @@ class PopQueue(BrowserView):
     def portal(self):
         return getToolByName(self.context, 'portal_url').getPortalObject()
 
+    def wait(self):
+        """seconds a long-poll (pop_queue?wait=N) is held without a job"""
+        try:
+            wait = int(self.request.get('wait', 0))
+        except ValueError:
+            return 0
+        return min(max(wait, 0), MAX_WAIT)
+
+    def catalog_pop(self):
+        """return the oldest queued model object from the catalog, jobs are
+        served this way until the upgrade step installs the job queue"""
+        results = self.portal_catalog(object_provides=IModel.__identifier__,
+                                      runstatus='queued', sort_on='modified')
+        return results[0].getObject() if results else None
+
+    def hold(self, queue, deadline):
+        """Hold the request until a job is queued, a lease expired or the
+        deadline passed.  Each check aborts the transaction to see the
+        jobs queued by other requests, nothing is committed before the
+        job is popped so a conflict retry does not repeat a partial wait."""
+        while time.time() < deadline:
+            if len(queue) or queue.expired(time.time()):
+                return True
+            transaction.abort()
+            time.sleep(WAIT_INTERVAL)
+        return False
+
     def __call__(self):
         
         #import pdb; pdb.set_trace()
 
-        filter = { 'object_provides' : IModel.__identifier__,
-                   'runstatus' : 'queued'
-                 }
-        results = self.portal_catalog(filter, sort_on='modified')
-        if results:
-            obj = results[0].getObject()
+        queue = get_queue()
+        timeout, attempts = lease.settings()
+        if queue is None:
+            log.warn('no job queue, popping the catalog, upgrade the '
+                     'leam.luc profile')
+            obj = self.catalog_pop()
+
+        else:
+            wait = self.wait()
+            if wait and _waiters.acquire(False):
+                try:
+                    self.hold(queue, time.time() + wait)
+                finally:
+                    _waiters.release()
+
+            # jobs whose worker stopped sending heartbeats are requeued
+            lease.recover(queue, attempts)
+            obj = queue.pop()
+
+        if obj is not None:
             url = obj.absolute_url()
             rsp = dict(
                 status = 'OK',
@@ -54,13 +138,14 @@ class PopQueue(BrowserView):
                 cmdline = obj.cmdline(),
                 on_success = url + '/success',
                 on_error = url + '/error',
+                heartbeat = url + '/heartbeat',
+                lease_timeout = timeout,
                 )
                 #cmdline = getattr(obj, 'cmdline', ''),
 
 
-            # mark the object as running
-            obj.runstatus = 'running'
-            obj.reindexObject(['runstatus',])
+            # mark the object as running under a lease
+            rsp['lease'] = lease.claim(obj, timeout, queue)
 
         # nothing to do
         else:
@@ -69,3 +154,68 @@ class PopQueue(BrowserView):
         self.request.RESPONSE.setHeader('Content-Type', 'application/json')
         return json.dumps(rsp)
 
+
+class LeaseView(BrowserView):
+    """
+    base of the views called by the worker holding the lease of a job,
+    the lease token is passed as the 'lease' request parameter
+    """
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+
+    def reply(self, **rsp):
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        return json.dumps(rsp)
+
+    @property
+    def queue(self):
+        return get_queue()
+
+    def lost(self):
+        """the lease expired or was granted to another worker"""
+        log.warn('%s called without the lease of %s' %
+                 (self.__name__, self.context.absolute_url()))
+        return self.reply(status='LOST', runstatus=self.context.runstatus)
+
+
+class Heartbeat(LeaseView):
+    """
+    renew the lease of a running job
+    """
+
+    def __call__(self):
+        timeout, attempts = lease.settings()
+        expires = lease.renew(self.context, self.request.get('lease'),
+                              timeout, self.queue)
+        if expires is None:
+            return self.lost()
+        return self.reply(status='OK', expires=expires)
+
+
+class Success(LeaseView):
+    """
+    mark a job complete and release its lease
+    """
+
+    def __call__(self):
+        if not lease.release(self.context, self.request.get('lease'),
+                             'complete', self.queue):
+            return self.lost()
+        return self.reply(status='OK', runstatus='complete')
+
+
+class Error(LeaseView):
+    """
+    mark a job as failed with an error and release its lease, jobs
+    reporting errors are not retried
+    """
+
+    def __call__(self):
+        if not lease.release(self.context, self.request.get('lease'),
+                             'error', self.queue):
+            return self.lost()
+        log.error('%s: %s' % (self.context.absolute_url(),
+                              self.request.get('msg', '')))
+        return self.reply(status='OK', runstatus='error')
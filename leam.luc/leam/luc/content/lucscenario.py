@@ -23,6 +23,8 @@ from leam.luc import lucMessageFactory as _
 
 from leam.luc.interfaces import ILUCScenario,ILUCSettings,IModel
 from leam.luc.config import PROJECTNAME
+from leam.luc import lease
+from leam.luc.jobqueue import queue_job
 
 from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
 import json
@@ -227,8 +229,8 @@ class LUCScenario(folder.ATFolder):
     security.declarePublic('requeue')
     def requeue(self):
         """simple method to requeue the current scenario"""
-        self.runstatus = 'queued'
-        self.reindexObject(['runstatus',])
+        lease.reset(self)
+        queue_job(self)
         return "requeue"
 
 
@@ -274,8 +276,8 @@ class LUCScenario(folder.ATFolder):
         scenario_id = intids.getId(context)
         for ids in localpp.keys():
             localpp[ids].scenario = RelationValue(scenario_id)
-            localpp[ids].runstatus = 'queued'
-            localpp[ids].reindexObject(['runstatus',])
+            lease.reset(localpp[ids])
+            queue_job(localpp[ids])
 
         return '%d jobs queued' % len(localpp.keys())
 
@@ -451,3 +453,9 @@ class LUCScenario(folder.ATFolder):
 
 
 atapi.registerType(LUCScenario, PROJECTNAME)
+
+
+def scenarioQueued(scenario, event):
+    """queue a new scenario created with the default 'queued' runstatus"""
+    if scenario.runstatus == 'queued':
+        queue_job(scenario)
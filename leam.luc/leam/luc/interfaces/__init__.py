@@ -4,3 +4,4 @@ from probmap import IProbmap
 from lucscenario import ILUCScenario
 from settings import ILUCSettings
 from model import IModel
+from jobqueue import IJobQueue
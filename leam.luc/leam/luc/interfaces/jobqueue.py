@@ -0,0 +1,22 @@
+from zope.interface import Interface
+
+from leam.luc import lucMessageFactory as _
+
+
+class IJobQueue(Interface):
+    """The site queue of model jobs polled by pop_queue."""
+
+    def put(obj):
+        """Mark a model object queued and append it to the queue."""
+
+    def pop():
+        """Remove and return the first queued model object or None."""
+
+    def lease(obj, expires):
+        """Record the lease expiry of a running model object."""
+
+    def release(obj):
+        """Forget the lease of a model object."""
+
+    def expired(now):
+        """Return the model objects whose lease expired before now."""
@@ -34,3 +34,19 @@ class ILUCSettings(Interface):
         default=u"python startup.py -c config.xml",
     )
 
+    lease_timeout = schema.Int(
+        title=_(u"Job Lease Timeout"),
+        required=False,
+        description=_(u"Seconds a running job is held without a heartbeat "
+                      u"from its worker before it is requeued"),
+        default=900,
+    )
+
+    max_attempts = schema.Int(
+        title=_(u"Maximum Job Attempts"),
+        required=False,
+        description=_(u"Number of times a job is run before a job whose "
+                      u"lease expired is marked failed"),
+        default=3,
+    )
+
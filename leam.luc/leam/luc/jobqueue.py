@@ -0,0 +1,146 @@
+"""Site queue of the model jobs.
+
+pop_queue searched the catalog for queued IModel objects on every poll,
+woke the oldest, and reindexed it, so each poll loaded the catalog and
+concurrent polls could hand the same job to two workers.  JobQueue is a
+persistent local utility keeping the queued jobs in a BTree keyed by the
+time they were queued:
+
+  - put appends a job and pop removes the oldest, both O(log n), the
+    number of queued jobs is kept in a Length counter
+  - jobs are stored by their intid, the BTree conflict resolution merges
+    concurrent puts, while two pops of the same job conflict and the
+    second request is retried by Zope, so a job is handed out once
+  - the lease expiry of running jobs is kept as well so expired leases
+    are found without a catalog query
+
+Jobs are queued with queue_job (LUCScenario.requeue and queue_post, the
+TAZ analysis subscriber, and new scenarios), setting the runstatus as
+well.  Until the upgrade step installed the queue queue_job only sets
+the runstatus, pop_queue then finds the jobs with the catalog and the
+upgrade step adds those left to the queue.
+Entries whose object was deleted or is no longer 'queued' are dropped by
+pop.
+"""
+import time
+
+from persistent import Persistent
+from BTrees.LLBTree import LLBTree
+from BTrees.Length import Length
+
+from zope.interface import implements
+from zope.component import getUtility, queryUtility
+from zope.app.intid.interfaces import IIntIds
+from Products.CMFCore.utils import getToolByName
+
+from leam.luc.interfaces import IJobQueue, IModel
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class JobQueue(Persistent):
+    """FIFO queue of model jobs and leases of the running jobs."""
+    implements(IJobQueue)
+
+    def __init__(self):
+        self._queue = LLBTree()     # time queued (usec) -> intid
+        self._queued = LLBTree()    # intid -> time queued
+        self._running = LLBTree()   # intid -> lease expiry (sec)
+        self._length = Length()     # len(self._queue)
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, obj):
+        intid = getUtility(IIntIds).queryId(obj)
+        return intid is not None and intid in self._queued
+
+    def put(self, obj):
+        """Mark a model object queued and append it to the queue, an object
+        already queued keeps its place."""
+        intid = getUtility(IIntIds).register(obj)
+        self._running.pop(intid, None)
+        if intid not in self._queued:
+            key = int(time.time() * 1e6)
+            while key in self._queue:
+                key += 1
+            self._queue[key] = intid
+            self._queued[intid] = key
+            self._length.change(1)
+        obj.runstatus = 'queued'
+        obj.reindexObject(['runstatus',])
+
+    def pop(self):
+        """Remove and return the first queued model object or None."""
+        intids = getUtility(IIntIds)
+        while self._queue:
+            key = self._queue.minKey()
+            intid = self._queue.pop(key)
+            self._queued.pop(intid, None)
+            self._length.change(-1)
+            obj = intids.queryObject(intid)
+            if obj is not None and obj.runstatus == 'queued':
+                return obj
+            log.info('dropped job %d no longer queued' % intid)
+        return None
+
+    def lease(self, obj, expires):
+        """Record the lease expiry of a running model object."""
+        intid = getUtility(IIntIds).register(obj)
+        self._running[intid] = int(expires)
+
+    def release(self, obj):
+        """Forget the lease of a model object."""
+        intid = getUtility(IIntIds).queryId(obj)
+        if intid is not None:
+            self._running.pop(intid, None)
+
+    def expired(self, now):
+        """Return the model objects whose lease expired before now."""
+        intids = getUtility(IIntIds)
+        objs = []
+        for intid, expires in list(self._running.items()):
+            if expires >= now:
+                continue
+            obj = intids.queryObject(intid)
+            if obj is None:
+                del self._running[intid]
+            else:
+                objs.append(obj)
+        return objs
+
+
+def get_queue():
+    """return the job queue of the site, None if it is not installed"""
+    return queryUtility(IJobQueue)
+
+
+def queue_job(obj):
+    """Queue a model object, only mark it queued when the job queue is
+    not installed (the upgrade step queues it from the catalog)."""
+    queue = get_queue()
+    if queue is not None:
+        queue.put(obj)
+    else:
+        log.warn('no job queue, %s marked queued only, upgrade the '
+                 'leam.luc profile' % obj.absolute_url())
+        obj.runstatus = 'queued'
+        obj.reindexObject(['runstatus',])
+
+
+def fill(queue, catalog):
+    """Queue the jobs marked queued in the catalog, oldest first, for
+    sites upgraded from the catalog based pop_queue."""
+    for brain in catalog(object_provides=IModel.__identifier__,
+                         runstatus='queued', sort_on='modified'):
+        queue.put(brain.getObject())
+    return len(queue)
+
+
+def install_queue(context):
+    """upgrade step registering the job queue (componentregistry.xml)"""
+    context.runImportStepFromProfile('profile-leam.luc:default',
+                                     'componentregistry')
+    n = fill(get_queue(), getToolByName(context, 'portal_catalog'))
+    log.info('job queue installed with %d queued jobs' % n)
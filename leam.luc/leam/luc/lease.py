@@ -0,0 +1,137 @@
+"""Leases of the model jobs handed out by pop_queue.
+
+pop_queue claims a job by granting a lease: a random token and an
+expiry time stored on the model object.  The worker renews the lease
+with the heartbeat view while the model runs and returns it with the
+success or error view.  The expiry is recorded in the job queue as
+well (see leam.luc.jobqueue) so expired leases are found without a
+catalog query.  A job whose lease expired (the worker died or lost the
+portal) is requeued by the next pop_queue, up to the maximum number of
+attempts after which it is marked 'failed'.
+
+Jobs marked 'running' before leases were introduced have no expiry and
+are left alone, use requeue to restart them.
+
+Until the upgrade step installs the job queue the queue passed is None,
+the leases are granted and checked but expired leases are not recovered.
+"""
+import time
+import uuid
+import logging
+
+from zope.component import queryUtility
+from plone.registry.interfaces import IRegistry
+
+log = logging.getLogger(__name__)
+
+# defaults when the registry records are not installed
+LEASE_TIMEOUT = 900
+MAX_ATTEMPTS = 3
+
+_prefix = 'leam.luc.interfaces.settings.ILUCSettings.'
+
+
+def settings():
+    """return the lease timeout (seconds) and the maximum attempts"""
+    registry = queryUtility(IRegistry)
+    if registry is None:
+        return LEASE_TIMEOUT, MAX_ATTEMPTS
+    timeout = registry.get(_prefix + 'lease_timeout') or LEASE_TIMEOUT
+    attempts = registry.get(_prefix + 'max_attempts') or MAX_ATTEMPTS
+    return timeout, attempts
+
+
+def install_settings(context):
+    """upgrade step registering the lease records (registry.xml), the
+    ILUCSettings records already set keep their values"""
+    context.runImportStepFromProfile('profile-leam.luc:default',
+                                     'plone.app.registry')
+    log.info('lease settings installed')
+
+
+def claim(obj, timeout, queue):
+    """Mark a job as running under a new lease and return its token."""
+    obj.lease_token = uuid.uuid4().hex
+    obj.lease_expires = time.time() + timeout
+    obj.attempts = getattr(obj, 'attempts', 0) + 1
+    obj.runstatus = 'running'
+    obj.reindexObject(['runstatus',])
+    if queue is not None:
+        queue.lease(obj, obj.lease_expires)
+    return obj.lease_token
+
+
+def holds(obj, token):
+    """return True when token is the current lease of a running job"""
+    return bool(token) and obj.runstatus == 'running' and \
+        getattr(obj, 'lease_token', None) == token
+
+
+def renew(obj, token, timeout, queue):
+    """Extend the lease, returns the new expiry or None if not held."""
+    if not holds(obj, token):
+        return None
+    obj.lease_expires = time.time() + timeout
+    if queue is not None:
+        queue.lease(obj, obj.lease_expires)
+    return obj.lease_expires
+
+
+def release(obj, token, status, queue):
+    """End the lease setting the runstatus, returns False if not held."""
+    if not holds(obj, token):
+        return False
+    if queue is not None:
+        queue.release(obj)
+    obj.lease_token = None
+    obj.lease_expires = None
+    obj.runstatus = status
+    obj.reindexObject(['runstatus',])
+    return True
+
+
+def reset(obj):
+    """Clear the lease and the attempts of a job being requeued."""
+    obj.lease_token = None
+    obj.lease_expires = None
+    obj.attempts = 0
+
+
+def expired(obj, now=None):
+    """return True when a running job has a lease past its expiry"""
+    expires = getattr(obj, 'lease_expires', None)
+    return expires is not None and expires < (now or time.time())
+
+
+def recover(queue, max_attempts):
+    """Requeue the running jobs whose lease expired.
+
+    Jobs that used max_attempts are marked 'failed' instead.
+
+    Returns:
+      int: number of jobs requeued
+    """
+    now = time.time()
+    requeued = 0
+    for obj in queue.expired(now):
+        if obj.runstatus != 'running':
+            queue.release(obj)
+            continue
+        if not expired(obj, now):
+            continue
+
+        obj.lease_token = None
+        obj.lease_expires = None
+        attempts = getattr(obj, 'attempts', 0)
+        if attempts >= max_attempts:
+            queue.release(obj)
+            obj.runstatus = 'failed'
+            obj.reindexObject(['runstatus',])
+            log.warn('lease of %s expired, failed after %d attempts' %
+                     (obj.absolute_url(), attempts))
+        else:
+            queue.put(obj)
+            requeued += 1
+            log.info('lease of %s expired, requeued (attempt %d)' %
+                     (obj.absolute_url(), attempts))
+    return requeued
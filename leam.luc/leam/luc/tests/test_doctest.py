@@ -19,6 +19,13 @@ def test_suite():
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE |
                 doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
 
+        # The job queue and the leases of the running jobs
+        ztc.ZopeDocFileSuite(
+            'jobqueue.txt', package='leam.luc.tests',
+            test_class=base.FunctionalTestCase,
+            optionflags=doctest.REPORT_ONLY_FIRST_FAILURE |
+                doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+
         ])
 
 if __name__ == '__main__':
@@ -33,6 +33,8 @@ from leam.taz import MessageFactory as _
 from leam.taz.settings import ISettings
 from leam.simmap.interfaces import ISimMap
 from leam.luc.interfaces import ILUCScenario, IModel
+from leam.luc import lease
+from leam.luc.jobqueue import queue_job
 
 
 # Interface class; used to define content-type schema.
@@ -105,7 +107,7 @@ def scenarioSpecified(obj, event):
     #import pdb; pdb.set_trace()
 
     if obj.scenario:
-        obj.runstatus = "queued"
+        queue_job(obj)
 
 
 class DefaultView(DisplayForm):
@@ -155,8 +157,8 @@ class requeue(View):
 
     def render(self):
         context = aq_inner(self.context)
-        context.runstatus = 'queued'
-        context.reindexObject(['runstatus',])
+        lease.reset(context)
+        queue_job(context)
 
         self.response.setHeader("Content-Type", "text/plain")
         return "requeued."
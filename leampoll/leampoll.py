@@ -6,6 +6,12 @@ and automatically started on system startup.
 """
 import os, sys, time
 import optparse
+import random
+import hashlib
+import fcntl
+import multiprocessing
+import threading
+import signal
 import shutil
 import re
 from subprocess import call, check_call, check_output
@@ -128,9 +134,211 @@ def parse_userdata():
     pass
 
 
+# seconds the processes of a job are given to exit before SIGKILL
+KILL_GRACE = 30
+
+# checkout commands that are mirrored and the option of each pinning the
+# revision or branch, any other command is checked out for every job
+MIRRORED = {
+    ('svn', 'co'): ('-r', '--revision'),
+    ('svn', 'checkout'): ('-r', '--revision'),
+    ('git', 'clone'): ('-b', '--branch'),
+    }
+
+# directory of the repository mirrors, None to check out every job (main)
+MIRRORS = None
+
+# mirrors not used for this many seconds are removed
+MIRROR_AGE = 7 * 86400
+
+# seconds between the checks for unused mirrors
+PRUNE_INTERVAL = 3600
+
+
+def parse_repo(repo):
+    """parse a repository command that can be mirrored
+
+    Only 'svn co [-r REV] URL' and 'git clone [-b BRANCH] URL' are
+    mirrored, commands with other options or a target directory are not.
+
+    Returns:
+      (tuple): vcs, url and the revision or branch (None for the latest),
+        None if the command is not mirrored
+    """
+    args = repo.split()
+    opts = MIRRORED.get(tuple(args[:2]))
+    if opts is None:
+        return None
+    if len(args) == 3:
+        return args[0], args[2], None
+    if len(args) == 5 and args[2] in opts:
+        return args[0], args[4], args[3]
+    return None
+
+
+def lock_mirror(path):
+    """Lock the lock file of a mirror and mark the mirror used.
+
+    The lock file is removed with the mirror by prune_mirrors, a lock
+    taken on a removed file is taken again on the new one.
+    """
+    while True:
+        lock = open(path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(lock.name).st_ino:
+                os.utime(lock.name, None)
+                return lock
+        except OSError:
+            pass
+        lock.close()
+
+
+def prune_mirrors(root, age=MIRROR_AGE):
+    """remove the mirrors not used for age seconds, mirrors in use by
+    another slot are skipped"""
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        if not name.endswith('.lock'):
+            continue
+        lockpath = os.path.join(root, name)
+        path = lockpath[:-len('.lock')]
+        try:
+            if time.time() - os.path.getmtime(lockpath) < age:
+                continue
+            with open(lockpath, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.fstat(lock.fileno()).st_ino != \
+                        os.stat(lockpath).st_ino or \
+                        time.time() - os.path.getmtime(lockpath) < age:
+                    continue
+                for d in (path + '.tmp', path):
+                    if os.path.exists(d):
+                        shutil.rmtree(d)
+                os.unlink(lockpath)
+            logger.info('removed mirror %s unused for %d days' %
+                        (path, age // 86400))
+        except (IOError, OSError):
+            # locked by another slot or already removed
+            continue
+
+
+class Mirror:
+    """Local mirror of a repository that run directories are copied from.
+
+    A mirror is kept for each svn or git URL, checked out once and then
+    updated in place before each job to the revision or branch of the
+    job's command (svn update -r, git fetch and checkout), so a job only
+    downloads the changes and commands pinning different revisions share
+    the mirror.  Run directories are copied with 'cp -a --reflink=auto',
+    a copy-on-write clone on filesystems that support it and a plain local
+    copy elsewhere.  Jobs write into their run directory (config.xml,
+    Data, ...) so it is never hard linked to the mirror.
+
+    A mirror that cannot be updated or copied is checked out again, a
+    branch or tag missing from the repository fails the mirror and the
+    job is checked out with its own command.
+    Concurrent slots share the mirrors, each is locked while in use.
+    """
+
+    def __init__(self, root, vcs, url, rev=None):
+        self.vcs = vcs
+        self.url = url
+        self.rev = rev
+        key = hashlib.sha1(('%s %s' % (vcs, url)).encode('utf-8'))
+        self.path = os.path.join(root, key.hexdigest()[:16])
+
+    def _run(self, cmd, cwd=None):
+        with open(os.devnull, 'wb') as FNULL:
+            check_call(cmd, cwd=cwd, stdout=FNULL, stderr=subprocess.STDOUT)
+
+    def checkout(self):
+        """check out the mirror, replacing any previous one"""
+        tmp = self.path + '.tmp'
+        for d in (tmp, self.path):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        logger.info('checking out mirror %s of %s' % (self.path, self.url))
+        if self.vcs == 'svn':
+            self._run(['svn', 'checkout', '--non-interactive', '-q',
+                       self.url, tmp])
+        else:
+            self._run(['git', 'clone', '-q', self.url, tmp])
+        os.rename(tmp, self.path)
+
+    def pin(self):
+        """update the mirror to the revision or branch of the job"""
+        if self.vcs == 'svn':
+            self._run(['svn', 'update', '--non-interactive', '-q',
+                       '-r', self.rev or 'HEAD'], cwd=self.path)
+            return
+
+        self._run(['git', 'fetch', '-q', '--prune', '--tags', 'origin'],
+                  cwd=self.path)
+        branch = self.rev
+        if branch is None:
+            head = check_output(['git', 'symbolic-ref',
+                                 'refs/remotes/origin/HEAD'], cwd=self.path)
+            branch = head.strip().split('refs/remotes/origin/', 1)[1]
+
+        # git clone -b takes a branch or else a tag, detaching the HEAD
+        if self.has_ref('refs/remotes/origin/' + branch):
+            self._run(['git', 'checkout', '-q', '-f', '-B', branch,
+                       'origin/' + branch], cwd=self.path)
+        elif self.has_ref('refs/tags/' + branch):
+            self._run(['git', 'checkout', '-q', '-f', '--detach',
+                       'refs/tags/' + branch], cwd=self.path)
+        else:
+            # not fixed by checking the mirror out again
+            raise ValueError('no branch or tag %s in %s' % (branch, self.url))
+
+    def has_ref(self, ref):
+        """return True when the mirror has the git ref"""
+        with open(os.devnull, 'wb') as FNULL:
+            return call(['git', 'show-ref', '--verify', '-q', ref],
+                        cwd=self.path, stdout=FNULL, stderr=FNULL) == 0
+
+    def update(self):
+        """update the mirror, checking it out again if the update fails"""
+        if os.path.isdir(self.path):
+            try:
+                self.pin()
+                return
+            except (subprocess.CalledProcessError, OSError) as e:
+                logger.warn('mirror %s update failed (%s)' %
+                            (self.path, str(e)))
+        self.checkout()
+        self.pin()
+
+    def copy(self, rundir):
+        """copy the mirror to a run directory"""
+        self._run(['cp', '-a', '--reflink=auto', self.path, rundir])
+
+    def materialize(self, rundir):
+        """Create a run directory from the updated mirror."""
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with lock_mirror(self.path):
+            self.update()
+            try:
+                self.copy(rundir)
+            except (subprocess.CalledProcessError, OSError) as e:
+                logger.warn('mirror %s copy failed (%s)' % (self.path, str(e)))
+                if os.path.exists(rundir):
+                    shutil.rmtree(rundir)
+                self.checkout()
+                self.pin()
+                self.copy(rundir)
+
+
 def get_repository(repo, jobid):
     """get the repository into a new directory
 
+    Plain svn and git checkouts (see parse_repo) are copied from a local
+    mirror (see Mirror) when MIRRORS is set, falling back to a checkout if
+    the mirror fails.
+
     Args:
       repo (str): command to checkout application
       jobid (str): a short name for the job
@@ -145,6 +353,20 @@ def get_repository(repo, jobid):
     if os.path.exists(rundir):
         shutil.rmtree(rundir)
 
+    mirrored = parse_repo(repo) if repo and MIRRORS else None
+    if mirrored:
+        start = time.time()
+        try:
+            Mirror(MIRRORS, *mirrored).materialize(rundir)
+            logger.debug('%s copied from mirror in %.1fs' %
+                         (rundir, time.time() - start))
+            return rundir
+        except Exception as e:
+            logger.error('mirror of %s failed, checking out: %s' %
+                         (repo, str(e)))
+            if os.path.exists(rundir):
+                shutil.rmtree(rundir)
+
     # TODO: if the repository is misconfigured git attempts to interactively
     # ask for a password. This will hang everything!
     if repo:
@@ -160,31 +382,128 @@ def get_repository(repo, jobid):
     return rundir
 
 
-def report_error(url, msg):
+def portal_auth():
+    """return the portal user and password set by main"""
+    return (os.environ.get('PORTAL_USER', ''),
+            os.environ.get('PORTAL_PASSWORD', ''))
+
+
+def post_portal(url, **data):
+    """ post to a job view of the portal
+
+    Returns:
+      (dict): JSON reply of the portal, None if the post failed
+    """
+    try:
+        r = requests.post(url, data=data, auth=portal_auth(), timeout=60)
+        r.raise_for_status()
+        return r.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error('post to %s failed: %s' % (url, str(e)))
+        return None
+
+
+def report_error(url, msg, lease=None):
     """ post error message to portal
 
     Args:
       url (str): URL of modeling entity
       msg (str): message to posted
+      lease (str): lease token granted by pop_queue
     """
 
     if not url:
         return
 
     msg = 'Error: ' + msg
+    rsp = post_portal(url, msg=msg, lease=lease or '')
+    if rsp and rsp.get('status') == 'LOST':
+        logger.warn('error not recorded, the job lease was lost')
 
 
-def report_success(url):
+def report_success(url, lease=None):
     """ post success message to portal
 
     Args:
       url (str): URL of modeling entity
-      msg (str): message to posted
+      lease (str): lease token granted by pop_queue
     """
 
     if not url:
         return
 
+    rsp = post_portal(url, lease=lease or '')
+    if rsp and rsp.get('status') == 'LOST':
+        logger.warn('success not recorded, the job lease was lost')
+
+
+class Heartbeat(threading.Thread):
+    """Renews the lease of a job from its checkout until its command ends.
+
+    The lease is renewed every third of its timeout so a missed beat
+    does not lose it.  When the portal reports the lease lost (it expired
+    and the job was requeued) the command is killed, the job is run by
+    another worker.  The command runs in its own session so its whole
+    process group (make, mpirun, GRASS, and pool workers) is sent
+    SIGTERM, then SIGKILL after the grace period.
+
+    Attributes:
+      lost (bool): True once the portal reported the lease lost
+    """
+
+    def __init__(self, url, lease, timeout, grace=None):
+        threading.Thread.__init__(self, name='heartbeat')
+        self.daemon = True
+        self.url = url
+        self.lease = lease
+        self.interval = max(float(timeout) / 3, 1.0)
+        self.grace = KILL_GRACE if grace is None else grace
+        self.proc = None
+        self.lost = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def attach(self, proc):
+        """set the command process, killed at once if the lease is lost"""
+        with self.lock:
+            self.proc = proc
+            lost = self.lost
+        if lost:
+            self.kill()
+
+    def kill(self):
+        """terminate the process group of the command"""
+        pgid = self.proc.pid
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pgid, sig)
+            except OSError:
+                return
+            deadline = time.time() + self.grace
+            while time.time() < deadline:
+                time.sleep(1)
+                try:
+                    os.killpg(pgid, 0)
+                except OSError:
+                    return
+        logger.error('processes of the job survived SIGKILL')
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            rsp = post_portal(self.url, lease=self.lease)
+            if rsp and rsp.get('status') == 'LOST':
+                logger.error('job lease lost, terminating the job')
+                with self.lock:
+                    self.lost = True
+                    proc = self.proc
+                if proc:
+                    self.kill()
+                return
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
 
 def json_response(rsp):
     """ Handle responses formatted in JSON.
@@ -198,59 +517,209 @@ def json_response(rsp):
         return
 
     logger.info("New Job = '%s'" % rsp.get('title'))
+
+    # the lease is renewed from the checkout until the command ends
+    heartbeat = None
+    if rsp.get('lease') and rsp.get('heartbeat'):
+        heartbeat = Heartbeat(rsp['heartbeat'], rsp['lease'],
+                              rsp.get('lease_timeout', 900))
+        heartbeat.start()
+
+    try:
+        runjson(rsp, heartbeat)
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+
+
+def runjson(rsp, heartbeat=None):
+    """Check out the repository and run the command of a JSON job.
+
+    Args:
+      rsp (dict): pop_queue response
+      heartbeat (Heartbeat): renewing the lease of the job (or None)
+    """
+
     on_error = rsp.get('on_error', '')
+    lease = rsp.get('lease')
 
     try:
         rundir = get_repository(rsp.get('repository', ''), rsp.get('id'))
 
     except subprocess.CalledProcessError as e:
-        report_error(on_error, 'unable to checkout repository')
+        report_error(on_error, 'unable to checkout repository', lease)
         logger.error('unable to access %s, return code = %d' % 
-                     (rsp.get('repository'), e.retcode))
+                     (rsp.get('repository'), e.returncode))
         return
 
     # less likely exceptions
     except Exception as e:
-        report_error(on_error, 'repository checkout: ' + str(e))
+        report_error(on_error, 'repository checkout: ' + str(e), lease)
         logger.error('repository checkout: ' + str(e))
         return
 
+    if heartbeat and heartbeat.lost:
+        logger.error('job lease lost during the checkout')
+        return
+
     # run command line
     cmdline = rsp.get('cmdline', '')
     if not cmdline:
-        report_error(rsp.get('on_error', 'no startup command given'))
+        report_error(on_error, 'no startup command given', lease)
         logger.error('no startup command given')
         return
 
     logger.debug('command line = ' + cmdline)
 
+    # the command runs in its own session so it can be killed as a group
     try:
         with open(rundir+'.log', 'wb') as f:
-            check_call(cmdline.split(), cwd=rundir, 
-                       stdout=f, stderr=subprocess.STDOUT)
-
-    except subprocess.CalledProcessError as e:
-        report_error(on_error, 'start-up command failed')
-        logger.error('command %s failed, return code = %d' %
-                     (cmdline, e.retcode))
-        return
+            proc = subprocess.Popen(cmdline.split(), cwd=rundir, 
+                                    stdout=f, stderr=subprocess.STDOUT,
+                                    preexec_fn=os.setsid)
+            if heartbeat:
+                heartbeat.attach(proc)
+            retcode = proc.wait()
 
     # less likely exceptions
     except Exception as e:
-        report_error(on_error, 'start-up command: ' + str(e))
+        report_error(on_error, 'start-up command: ' + str(e), lease)
         logger.error('startup command: ' + str(e))
+        return
+
+    if heartbeat and heartbeat.lost:
+        logger.error('command %s terminated, job lease lost' % cmdline)
+        return
+
+    if retcode:
+        report_error(on_error, 'start-up command failed', lease)
+        logger.error('command %s failed, return code = %d' %
+                     (cmdline, retcode))
+        return
     
-    report_success(rsp.get('on_success', ''))
+    report_success(rsp.get('on_success', ''), lease)
     logger.debug('command completed successfully')
 
 
+def available_memory():
+    """return the memory available for new processes in MB (None when
+    unknown)"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def run_slot(slot, rsp):
+    """Run a job within a slot process, logging to slot<N>.log as well."""
+    handler = logging.FileHandler('slot%d.log' % slot)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s slot' + str(slot) + ': %(levelname)s: %(message)s',
+        '%Y-%m-%d %H:%M:%S'))
+    logging.getLogger().addHandler(handler)
+    json_response(rsp)
+
+
+class Slots:
+    """Runs jobs concurrently as child processes, one per slot.
+
+    A job is only admitted when a slot is free and the cores and memory
+    budgeted for each job are available, so concurrent jobs do not
+    oversubscribe the host (GRASS imports in particular thrash the disk).
+
+    Attributes:
+      procs (list): child process of each slot or None
+      cores (int): cores budgeted for each job (0 for no limit)
+      memory (int): MB budgeted for each job (0 for no limit)
+    """
+
+    def __init__(self, count, cores=0, memory=0):
+        self.procs = [None] * count
+        self.cores = cores
+        self.memory = memory
+
+    def reap(self):
+        """release the slots of finished jobs"""
+        for i, p in enumerate(self.procs):
+            if p is not None and not p.is_alive():
+                p.join()
+                logger.info('slot %d: job %s finished, exit code = %s' %
+                            (i, p.name, p.exitcode))
+                self.procs[i] = None
+
+    def running(self):
+        """return the number of jobs running"""
+        return len([p for p in self.procs if p is not None])
+
+    def admit(self):
+        """return a free slot if another job fits the budget, else None"""
+        self.reap()
+        free = [i for i, p in enumerate(self.procs) if p is None]
+        if not free:
+            return None
+
+        running = self.running()
+        if self.cores and running and \
+                (running + 1) * self.cores > multiprocessing.cpu_count():
+            logger.debug('admission: %d jobs use the cores' % running)
+            return None
+        avail = available_memory()
+        if self.memory and running and avail is not None and \
+                avail < self.memory:
+            logger.debug('admission: %d MB available' % avail)
+            return None
+        return free[0]
+
+    def start(self, slot, rsp):
+        """run the job of a pop_queue response in a slot"""
+        p = multiprocessing.Process(target=run_slot, args=(slot, rsp),
+                                    name=str(rsp.get('id')))
+        p.start()
+        self.procs[slot] = p
+        logger.info("slot %d: started job '%s'" % (slot, rsp.get('title')))
+
+
+class Backoff:
+    """Jittered exponential backoff.
+
+    The delay doubles from base up to cap with each call, a random delay
+    between half and one and a half times it is returned so workers
+    started together do not poll the portal in step while the mean delay
+    stays the same.
+    """
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.n = 0
+
+    def delay(self):
+        """return the next delay in seconds"""
+        d = min(self.cap, self.base * 2 ** self.n)
+        if d < self.cap:
+            self.n += 1
+        return random.uniform(d / 2.0, d * 1.5)
+
+    def reset(self):
+        self.n = 0
+
+
 def main():
 
     usage = "usage: %prog [options] <Site URL>"
 
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-s', '--speed', default=20, type="int",
-        help='set the polling speed to X seconds')
+        help='set the mean wait between polls of an empty queue to '
+             'X seconds (default=20)')
+    parser.add_option('-w', '--wait', default=30, type="int",
+        help='seconds pop_queue holds a poll until a job is queued '
+             '(long-poll, the portal holds a few polls at once, '
+             '0 to disable, default=30)')
     parser.add_option('-i', '--idle', default=0, type="int",
         help='terminates server after number of empty polls (default=0)')
     parser.add_option('-q', '--popq', default='/pop_queue',
@@ -261,6 +730,24 @@ def main():
         help='Portal user name (or PORTAL_USER environmental var)')
     parser.add_option('-X', '--password', default=None,
         help='Portal password (or PORTAL_PASSWORD environmental var)')
+    parser.add_option('-c', '--cache', default=None,
+        help='local model cache shared by jobs (or LEAM_CACHE environmental var)')
+    parser.add_option('-m', '--mirror', default='mirrors',
+        help='directory of the local mirrors of svn co and git clone '
+             'repositories, run directories are copied from them, mirrors '
+             'unused for a week are removed (default=mirrors, empty to '
+             'check out every job)')
+    parser.add_option('-n', '--slots', default=1, type="int",
+        help='number of jobs run concurrently (default=1)')
+    parser.add_option('--cores', default=0, type="int",
+        help='cores budgeted for each concurrent job, also used as the '
+             'GLUC rank count unless --ranks is given (default=no limit)')
+    parser.add_option('--memory', default=0, type="int",
+        help='memory in MB that must be available to start another '
+             'concurrent job (default=no limit)')
+    parser.add_option('-r', '--ranks', default=None, type="int",
+        help='MPI ranks used by each GLUC run (default=CPUs shared by '
+             'the concurrent runs)')
     parser.add_option('-u', '--userdata', default=False, action='store_true',
         help='parse user data for authentication data')
     parser.add_option('-d', '--debug', default=False, action='store_true',
@@ -299,43 +786,90 @@ def main():
                 'Specify on the command line or environmental variables.\n')
         sys.exit(1)
 
+    # the local cache location is passed to model runs via environment
+    if options.cache:
+        os.environ['LEAM_CACHE'] = os.path.abspath(options.cache)
+
+    # run directories are copied from the repository mirrors
+    global MIRRORS
+    MIRRORS = os.path.abspath(options.mirror) if options.mirror else None
+
+    # GLUC rank count, the scenario config gluc_ranks takes precedence
+    if options.ranks:
+        os.environ['LEAM_GLUC_RANKS'] = str(options.ranks)
+    elif options.slots > 1 and options.cores:
+        os.environ['LEAM_GLUC_RANKS'] = str(options.cores)
+
+    # concurrent jobs, a single slot runs each job within the loop
+    slots = None
+    if options.slots > 1:
+        slots = Slots(options.slots, options.cores, options.memory)
+
     if len(args) != 1:
         logger.error('the URL to the Plone site is required')
         sys.exit(1)
 
     url = args[0]
     popq = url+options.popq
+    params = dict(wait=options.wait) if options.wait else {}
     logger.info('polling started on ' + url)
 
+    # waits after empty polls, jittered around --speed so idle workers do
+    # not poll more often than before, and after errors, reset by a
+    # successful poll
+    idle = Backoff(options.speed, options.speed)
+    failing = Backoff(options.speed, 600)
+    pruned = 0
+
     # primary loop
     while True:
+
+        # mirrors of repositories no longer used are removed
+        if MIRRORS and time.time() - pruned > PRUNE_INTERVAL:
+            prune_mirrors(MIRRORS)
+            pruned = time.time()
+
+        # the queue is only popped when another job can be admitted
+        slot = slots.admit() if slots else None
+        if slots and slot is None:
+            time.sleep(1)
+            continue
+
         try:
             logger.debug('Popping the Queue')
-            r = requests.get(popq, auth=(user, password))
+            r = requests.get(popq, params=params, auth=(user, password),
+                             timeout=options.wait + 60)
             r.raise_for_status()
 
         except requests.exceptions.ConnectionError:
             logger.error("Connection Error")
-            time.sleep(60)
+            time.sleep(failing.delay())
             continue
 
         except requests.exceptions.Timeout:
             logger.error("Connection Timeout")
-            time.sleep(60)
+            time.sleep(failing.delay())
             continue
 
         except requests.exceptions.HTTPError:
             logger.error("HTTP status error code = " + str(r.status_code))
-            time.sleep(600)
+            time.sleep(failing.delay())
             continue
 
+        failing.reset()
+        found = False
         logger.debug('content-type: ' + r.headers['content-type'])
 
         if r.headers['content-type'].startswith('application/xml'):
             xml_response(r)
 
         elif r.headers['content-type'].startswith('application/json'):
-            json_response(r.json())
+            rsp = r.json()
+            found = rsp.get('status', '') != 'EMPTY'
+            if slots and found:
+                slots.start(slot, rsp)
+            else:
+                json_response(rsp)
 
         # probably an error message
         elif r.header['content-type'].startswith('text/html'):
@@ -347,7 +881,12 @@ def main():
             logger.error("popqueue returned unknown content-type '%s'",
                     r.headers['content-type'])
 
-        time.sleep(options.speed)
+        # poll again at once after a job, empty polls wait about --speed
+        # on top of the long-poll wait
+        if found:
+            idle.reset()
+        else:
+            time.sleep(idle.delay())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+"""
+Moving window filters of GRASS layers computed with NumPy.
+
+neighbor_att runs r.mfilter with a 29x29 weighted kernel and publish.sh
+runs r.neighbors sums over an 11 cell circle, both visit every cell of
+the window for every cell of the region.  The filters here compute the
+same results with:
+
+  - a separable pair of 1-D passes when the kernel has rank one
+  - an FFT of each block otherwise
+  - running sums along the rows (a summed-area table for square
+    windows) when every weight of the window is 1
+
+The region is processed in blocks of rows read with enough rows above
+and below (the halo) to cover the window, so memory is bounded by the
+block size rather than the region.
+
+Semantics follow GRASS 6.4:
+
+  r.mfilter (raster/r.mfilter/apply.c, execute.c): the window is
+    centred on each cell (filter TYPE P).  With a DIVISOR the result is
+    null when any cell of the window is null, otherwise the sum divided
+    by DIVISOR.  With DIVISOR 0 null cells contribute nothing, the sum
+    is divided by the weights of the non-null cells and the result is
+    null when they sum to 0, as when every cell of the window is null.
+    The cells within half a window of the region edge are copied from
+    the input unchanged.
+  r.neighbors method=sum: null cells and cells outside the region are
+    ignored, the result is null when no cell of the window is non-null,
+    and -c restricts the window to the cells within size/2 cells of the
+    centre.
+
+test_convolve.py checks these semantics against direct window sums,
+'convolve.py compare' against r.mfilter and r.neighbors within GRASS.
+
+Usage:
+  convolve.py mfilter input output filter
+  convolve.py sum [-c] [-s size] input output
+  convolve.py compare [options]
+"""
+import sys
+import math
+from optparse import OptionParser
+
+import numpy
+
+import gridio
+
+
+def read_filter(fname):
+    """Read an r.mfilter filter file.
+
+    Returns:
+      (numpy.ndarray, float): kernel and divisor (0 for the sum of the
+        weights of the non-null cells)
+    """
+    kernel, divisor = None, 0.0
+    with open(fname) as f:
+        lines = [l.split() for l in f if l.strip()]
+
+    i = 0
+    while i < len(lines):
+        key = lines[i][0].upper()
+        if key == 'MATRIX':
+            n = int(lines[i][1])
+            kernel = numpy.array([[float(v) for v in l]
+                                  for l in lines[i+1:i+1+n]])
+            if kernel.shape != (n, n):
+                raise ValueError('%s: bad MATRIX' % fname)
+            i += n
+        elif key == 'DIVISOR':
+            divisor = float(lines[i][1])
+        elif key == 'TYPE' and lines[i][1].upper() != 'P':
+            raise ValueError('%s: only parallel (TYPE P) filters are '
+                             'supported' % fname)
+        i += 1
+
+    if kernel is None:
+        raise ValueError('%s: no MATRIX' % fname)
+    return kernel, divisor
+
+
+def circle(size):
+    """return the r.neighbors -c window of a size"""
+    d = size // 2
+    r, c = numpy.mgrid[:size, :size]
+    return ((r - d) ** 2 + (c - d) ** 2 <= d * d).astype(numpy.float64)
+
+
+def _fast(n):
+    """return the smallest n' >= n with no prime factors above 5"""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def _separate(kernel):
+    """return the column and row vectors of a rank one kernel, or None"""
+    u, s, vt = numpy.linalg.svd(kernel)
+    if s[0] == 0 or (len(s) > 1 and s[1] > s[0] * 1e-12):
+        return None
+    col, row = u[:, 0] * math.sqrt(s[0]), vt[0] * math.sqrt(s[0])
+    if not numpy.allclose(numpy.outer(col, row), kernel, rtol=0,
+                          atol=1e-12 * abs(kernel).max()):
+        return None
+    return col, row
+
+
+def _runsum(data, weights):
+    """window sums of a 0/1 window using running sums along the rows"""
+    k = weights.shape[0]
+    nrows, ncols = data.shape[0] - k + 1, data.shape[1] - k + 1
+    if weights.all():
+        # summed-area table
+        sat = numpy.zeros((data.shape[0] + 1, data.shape[1] + 1))
+        numpy.cumsum(numpy.cumsum(data, axis=0), axis=1, out=sat[1:, 1:])
+        return sat[k:, k:] - sat[:-k, k:] - sat[k:, :-k] + sat[:-k, :-k]
+
+    cum = numpy.zeros((data.shape[0], data.shape[1] + 1))
+    numpy.cumsum(data, axis=1, out=cum[:, 1:])
+    out = numpy.zeros((nrows, ncols))
+    for i in range(k):
+        cols = numpy.flatnonzero(weights[i])
+        if not len(cols):
+            continue
+        if cols[-1] - cols[0] + 1 != len(cols):
+            # a row with gaps, sum each column of the window
+            for j in cols:
+                out += data[i:i + nrows, j:j + ncols]
+            continue
+        a, b = cols[0], cols[-1] + 1
+        out += cum[i:i + nrows, b:b + ncols] - cum[i:i + nrows, a:a + ncols]
+    return out
+
+
+def correlate(data, kernel):
+    """Apply a kernel to each cell of a block.
+
+    Args:
+      data (array): block of values, zero where nothing contributes,
+        including the half window around the cells to be computed
+      kernel (array): square window of weights (odd size)
+
+    Returns:
+      numpy.ndarray: sum of weight times value over the window centred
+        on each cell, (rows - size + 1, cols - size + 1)
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    kernel = numpy.asarray(kernel, dtype=numpy.float64)
+    k = kernel.shape[0]
+    nrows, ncols = data.shape[0] - k + 1, data.shape[1] - k + 1
+
+    if numpy.all((kernel == 0) | (kernel == 1)):
+        out = _runsum(data, kernel)
+    else:
+        pair = _separate(kernel)
+        if pair:
+            col, row = pair
+            tmp = numpy.zeros((data.shape[0], ncols))
+            for j in range(k):
+                tmp += row[j] * data[:, j:j + ncols]
+            out = numpy.zeros((nrows, ncols))
+            for i in range(k):
+                out += col[i] * tmp[i:i + nrows]
+        else:
+            shape = (_fast(data.shape[0]), _fast(data.shape[1]))
+            f = numpy.fft.rfft2(data, shape)
+            f *= numpy.fft.rfft2(kernel[::-1, ::-1], shape)
+            out = numpy.fft.irfft2(f, shape)[k - 1:k - 1 + nrows,
+                                              k - 1:k - 1 + ncols]
+
+    # sums of integer weights and values are integers, remove the FFT noise
+    if numpy.all(kernel == numpy.round(kernel)) and \
+            numpy.all(data == numpy.round(data)):
+        out = numpy.round(out)
+    return out
+
+
+def _blocks(nrows, rows, halo):
+    """yield (first, last) rows of each block and the rows read for it"""
+    for r in xrange(0, nrows, rows):
+        last = min(r + rows, nrows)
+        yield r, last, max(r - halo, 0), min(last + halo, nrows)
+
+
+def _window(block, first, last, lo, hi, halo):
+    """pad a block read for rows first..last to the full halo"""
+    top = halo - (first - lo)
+    bottom = halo - (hi - last)
+    return numpy.pad(block, ((top, bottom), (halo, halo)), 'constant')
+
+
+def filter_array(src, kernel, divisor=0.0, rows=512, out=None,
+                 null=gridio.NULL):
+    """Apply a weighted kernel to an array as r.mfilter.
+
+    Args:
+      src (array): values, null cells hold <null>
+      kernel (array): square window of weights (odd size)
+      divisor (float): the sums are divided by divisor, 0 for the
+        weights of the non-null cells in the window
+      rows (int): number of rows processed at a time
+      out (array): float64 array receiving the result (default new)
+      null (float): sentinel of the null cells
+
+    Returns:
+      numpy.ndarray: out, null cells hold <null>
+    """
+    kernel = numpy.asarray(kernel, dtype=numpy.float64)
+    halo = kernel.shape[0] // 2
+    window = numpy.ones(kernel.shape)
+    nrows, ncols = src.shape
+    if out is None:
+        out = numpy.empty(src.shape, dtype=numpy.float64)
+
+    for first, last, lo, hi in _blocks(nrows, rows, halo):
+        block = numpy.asarray(src[lo:hi], dtype=numpy.float64)
+        valid = block != null
+        v = correlate(_window(numpy.where(valid, block, 0.0), first, last,
+                              lo, hi, halo), kernel)
+        if divisor:
+            # any null cell of the window, whatever its weight
+            n = correlate(_window((~valid).astype(numpy.float64), first,
+                                  last, lo, hi, halo), window)
+            v = numpy.where(n == 0, v / divisor, null)
+        else:
+            w = correlate(_window(valid.astype(numpy.float64), first, last,
+                                  lo, hi, halo), kernel)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                v = numpy.where(w != 0, v / numpy.where(w != 0, w, 1.0),
+                                null)
+        out[first:last] = v
+
+    # cells within half a window of the edge are copied unchanged
+    if halo:
+        out[:halo] = src[:halo]
+        out[-halo:] = src[-halo:]
+        out[:, :halo] = src[:, :halo]
+        out[:, -halo:] = src[:, -halo:]
+    return out
+
+
+def sum_array(src, weights, rows=512, out=None, null=gridio.NULL):
+    """Sum an array over a moving window as r.neighbors method=sum.
+
+    Args:
+      src (array): values, null cells hold <null>
+      weights (array): 0/1 window (odd size), see circle
+      rows (int): number of rows processed at a time
+      out (array): float64 array receiving the result (default new)
+      null (float): sentinel of the null cells
+
+    Returns:
+      numpy.ndarray: out, null cells hold <null>
+    """
+    halo = weights.shape[0] // 2
+    nrows, ncols = src.shape
+    if out is None:
+        out = numpy.empty(src.shape, dtype=numpy.float64)
+
+    for first, last, lo, hi in _blocks(nrows, rows, halo):
+        block = numpy.asarray(src[lo:hi], dtype=numpy.float64)
+        valid = block != null
+        v = correlate(_window(numpy.where(valid, block, 0.0), first, last,
+                              lo, hi, halo), weights)
+        n = correlate(_window(valid.astype(numpy.float64), first, last,
+                              lo, hi, halo), weights)
+        out[first:last] = numpy.where(n > 0, v, null)
+    return out
+
+
+def mfilter(inlayer, outlayer, kernel, divisor=0.0, rows=512):
+    """Apply a weighted kernel to a layer as r.mfilter.
+
+    Args:
+      inlayer (str): input GRASS layer
+      outlayer (str): output GRASS layer (DCELL)
+      kernel (array): square window of weights (odd size)
+      divisor (float): the sums are divided by divisor, 0 for the
+        weights of the non-null cells in the window
+      rows (int): number of rows processed at a time
+    """
+    src = gridio.load(inlayer, dtype=numpy.float64)
+    out = filter_array(src, kernel, divisor, rows,
+                       out=gridio.empty(dtype=numpy.float64))
+    gridio.write(outlayer, out)
+
+
+def neighbors_sum(inlayer, outlayer, size=3, circular=False, rows=512):
+    """Sum a layer over a moving window as r.neighbors method=sum.
+
+    Args:
+      inlayer (str): input GRASS layer
+      outlayer (str): output GRASS layer (DCELL)
+      size (int): window size in cells (odd)
+      circular (bool): use the circular window (r.neighbors -c)
+      rows (int): number of rows processed at a time
+    """
+    if size % 2 == 0:
+        raise ValueError('window size must be odd')
+    weights = circle(size) if circular else numpy.ones((size, size))
+    src = gridio.load(inlayer, dtype=numpy.float64)
+    out = sum_array(src, weights, rows,
+                    out=gridio.empty(dtype=numpy.float64))
+    gridio.write(outlayer, out)
+
+
+def compare(rows=200, cols=300, seed=1, size=11, fname=None, keep=False):
+    """Compare the filters with r.mfilter and r.neighbors.
+
+    A random layer with null cells is written to GRASS in a temporary
+    region, filtered by r.mfilter (with <fname>, or a random 7x7 kernel
+    with DIVISOR 0 and with DIVISOR 1) and summed by r.neighbors -c,
+    and each output is compared with the in memory result.
+
+    Returns:
+      list: (name, cells differing in null-ness, largest absolute
+        difference of the cells non-null in both)
+    """
+    import grass.script as grass
+
+    rnd = numpy.random.RandomState(seed)
+    src = numpy.round(rnd.uniform(0.0, 3.0, (rows, cols)))
+    src[rnd.uniform(size=src.shape) < 0.01] = gridio.NULL
+
+    filters = []
+    if fname:
+        filters.append(('file',) + read_filter(fname) + (fname,))
+    else:
+        kernel = numpy.round(rnd.uniform(0.0, 5.0, (7, 7)))
+        for divisor in (0.0, 1.0):
+            name = '/tmp/convolve_cmp_%d' % divisor
+            with open(name, 'w') as f:
+                f.write('TITLE compare\nMATRIX 7\n')
+                for row in kernel:
+                    f.write(' '.join('%d' % v for v in row) + '\n')
+                f.write('DIVISOR %d\nTYPE P\n' % divisor)
+            filters.append(('divisor%d' % divisor, kernel, divisor, name))
+
+    layers = ['convolve_cmp_in', 'convolve_cmp_sum']
+    results = []
+    grass.use_temp_region()
+    try:
+        grass.run_command('g.region', n=rows * 30, s=0, e=cols * 30, w=0,
+                          res=30)
+        gridio.write(layers[0], numpy.ma.masked_equal(src, gridio.NULL))
+
+        for name, kernel, divisor, filterfile in filters:
+            layer = 'convolve_cmp_' + name
+            layers.append(layer)
+            if grass.run_command('r.mfilter', input=layers[0],
+                    output=layer, filter=filterfile, overwrite=True,
+                    quiet=True):
+                raise RuntimeError('r.mfilter failed')
+            results.append((name, filter_array(src, kernel, divisor),
+                            gridio.load(layer, dtype=numpy.float64)))
+
+        if grass.run_command('r.neighbors', flags='c', input=layers[0],
+                output=layers[1], method='sum', size=size,
+                overwrite=True, quiet=True):
+            raise RuntimeError('r.neighbors failed')
+        results.append(('sum', sum_array(src, circle(size)),
+                        gridio.load(layers[1], dtype=numpy.float64)))
+    finally:
+        if not keep:
+            grass.run_command('g.remove', quiet=True, rast=','.join(layers))
+        grass.del_temp_region()
+
+    report = []
+    for name, result, expected in results:
+        a, b = result == gridio.NULL, expected == gridio.NULL
+        both = ~a & ~b
+        diff = numpy.abs(result[both] - expected[both])
+        report.append((name, int((a != b).sum()),
+                       float(diff.max()) if len(diff) else 0.0))
+    return report
+
+
+def main():
+    usage = 'usage: %prog mfilter input output filter\n' \
+            '       %prog sum [-c] [-s size] input output\n' \
+            '       %prog compare [-s size] [-f filter] [-k]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--size', type='int', default=None,
+        help='neighborhood size of the sum (default=3, compare 11)')
+    parser.add_option('-c', '--circle', default=False, action='store_true',
+        help='use a circular neighborhood for the sum')
+    parser.add_option('-r', '--rows', type='int', default=512,
+        help='rows processed at a time (default=512)')
+    parser.add_option('-f', '--filter', default=None,
+        help='filter file compared with r.mfilter (default=random 7x7)')
+    parser.add_option('-k', '--keep', default=False, action='store_true',
+        help='keep the convolve_cmp_* layers')
+    (opts, args) = parser.parse_args()
+
+    if args[:1] == ['mfilter'] and len(args) == 4:
+        kernel, divisor = read_filter(args[3])
+        mfilter(args[1], args[2], kernel, divisor, rows=opts.rows)
+    elif args[:1] == ['sum'] and len(args) == 3:
+        neighbors_sum(args[1], args[2], opts.size or 3, opts.circle,
+                      rows=opts.rows)
+    elif args == ['compare']:
+        report = compare(size=opts.size or 11,
+                         fname=opts.filter, keep=opts.keep)
+        failed = False
+        for name, nulls, diff in report:
+            print '%-10s null mismatches: %d  max difference: %g' % \
+                (name, nulls, diff)
+            failed = failed or nulls or diff > 1e-6
+        sys.exit(1 if failed else 0)
+    else:
+        parser.error('unknown command')
+
+
+if __name__ == '__main__':
+    main()
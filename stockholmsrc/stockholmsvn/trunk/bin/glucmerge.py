@@ -0,0 +1,146 @@
+"""
+Streamed post-run processing of GLUC outputs.
+
+After each model run gluc.make imports change.bil and summary.bil,
+derives the <projid>_ppcell, _hhcell, _empcell, and _year layers and
+merges everything into the cumulative result layers with a dozen
+r.mapcalc calls, each re-reading full region rasters.  merge performs
+the same derivations and merge in a single pass over blocks of rows,
+reading the GLUC outputs directly from the BIL files and each
+cumulative layer once, and writing each result once.
+
+The semantics follow the gluc.make 'growth', 'decline', and 'merge'
+targets, including the propagation of nulls by r.mapcalc.
+
+A projection run on a window of the region (see bil.crop) is pasted
+back at the window's offset, the cumulative layers outside the window
+are left unchanged.
+"""
+import os
+import numpy
+
+import bil
+import gridio
+
+
+# cumulative result layers and the type used to process them
+LAYERS = [
+    ('change', numpy.int32),
+    ('summary', numpy.int32),
+    ('ppcell', numpy.float64),
+    ('hhcell', numpy.float64),
+    ('empcell', numpy.float64),
+    ('year', numpy.int32),
+    ]
+
+# residents per household used by gluc.make for hhcell
+HOUSEHOLD = 2.6
+
+
+def derive(change, summary, popden, empden, mode, start):
+    """Compute the projection layers for a block of rows.
+
+    Each argument is a tuple of values and a valid (not null) mask.
+
+    Args:
+      change (tuple): GLUC change map
+      summary (tuple): GLUC summary map (years after start)
+      popden (tuple): population density
+      empden (tuple): employment density
+      mode (str): gluc.make mode, densities are negated for 'decline'
+      start (int): start year of the run
+
+    Returns:
+      dict: layer name -> (values, null mask)
+    """
+    sign = -1.0 if mode == 'decline' else 1.0
+    change, cvalid = change
+    summary, svalid = summary
+
+    res = change == 21
+    ppcell = numpy.where(res, sign * popden[0], 0.0)
+    ppnull = ~cvalid | (res & ~popden[1])
+
+    com = change == 23
+    empcell = numpy.where(com, sign * empden[0], 0.0)
+    empnull = ~cvalid | (com & ~empden[1])
+
+    year = numpy.where(summary > 0, summary.astype(numpy.int32) + start, 0)
+
+    return dict(
+        change = (change, ~cvalid),
+        summary = (summary, ~svalid),
+        ppcell = (ppcell, ppnull),
+        hhcell = (ppcell / HOUSEHOLD, ppnull),
+        empcell = (empcell, empnull),
+        year = (year, ~svalid),
+        )
+
+
+def merge(projid, mode, start, path='.', rows=256, keep=False,
+          window=None):
+    """Derive the results of a GLUC run and merge them into the
+    cumulative change, summary, ppcell, hhcell, empcell, and year layers.
+
+    Equivalent to 'gluc.make <mode> merge'.  Cells with a non-zero
+    projection value replace the cumulative value, nulls are propagated.
+
+    Args:
+      projid (str): projection identifier
+      mode (str): gluc.make mode (growth, decline)
+      start (int): start year of the run
+      path (str): directory containing the gluc tree used for the run
+      rows (int): number of rows processed at a time
+      keep (bool): also write the <projid>_<layer> projection layers
+      window (tuple): first row, last row + 1, first column, and last
+        column + 1 of the region covered by the GLUC outputs (default=
+        the whole region)
+
+    Returns:
+      None
+    """
+    start = int(start)
+    mapdir = os.path.join(path, 'gluc', 'DriverOutput', 'Maps')
+    datadir = os.path.join(path, 'gluc', 'Data')
+
+    inputs = []
+    for fname in (os.path.join(mapdir, 'change.bil'),
+                  os.path.join(mapdir, 'summary.bil'),
+                  os.path.join(datadir, 'pop_density.bil'),
+                  os.path.join(datadir, 'emp_density.bil')):
+        inputs.append((bil.open_bil(fname), bil.read_header(fname)))
+    change = inputs[0][0]
+
+    cumulative = {}
+    projection = {}
+    for name, dtype in LAYERS:
+        cumulative[name] = gridio.load(name, dtype=dtype)
+        shape = cumulative[name].shape
+        r0, r1, c0, c1 = window or (0, shape[0], 0, shape[1])
+        if (r1 - r0, c1 - c0) != change.shape or r1 > shape[0] or \
+                c1 > shape[1]:
+            raise RuntimeError('%s: GLUC output %s does not match region %s'
+                % (projid, str(change.shape), str((r1 - r0, c1 - c0))))
+        if keep:
+            # GLUC outputs are 0 outside of the projection boundary
+            projection[name] = gridio.empty(dtype=dtype)
+            projection[name][...] = 0
+
+    for r in xrange(0, change.shape[0], rows):
+        blk = slice(r, r + rows)
+        dest = (slice(r0 + r, min(r0 + r + rows, r1)), slice(c0, c1))
+        args = [(a[blk], bil.valid(a[blk], hdr)) for a, hdr in inputs]
+        derived = derive(*(args + [mode, start]))
+
+        for name, dtype in LAYERS:
+            vals, null = derived[name]
+            cum = cumulative[name][dest]
+            if keep:
+                projection[name][dest] = numpy.where(null, gridio.NULL, vals)
+            cumulative[name][dest] = numpy.where(null, gridio.NULL,
+                numpy.where(vals != 0, vals, cum))
+
+    for name, dtype in LAYERS:
+        gridio.write(name, cumulative[name])
+        if keep:
+            gridio.write('%s_%s' % (projid, name), projection[name])
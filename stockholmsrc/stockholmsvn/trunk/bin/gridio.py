@@ -0,0 +1,84 @@
+"""
+Utilities for moving GRASS raster layers in and out of NumPy arrays.
+
+The arrays are sized to the current GRASS region and are backed by the
+memory-mapped temporary files created by grass.script.array, so large
+regional layers are paged in on demand rather than held in memory.
+
+Null cells are written out using the NULL sentinel and returned as the
+mask of a numpy masked array.  This preserves the r.mapcalc/r.univar
+convention where any expression touching a null cell is ignored.
+
+NOTE: grass.script can only be imported once GISBASE is set so the import
+is deferred until the first read or write.
+"""
+import numpy
+
+
+NULL = -9999
+
+
+def _garray():
+    """return the grass.script.array module"""
+    from grass.script import array as garray
+    return garray
+
+
+def read(layer, dtype=numpy.float32, null=NULL):
+    """Read a GRASS raster layer into a masked array.
+
+    Args:
+      layer (str): GRASS raster layer
+      dtype (numpy.dtype): type of the returned array
+      null (int): sentinel used to identify null cells
+
+    Returns:
+      numpy.ma.MaskedArray: layer values with null cells masked
+    """
+    a = _garray().array(dtype=dtype)
+    if a.read(layer, null=null):
+        raise RuntimeError('unable to read raster layer ' + layer)
+
+    return numpy.ma.masked_equal(a, null, copy=False)
+
+
+def load(layer, dtype=numpy.float32, null=NULL):
+    """Read a GRASS raster layer without masking.
+
+    Null cells hold the <null> sentinel.  The memory-mapped array can be
+    modified in place, a block of rows at a time, and passed to write.
+
+    Returns:
+      grass.script.array.array: layer values sized to the current region
+    """
+    a = _garray().array(dtype=dtype)
+    if a.read(layer, null=null):
+        raise RuntimeError('unable to read raster layer ' + layer)
+
+    return a
+
+
+def empty(dtype=numpy.float32):
+    """return an uninitialized memory-mapped array sized to the region"""
+    return _garray().array(dtype=dtype)
+
+
+def write(layer, data, null=NULL):
+    """Write an array (masked or not) to a GRASS raster layer.
+
+    Masked cells are written as GRASS nulls.  Arrays returned by load or
+    empty are written directly without a copy.
+
+    Args:
+      layer (str): GRASS raster layer to be created or replaced
+      data (array): values sized to the current region
+      null (int): sentinel used to identify null cells
+    """
+    garray = _garray()
+    if isinstance(data, garray.array):
+        a = data
+    else:
+        a = garray.array(dtype=data.dtype)
+        a[...] = numpy.ma.filled(data, null)
+    if a.write(layer, null=null, overwrite=True):
+        raise RuntimeError('unable to write raster layer ' + layer)
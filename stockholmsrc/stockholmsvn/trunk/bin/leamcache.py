@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+A local content-addressed cache shared by the model runs on a host.
+
+Entries are directories of files stored under a key computed from the
+content of everything used to produce them (see Hasher) so a changed
+input always results in a miss rather than a stale hit.  The cache
+lives in $LEAM_CACHE (default ~/.leam/cache) and is shared by every run
+directory created by leampoll.  The least recently used entries are
+evicted once the cache grows beyond $LEAM_CACHE_SIZE megabytes.
+
+Usage:
+  leamcache.py [stats|evict|clear]
+"""
+import os
+import sys
+import errno
+import fcntl
+import hashlib
+import json
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+CACHE_ROOT = os.path.join('~', '.leam', 'cache')
+CACHE_SIZE = 20 * 1024   # megabytes
+
+
+class Hasher:
+    """Accumulates the inputs of a cache entry into a single key.
+
+    Each part is tagged with a name so reordering or moving content
+    between parts changes the key.
+    """
+
+    def __init__(self, kind):
+        self.h = hashlib.sha1()
+        self.update('kind', kind)
+
+    def update(self, name, data):
+        """add a named string to the key"""
+        if data is None:
+            data = ''
+        elif isinstance(data, unicode):
+            data = data.encode('utf-8')
+        elif not isinstance(data, str):
+            data = str(data)
+        self.h.update('%s:%d:' % (name, len(data)))
+        self.h.update(data)
+
+    def update_file(self, fname, name=None, blocksize=1024*1024):
+        """add the content of a file to the key (missing files are empty)"""
+        name = name or os.path.basename(fname)
+        h = hashlib.sha1()
+        if os.path.exists(fname):
+            with open(fname, 'rb') as f:
+                for block in iter(lambda: f.read(blocksize), ''):
+                    h.update(block)
+        self.update(name, h.hexdigest())
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+
+class Cache:
+    """A directory based cache with LRU eviction.
+
+    Attributes:
+      root (str): cache directory
+      maxsize (int): size limit in bytes
+    """
+
+    def __init__(self, root=None, maxsize=None):
+        root = root or os.environ.get('LEAM_CACHE', '') or CACHE_ROOT
+        self.root = os.path.abspath(os.path.expanduser(root))
+        if maxsize is None:
+            maxsize = int(os.environ.get('LEAM_CACHE_SIZE', CACHE_SIZE))
+        self.maxsize = maxsize * 1024 * 1024
+
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    @contextmanager
+    def _lock(self):
+        """exclusive lock on the cache shared between processes"""
+        with open(os.path.join(self.root, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _count(self, stat):
+        """increment one of the hit/miss counters"""
+        fname = os.path.join(self.root, 'stats.json')
+        with self._lock():
+            try:
+                with open(fname) as f:
+                    stats = json.load(f)
+            except (IOError, ValueError):
+                stats = {}
+            stats[stat] = stats.get(stat, 0) + 1
+            with open(fname, 'w') as f:
+                json.dump(stats, f)
+
+    def get(self, key, dest='.'):
+        """Retrieve the files stored under key.
+
+        Files are hard linked into <dest> when possible and copied
+        otherwise.
+
+        Returns:
+          list: names of the files retrieved or None on a miss
+        """
+        path = self._path(key)
+        if not os.path.isdir(path):
+            self._count('misses')
+            return None
+
+        fnames = []
+        for fname in sorted(os.listdir(path)):
+            target = os.path.join(dest, fname)
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(os.path.join(path, fname), target)
+            except OSError:
+                shutil.copy(os.path.join(path, fname), target)
+            fnames.append(fname)
+
+        # the directory mtime tracks use for LRU eviction
+        os.utime(path, None)
+        self._count('hits')
+        return fnames
+
+    def put(self, key, fnames):
+        """Store a list of files under key and evict old entries.
+
+        The entry is assembled in a temporary directory and renamed into
+        place so a partially written entry is never visible.
+        """
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.root)
+        try:
+            for fname in fnames:
+                shutil.copy(fname, os.path.join(tmp, os.path.basename(fname)))
+            with self._lock():
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.rename(tmp, path)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+        self._count('puts')
+        self.evict()
+
+    def entries(self):
+        """return list of (mtime, size, path) for every entry"""
+        entries = []
+        for d in os.listdir(self.root):
+            if len(d) != 2 or not os.path.isdir(os.path.join(self.root, d)):
+                continue
+            for key in os.listdir(os.path.join(self.root, d)):
+                path = os.path.join(self.root, d, key)
+                size = sum(os.path.getsize(os.path.join(path, f))
+                           for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+        return entries
+
+    def evict(self, maxsize=None):
+        """remove least recently used entries until under maxsize bytes"""
+        if maxsize is None:
+            maxsize = self.maxsize
+
+        removed = 0
+        with self._lock():
+            entries = sorted(self.entries())
+            total = sum(e[1] for e in entries)
+            for mtime, size, path in entries:
+                if total <= maxsize:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                removed += 1
+
+        return removed
+
+    def clear(self):
+        """remove every entry and reset the statistics"""
+        self.evict(maxsize=0)
+        fname = os.path.join(self.root, 'stats.json')
+        if os.path.exists(fname):
+            os.remove(fname)
+
+    def stats(self):
+        """return dict of cache statistics"""
+        try:
+            with open(os.path.join(self.root, 'stats.json')) as f:
+                stats = json.load(f)
+        except (IOError, ValueError):
+            stats = {}
+
+        entries = self.entries()
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        return dict(
+            root = self.root,
+            entries = len(entries),
+            size = sum(e[1] for e in entries),
+            maxsize = self.maxsize,
+            hits = hits,
+            misses = misses,
+            puts = stats.get('puts', 0),
+            hitrate = float(hits) / (hits + misses) if hits + misses else 0.0,
+            oldest = time.ctime(min(e[0] for e in entries)) if entries else '',
+            )
+
+
+def main():
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    cache = Cache()
+
+    if cmd == 'stats':
+        s = cache.stats()
+        print 'cache:    %s' % s['root']
+        print 'entries:  %d' % s['entries']
+        print 'size:     %.1f MB of %.1f MB' % (s['size'] / 1048576.0,
+                                               s['maxsize'] / 1048576.0)
+        print 'hits:     %d' % s['hits']
+        print 'misses:   %d' % s['misses']
+        print 'hit rate: %.1f%%' % (100.0 * s['hitrate'])
+        print 'oldest:   %s' % s['oldest']
+
+    elif cmd == 'evict':
+        print 'removed %d entries' % cache.evict()
+
+    elif cmd == 'clear':
+        cache.clear()
+
+    else:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Dependency aware parallel build of the GRASS makefiles.
+
+attmaps.make and probmaps.make name GRASS layers rather than files so
+'make -j' cannot be used: every rule writes into the current mapset and
+several share scratch layers (mask, empX, tmp1, and the tt/ctmp layers
+of cities.py) and the region.  The scheduler reads the rules from the
+makefile and runs each target as soon as its prerequisites are built,
+executing 'make -o <prereq>... <target>' so make only runs the recipe of
+that target.
+
+Each target runs in its own TempMapset (see mapsets.py) with a copy of
+the region and the model mapset on the search path.  When the target
+completes the layers it created are moved into the model mapset, in
+completion order, so scratch layers never collide and later targets see
+the results exactly as they would after a serial make.
+
+Recipes changing a layer built by another target (r.null on a
+prerequisite) cannot run isolated, GRASS only modifies layers of the
+current mapset.  Such targets are listed as prerequisites of the special
+target .INPLACE, make ignores it, and run alone in the model mapset once
+the targets running have completed.
+
+Usage:
+  makesched.py [-j jobs] [-l log] makefile [target ...]
+"""
+import os
+import re
+import sys
+import time
+import Queue
+import subprocess
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from mapsets import TempMapset
+
+
+def _lines(fname):
+    """return the lines of a makefile with continuations joined"""
+    lines, buf = [], ''
+    with open(fname) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.endswith('\\'):
+                buf += line[:-1] + ' '
+                continue
+            lines.append(buf + line)
+            buf = ''
+    if buf:
+        lines.append(buf)
+    return lines
+
+
+def _expand(s, variables, depth=0):
+    """expand ${VAR} and $(VAR) references to simple variables"""
+    if depth > 10:
+        return s
+    def repl(m):
+        return _expand(variables.get(m.group(1) or m.group(2), ''),
+                       variables, depth + 1)
+    return re.sub(r'\$\{(\w+)\}|\$\((\w+)\)', repl, s)
+
+
+def read_variables(fname):
+    """return the simple variable assignments of a makefile, expanded"""
+    variables = {}
+    for line in _lines(fname):
+        m = re.match(r'^\s*(\w+)\s*[:?+]?=\s*(.*)$', line)
+        if m and not line.startswith('\t'):
+            variables[m.group(1)] = m.group(2).strip()
+    return dict((k, _expand(v, variables)) for k, v in variables.items())
+
+
+def parse_makefile(fname):
+    """Read the explicit rules of a makefile.
+
+    Only the subset of make syntax used by the model makefiles is
+    supported: simple variable assignments and explicit rules.  Special
+    targets (starting with '.') are not rules, the prerequisites of
+    .INPLACE are returned as the targets run in the model mapset.
+
+    Returns:
+      (list, dict, set, set): targets in the order defined, target -> list
+        of prerequisites, the targets with a recipe, and the targets run
+        in place
+    """
+    variables, rules, order, recipes, inplace = {}, {}, [], set(), set()
+    current = []
+    for line in _lines(fname):
+        if line.startswith('\t'):
+            if line.strip():
+                recipes.update(current)
+            continue
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+
+        m = re.match(r'^\s*(\w+)\s*[:?+]?=\s*(.*)$', line)
+        if m:
+            variables[m.group(1)] = m.group(2).strip()
+            continue
+
+        m = re.match(r'^([^:=#\t][^:=#]*):(?!=)(.*)$', line)
+        if m:
+            current = _expand(m.group(1), variables).split()
+            deps = _expand(m.group(2).split('#')[0], variables).split()
+            if current == ['.INPLACE']:
+                inplace.update(deps)
+            current = [t for t in current if not t.startswith('.')]
+            for target in current:
+                if target not in rules:
+                    order.append(target)
+                    rules[target] = []
+                rules[target] += [d for d in deps if d not in rules[target]]
+
+    return order, rules, recipes, inplace
+
+
+def closure(rules, goals, built=()):
+    """return the set of targets needed to build the goals, the
+    prerequisites of targets already built are not needed for them"""
+    needed, stack = set(), list(goals)
+    while stack:
+        target = stack.pop()
+        if target in needed or target in built:
+            continue
+        needed.add(target)
+        stack += [d for d in rules.get(target, []) if d in rules]
+    return needed
+
+
+def _make(args):
+    """Run the recipe of a single target, executed by the thread pool.
+
+    Returns:
+      tuple: target, return code, start time, elapsed seconds, and output
+    """
+    makefile, target, prereqs, env = args
+    cmd = ['make', '-f', makefile]
+    for p in prereqs:
+        cmd += ['-o', p]
+    cmd.append(target)
+
+    start = time.time()
+    try:
+        p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        rc = p.returncode
+    except OSError as e:
+        output, rc = '%s: %s\n' % (' '.join(cmd), e), 127
+    return target, rc, start, time.time() - start, output
+
+
+def run(makefile, goals=(), jobs=None, log=None, isolate=True, built=()):
+    """Build the goals of a makefile running independent targets
+    concurrently.
+
+    Args:
+      makefile (str): makefile name
+      goals (list): targets to be built (default first target)
+      jobs (int): maximum concurrent targets (default CPU count)
+      log (file): output of each target is written as it completes
+      isolate (bool): run each target in its own GRASS mapset
+      built (list): targets already built by other means (as make -o)
+
+    Returns:
+      list: (target, start time, elapsed seconds) in order of completion
+
+    Raises:
+      subprocess.CalledProcessError: a target failed, the targets
+        already running are allowed to finish first
+    """
+    order, rules, recipes, inplace = parse_makefile(makefile)
+    goals = list(goals) or order[:1]
+    needed = closure(rules, goals, built)
+
+    # make considers a target without prerequisites built if it exists
+    done = set(t for t in needed if not rules[t] and os.path.exists(t))
+    done.update(built)
+    pending = [t for t in order if t in needed and t not in done]
+
+    jobs = jobs or os.sysconf('SC_NPROCESSORS_ONLN')
+    pool = ThreadPool(max(1, jobs))
+    finished = Queue.Queue()
+    running, times, failed = {}, [], None
+    alone = None
+    try:
+        while pending or running:
+            ready = [t for t in pending
+                     if all(d in done or d not in rules for d in rules[t])]
+            for target in ready:
+                if failed or alone or len(running) >= jobs:
+                    break
+
+                # targets modifying the layers of other targets wait for the
+                # running targets and run alone in the model mapset
+                if isolate and target in inplace and target in recipes:
+                    if running:
+                        continue
+                    alone = target
+                pending.remove(target)
+
+                # targets without a recipe only group their prerequisites
+                if target not in recipes:
+                    done.add(target)
+                    continue
+
+                mapset = TempMapset('mk_' + re.sub(r'\W', '_', target)) \
+                    if isolate and target != alone else None
+                env = mapset.env if mapset else None
+                running[target] = mapset
+                pool.apply_async(_make, [(makefile, target, rules[target],
+                                 env)], callback=finished.put)
+
+            if not running:
+                if failed or not pending:
+                    break
+                if not ready:
+                    raise RuntimeError('circular dependency among ' +
+                                       ', '.join(pending))
+                continue
+
+            target, rc, start, elapsed, output = finished.get()
+            mapset = running.pop(target)
+            if target == alone:
+                alone = None
+            if log:
+                log.write(output)
+                log.flush()
+
+            if mapset:
+                if rc == 0:
+                    mapset.promote()
+                mapset.remove()
+
+            if rc:
+                failed = failed or subprocess.CalledProcessError(rc,
+                    'make -f %s %s' % (makefile, target))
+                pending = []
+            else:
+                done.add(target)
+                times.append((target, start, elapsed))
+
+    finally:
+        pool.close()
+        pool.join()
+        for mapset in running.values():
+            if mapset:
+                mapset.remove()
+
+    if failed:
+        raise failed
+    return times
+
+
+def main():
+    usage = 'usage: %prog [-j jobs] [-l log] makefile [target ...]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-j', '--jobs', type='int', default=None,
+        help='number of targets built concurrently (default=CPU count)')
+    parser.add_option('-l', '--log', default=None,
+        help='file receiving the output of each target (default=stdout)')
+    parser.add_option('-n', '--noisolate', default=False, action='store_true',
+        help='build all targets in the current mapset')
+    (opts, args) = parser.parse_args()
+    if not args:
+        parser.error('a makefile is required')
+
+    log = open(opts.log, 'w') if opts.log else sys.stdout
+    times = run(args[0], args[1:], jobs=opts.jobs, log=log,
+                isolate=not opts.noisolate)
+
+    sys.stderr.write('\n%-30s %10s\n' % ('target', 'seconds'))
+    for target, start, elapsed in sorted(times, key=lambda t: -t[2]):
+        sys.stderr.write('%-30s %10.1f\n' % (target, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Temporary GRASS mapsets used to run GRASS commands concurrently.
+
+GRASS modules write new layers and read the region from the current
+mapset so two processes sharing a mapset can clobber each other.  A
+TempMapset is created within the current location with its own copy of
+the region (WIND) and a GISRC file that can be handed to a subprocess.
+The parent mapset and PERMANENT are placed on the search path so layers
+already created by the model are visible without copying them.  Once
+the task completes promote moves the layers it created into the parent.
+
+NOTE: grass.script can only be imported once GISBASE is set so the import
+is deferred until the first mapset is created.
+"""
+import os
+import shutil
+import tempfile
+
+
+# mapset elements holding the parts of a raster layer
+RASTER_ELEMENTS = ('cellhd', 'cell', 'fcell', 'cats', 'colr', 'hist',
+                   'cell_misc')
+
+gisrc_tmpl = """GISDBASE: %(GISDBASE)s
+LOCATION_NAME: %(LOCATION_NAME)s
+MAPSET: %(MAPSET)s
+GRASS_GUI: text
+"""
+
+
+def _remove(path):
+    """remove a file or directory if it exists"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _gisenv():
+    """return the GISDBASE, LOCATION_NAME, and MAPSET of the session"""
+    from grass.script import gisenv
+    return gisenv()
+
+
+class TempMapset:
+    """A GRASS mapset created for a single task and removed afterwards.
+
+    Attributes:
+      name (str): mapset name
+      parent (str): mapset the region and search path were taken from
+      path (str): mapset directory
+      gisrc (str): GISRC file selecting the mapset
+      env (dict): copy of os.environ with GISRC set for subprocesses
+    """
+
+    def __init__(self, name, parent=None):
+        genv = _gisenv()
+        location = os.path.join(genv['GISDBASE'], genv['LOCATION_NAME'])
+
+        self.name = name
+        self.parent = parent or genv['MAPSET']
+        self.path = os.path.join(location, name)
+
+        # start from a clean mapset in case a previous run failed
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+
+        # the region is copied so changes are not seen by the parent
+        for fname in ('WIND', 'VAR'):
+            src = os.path.join(location, self.parent, fname)
+            if os.path.exists(src):
+                shutil.copy(src, os.path.join(self.path, fname))
+
+        with open(os.path.join(self.path, 'SEARCH_PATH'), 'w') as f:
+            for m in (name, self.parent, 'PERMANENT'):
+                f.write(m + '\n')
+
+        fd, self.gisrc = tempfile.mkstemp(prefix='gisrc_%s_' % name)
+        with os.fdopen(fd, 'w') as f:
+            f.write(gisrc_tmpl % dict(genv, MAPSET=name))
+
+        self.env = dict(os.environ)
+        self.env['GISRC'] = self.gisrc
+
+    def layer(self, name):
+        """return the fully qualified name of a layer within the mapset"""
+        return '%s@%s' % (name, self.name)
+
+    def promote(self):
+        """Move the layers created in the mapset into the parent mapset.
+
+        Existing parent layers of the same name are removed first, as
+        g.remove would, so no stale element of the old layer survives.
+
+        Returns:
+          list: names of the raster and vector layers moved
+        """
+        parent = os.path.join(os.path.dirname(self.path), self.parent)
+
+        names = {}
+        for element in ('cellhd', 'vector'):
+            d = os.path.join(self.path, element)
+            if os.path.isdir(d):
+                names[element] = os.listdir(d)
+
+        for name in names.get('cellhd', []):
+            for element in RASTER_ELEMENTS:
+                _remove(os.path.join(parent, element, name))
+        for name in names.get('vector', []):
+            _remove(os.path.join(parent, 'vector', name))
+
+        for element in RASTER_ELEMENTS + ('vector', 'dbf'):
+            src = os.path.join(self.path, element)
+            if not os.path.isdir(src):
+                continue
+            dest = os.path.join(parent, element)
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            for name in os.listdir(src):
+                _remove(os.path.join(dest, name))
+                os.rename(os.path.join(src, name), os.path.join(dest, name))
+
+        return sorted(names.get('cellhd', []) + names.get('vector', []))
+
+    def remove(self):
+        """delete the mapset and its GISRC file"""
+        shutil.rmtree(self.path, ignore_errors=True)
+        if os.path.exists(self.gisrc):
+            os.remove(self.gisrc)
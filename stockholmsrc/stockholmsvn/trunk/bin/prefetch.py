@@ -0,0 +1,113 @@
+"""
+Concurrent download of the model inputs referenced by a LUC config.
+
+Every driver set and projection asset is known once the configuration
+has been parsed so the files are downloaded in parallel into a staging
+directory before any GRASS processing starts.  LEAMsite.stage is then
+used to serve the staged copies from getURL rather than fetching each
+URL serially through a single browser session.
+"""
+import os
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+
+def _listof(v):
+    """driver fields may hold a single URL or a list of URLs"""
+    if not v:
+        return []
+    return [v] if isinstance(v, basestring) else list(v)
+
+
+def config_urls(luc):
+    """Collect the URLs referenced by a parsed LUC config.
+
+    Args:
+      luc (LUC): parsed model configuration
+
+    Returns:
+      list: unique http(s) URLs in the order first referenced
+    """
+    urls = [luc.scenario.get('grass_loc')]
+
+    for drivers in luc.growthmap + luc.declinemap:
+        urls += [drivers.get(k) for k in ('landuse', 'dem', 'tdm')]
+        urls.append((drivers.get('empcenters') or {}).get('empcenter'))
+        urls.append((drivers.get('popcenters') or {}).get('popcenter'))
+        urls += _listof(drivers.get('specials'))
+        urls += _listof(drivers.get('nogrowth'))
+
+    for proj in luc.growth + luc.decline:
+        urls += [proj.get(k) for k in
+                 ('layer', 'graph', 'pop_density', 'emp_density')]
+
+    unique = []
+    for url in urls:
+        if url and url.startswith('http') and url not in unique:
+            unique.append(url)
+    return unique
+
+
+def _fetch(args):
+    """Download a single URL, executed by the prefetch thread pool.
+
+    Returns:
+      tuple: url, file name, content-type, and error message
+    """
+    url, fname, auth = args
+    try:
+        r = requests.get(url, auth=auth, stream=True)
+        r.raise_for_status()
+        with open(fname + '.part', 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                f.write(chunk)
+        os.rename(fname + '.part', fname)
+        return url, fname, r.headers.get('content-type', ''), None
+
+    except Exception as e:
+        return url, None, None, str(e)
+
+
+def prefetch(urls, auth, staging='staging', threads=8):
+    """Download a list of URLs concurrently into the staging directory.
+
+    Failed downloads are not fatal, the caller falls back to fetching
+    those URLs directly.
+
+    Args:
+      urls (list): URLs to be downloaded
+      auth (tuple): portal user and password
+      staging (str): directory where the files are written
+      threads (int): number of concurrent downloads
+
+    Returns:
+      (dict, dict): url -> (file name, content-type) for each staged
+        file and url -> error message for each failure
+    """
+    if not os.path.isdir(staging):
+        os.makedirs(staging)
+
+    args = []
+    for url in urls:
+        key = url.encode('utf-8') if isinstance(url, unicode) else url
+        fname = os.path.join(staging, hashlib.sha1(key).hexdigest())
+        args.append((url, fname, auth))
+
+    staged, failed = {}, {}
+    if not args:
+        return staged, failed
+
+    pool = ThreadPool(max(1, min(threads, len(args))))
+    try:
+        for url, fname, ctype, err in pool.imap_unordered(_fetch, args):
+            if err:
+                failed[url] = err
+            else:
+                staged[url] = (fname, ctype)
+    finally:
+        pool.close()
+        pool.join()
+
+    return staged, failed
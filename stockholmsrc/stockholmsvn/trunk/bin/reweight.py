@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Re-weighting of the probability maps from cached Driver Set layers.
+
+The road weights of transport_att (W_STATERD, W_RAMP, W_INTERSECT,
+W_COUNTY, and W_ROAD in attmaps.make) and the score weights of
+probmaps.make are applied long after the expensive steps of
+buildProbmaps (the travel time surfaces, cities.py, and the distance
+attractors).  save keeps the layers the weights are applied to in a
+compact cache for a Driver Set:
+
+  - the five road attractors combined into transport_att
+  - cities_att, emp_att, special_res, and special_com
+  - forest_score, water_score, and slope_score, which have no weights
+
+Layers are stored as float32 .npy files (NaN for null), or uint8 (255
+for null) for CELL layers whose values fit.  compose rebuilds
+transport_att with new weights and passes the cached layers to
+probmap.compose, producing probmap_res and probmap_com in a single pass
+without running attmaps.make or probmaps.make.
+
+The cached values are float32 so re-weighted probmaps agree with a full
+build to float32 precision rather than exactly.  The *_prob_MULT and
+city/employment size variables of attmaps.make are not used by any
+active target (cities.py uses the population of each center) so they
+cannot be re-weighted.
+
+Usage:
+  reweight.py save dset_id
+  reweight.py compose dset_id [NAME=weight ...] [res.bil com.bil]
+"""
+import os
+import sys
+import json
+import time
+
+import numpy
+from numpy.lib.format import open_memmap
+
+import gridio
+import probmap
+import sfa
+import makesched
+
+
+# attmaps.make weight -> road attractor, in the order of transport_att
+TRANSPORT = [
+    ('W_STATERD', 'staterd_att'),
+    ('W_INTERSECT', 'intersect_att'),
+    ('W_RAMP', 'ramp_att'),
+    ('W_COUNTY', 'county_att'),
+    ('W_ROAD', 'road_att'),
+    ]
+
+ATTRACTORS = [a for w, a in TRANSPORT] + \
+    ['cities_att', 'emp_att', 'special_res', 'special_com']
+
+# scores without weights, cached instead of their attractors
+FIXED = ['forest_score', 'water_score', 'slope_score']
+
+UINT8_NULL = 255
+
+
+def _region():
+    import grass.script as grass
+    return grass.read_command('g.region', flags='g')
+
+
+class Stored:
+    """Rows of a cached layer as float64 with NaN for null."""
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+
+    def __getitem__(self, index):
+        a = self.data[index]
+        x = numpy.asarray(a, dtype=numpy.float64)
+        if a.dtype == numpy.uint8:
+            x[a == UINT8_NULL] = numpy.nan
+        return x
+
+
+class ScoreCache:
+    """Cached layers of a Driver Set.
+
+    Attributes:
+      directory (str): <root>/<dset_id> holding the .npy files and
+        manifest.json
+      manifest (dict): region, GRASS type, and stored type of each layer,
+        and the make file variables in effect when saved
+    """
+
+    def __init__(self, dset_id, root='reweight'):
+        self.directory = os.path.join(root, dset_id)
+        self.fname = os.path.join(self.directory, 'manifest.json')
+        try:
+            with open(self.fname) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            self.manifest = None
+
+    def _path(self, layer):
+        return os.path.join(self.directory, layer + '.npy')
+
+    def save(self, attmaps='bin/attmaps.make', probmaps='bin/probmaps.make',
+             rows=1024):
+        """Cache the layers of the Driver Set in the current mapset."""
+        import grass.script as grass
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        manifest = dict(created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        region=_region(), layers={},
+                        attmaps=makesched.read_variables(attmaps),
+                        probmaps=makesched.read_variables(probmaps))
+
+        variables = probmap.settings(probmaps)
+        types = dict((a, sfa.datatype(a)) for a in
+                     ATTRACTORS + ['forest_att', 'water_att', 'slope_att'])
+        scorer = probmap.Scorer(variables, types)
+        specs = dict((s[0], s[1]) for s in probmap.SCORES)
+
+        for layer in ATTRACTORS + FIXED:
+            source = specs.get(layer, layer)
+            info = grass.raster_info(source)
+            if layer not in FIXED and info['datatype'] == 'CELL' and \
+                    0 <= info['min'] and info['max'] < UINT8_NULL:
+                dtype = numpy.uint8
+            else:
+                dtype = numpy.float32
+
+            src = gridio.load(source, dtype=numpy.float64)
+            dest = open_memmap(self._path(layer) + '.tmp', mode='w+',
+                               dtype=dtype, shape=src.shape)
+            for r in xrange(0, src.shape[0], rows):
+                x = numpy.asarray(src[r:r + rows])
+                x = numpy.where(x == gridio.NULL, numpy.nan, x)
+                if layer in FIXED:
+                    x = scorer.score(layer, {source: x})
+                if dtype is numpy.uint8:
+                    x = numpy.where(numpy.isnan(x), UINT8_NULL, x)
+                dest[r:r + rows] = x
+            del dest
+            os.rename(self._path(layer) + '.tmp', self._path(layer))
+
+            manifest['layers'][layer] = dict(
+                gtype=types.get(layer, 'DCELL'),
+                dtype=numpy.dtype(dtype).name)
+
+        with open(self.fname, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        self.manifest = manifest
+
+    def load(self, layer):
+        """return the cached layer (see Stored) and its GRASS type"""
+        data = numpy.load(self._path(layer), mmap_mode='r')
+        return Stored(data), self.manifest['layers'][layer]['gtype']
+
+    def compose(self, weights=None, bils=None, rows=1024):
+        """Build probmap_res and probmap_com with new weights.
+
+        Args:
+          weights (dict): attmaps.make road weights and probmaps.make
+            score weights, others keep the values used when saved
+          bils (tuple): names of the res and com BIL files to be written
+          rows (int): number of rows processed at a time
+
+        Raises:
+          RuntimeError: no cache was saved or the region differs
+          ValueError: a weight cannot be applied to the cached layers
+        """
+        if not self.manifest:
+            raise RuntimeError('no cached layers in ' + self.directory)
+        if self.manifest['region'] != _region():
+            raise RuntimeError('%s was saved for a different region'
+                               % self.directory)
+
+        weights = dict(weights or {})
+        road = dict(self.manifest['attmaps'])
+        variables = dict(self.manifest['probmaps'])
+        for name, value in weights.items():
+            if name in dict(TRANSPORT):
+                road[name] = value
+            elif name.startswith('W_') and name in variables:
+                variables[name] = value
+            else:
+                raise ValueError('%s cannot be re-weighted' % name)
+
+        # transport_att as in attmaps.make (float64 from float32 inputs)
+        roads = [(float(road[w]), self.load(a)[0]) for w, a in TRANSPORT]
+        transport = gridio.empty(dtype=numpy.float64)
+        for r in xrange(0, transport.shape[0], rows):
+            t = 0.0
+            for w, a in roads:
+                t = t + w / (a[r:r + rows] + 0.1)
+            transport[r:r + rows] = numpy.where(numpy.isnan(t), gridio.NULL,
+                                                t)
+
+        inputs = dict((layer, self.load(layer)) for layer in
+                      ATTRACTORS[len(TRANSPORT):] + FIXED)
+        inputs['transport_att'] = (transport, 'DCELL')
+        probmap.compose(variables, bils=bils, rows=rows, inputs=inputs)
+
+
+def main():
+    usage = __doc__.split('Usage:')[1]
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] not in ('save', 'compose'):
+        sys.stderr.write('Usage:' + usage)
+        sys.exit(1)
+
+    cache = ScoreCache(args[1])
+    if args[0] == 'save':
+        cache.save()
+        return
+
+    weights = dict(a.split('=', 1) for a in args[2:] if '=' in a)
+    bils = [a for a in args[2:] if '=' not in a]
+    if bils and len(bils) != 2:
+        sys.stderr.write('Usage:' + usage)
+        sys.exit(1)
+
+    start = time.time()
+    cache.compose(weights, bils=bils or None)
+    sys.stderr.write('probmaps composed in %.1fs\n' % (time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
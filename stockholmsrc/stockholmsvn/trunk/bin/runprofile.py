@@ -0,0 +1,107 @@
+"""
+Phase level timing and resource usage for model runs.
+
+Each phase records the wall time, the CPU time used by the model
+process and by child processes (GRASS modules, make, GLUC), and the
+peak resident set size.  Child CPU time is only available for children
+that have terminated and been waited for, which is always the case for
+the check_call/call style used by the model scripts.
+
+The peak RSS values are the high-water marks reported by getrusage at
+the end of the phase (kilobytes on Linux), a phase that raised the mark
+is the one responsible for the peak.
+"""
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+
+def _usage():
+    """return (self cpu, children cpu, self maxrss, children maxrss)"""
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (s.ru_utime + s.ru_stime, c.ru_utime + c.ru_stime,
+            s.ru_maxrss, c.ru_maxrss)
+
+
+class Profile:
+    """Collects timing information for the phases of a model run.
+
+    Attributes:
+      phases (list of dict): completed phases in order of completion
+      depth (int): number of phases currently open
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+        self.depth = 0
+
+    @contextmanager
+    def phase(self, name, **info):
+        """Context manager timing a phase.
+
+        Args:
+          name (str): phase name, '/' separates nested phases such as
+            'projection/<projid>/sanity'
+          info: additional values stored with the phase
+        """
+        start = time.time()
+        before = _usage()
+        failed = True
+        self.depth += 1
+        try:
+            yield
+            failed = False
+        finally:
+            self.depth -= 1
+            after = _usage()
+            self.record(name, start=start, wall=time.time() - start,
+                        cpu=after[0] - before[0],
+                        child_cpu=after[1] - before[1],
+                        maxrss=after[2], child_maxrss=after[3],
+                        failed=failed, **info)
+
+    def record(self, name, start=None, **values):
+        """Add a phase measured elsewhere (e.g. within a pool worker)."""
+        if start is None:
+            start = time.time() - values.get('wall', 0.0)
+        values.update(name=name, depth=self.depth,
+                      start=round(start - self.started, 3))
+        for k in ('wall', 'cpu', 'child_cpu'):
+            if k in values:
+                values[k] = round(values[k], 3)
+        self.phases.append(values)
+
+    def totals(self):
+        """return dict of wall and cpu time of the outermost phases summed
+        by the first component of their name"""
+        totals = {}
+        for p in self.phases:
+            if p['depth']:
+                continue
+            name = p['name'].split('/')[0]
+            t = totals.setdefault(name, dict(wall=0.0, cpu=0.0))
+            t['wall'] += p.get('wall', 0.0)
+            t['cpu'] += p.get('cpu', 0.0) + p.get('child_cpu', 0.0)
+        return totals
+
+    def write(self, fname='profile.json'):
+        """write the profile as JSON and return the filename"""
+        s = resource.getrusage(resource.RUSAGE_SELF)
+        c = resource.getrusage(resource.RUSAGE_CHILDREN)
+        doc = dict(
+            started = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                    time.localtime(self.started)),
+            wall = round(time.time() - self.started, 3),
+            cpu = round(s.ru_utime + s.ru_stime, 3),
+            child_cpu = round(c.ru_utime + c.ru_stime, 3),
+            maxrss = s.ru_maxrss,
+            child_maxrss = c.ru_maxrss,
+            totals = self.totals(),
+            phases = self.phases,
+            )
+        with open(fname, 'w') as f:
+            json.dump(doc, f, indent=1, sort_keys=True)
+        return fname
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Regression tests of convolve.py against r.mfilter and r.neighbors
+semantics.
+
+The filters are compared with direct sums over the window of each cell
+following raster/r.mfilter/apply.c and r.neighbors method=sum.  Only
+NumPy is needed, 'convolve.py compare' checks against r.mfilter and
+r.neighbors themselves within a GRASS session.
+
+Usage:
+  python bin/test_convolve.py
+"""
+import os
+import tempfile
+import unittest
+
+import numpy
+from numpy.testing import assert_array_equal, assert_allclose
+
+import convolve
+
+NULL = convolve.gridio.NULL
+
+
+def window_sums(data, kernel):
+    """weighted sum over the window centred on each cell, the cells
+    outside the array contribute nothing"""
+    k = kernel.shape[0]
+    h = k // 2
+    padded = numpy.pad(data, h, 'constant')
+    out = numpy.zeros(data.shape)
+    for r in range(data.shape[0]):
+        for c in range(data.shape[1]):
+            out[r, c] = (padded[r:r + k, c:c + k] * kernel).sum()
+    return out
+
+
+def mfilter(src, kernel, divisor):
+    """r.mfilter apply.c cell by cell: with a divisor any null cell of
+    the window makes the cell null, with divisor 0 the null cells are
+    skipped and the sum divided by the weights of the others; the cells
+    within half a window of the edge are copied"""
+    k = kernel.shape[0]
+    h = k // 2
+    out = src.astype(numpy.float64)
+    for r in range(h, src.shape[0] - h):
+        for c in range(h, src.shape[1] - h):
+            v, w, null = 0.0, 0.0, False
+            for i in range(k):
+                for j in range(k):
+                    x = src[r - h + i, c - h + j]
+                    if x == NULL:
+                        null = True
+                        continue
+                    v += x * kernel[i, j]
+                    w += kernel[i, j]
+            if divisor:
+                out[r, c] = NULL if null else v / divisor
+            else:
+                out[r, c] = v / w if w else NULL
+    return out
+
+
+def neighbors(src, weights):
+    """r.neighbors method=sum cell by cell: null cells and cells outside
+    the region are skipped, null when the window has no other cell"""
+    k = weights.shape[0]
+    h = k // 2
+    out = numpy.empty(src.shape)
+    for r in range(src.shape[0]):
+        for c in range(src.shape[1]):
+            v, n = 0.0, 0
+            for i in range(k):
+                for j in range(k):
+                    rr, cc = r - h + i, c - h + j
+                    if not weights[i, j] or \
+                            not (0 <= rr < src.shape[0] and
+                                 0 <= cc < src.shape[1]) or \
+                            src[rr, cc] == NULL:
+                        continue
+                    v += src[rr, cc]
+                    n += 1
+            out[r, c] = v if n else NULL
+    return out
+
+
+def layer(seed, rows=23, cols=31, nulls=0.03):
+    """random small integer values with null cells"""
+    rnd = numpy.random.RandomState(seed)
+    src = numpy.round(rnd.uniform(0.0, 3.0, (rows, cols)))
+    src[rnd.uniform(size=src.shape) < nulls] = NULL
+    return src
+
+
+class TestCorrelate(unittest.TestCase):
+
+    def check(self, kernel, exact=True):
+        rnd = numpy.random.RandomState(kernel.shape[0])
+        data = numpy.round(rnd.uniform(0.0, 9.0, (30, 40)))
+        h = kernel.shape[0] // 2
+        expected = window_sums(data, kernel)[h:-h, h:-h]
+        result = convolve.correlate(data, kernel)
+        if exact:
+            assert_array_equal(result, expected)
+        else:
+            assert_allclose(result, expected, rtol=1e-9, atol=1e-9)
+
+    def test_square(self):
+        # summed-area table
+        self.check(numpy.ones((5, 5)))
+
+    def test_circle(self):
+        # running sums along the rows
+        self.check(convolve.circle(11))
+        self.check(convolve.circle(3))
+
+    def test_separable(self):
+        kernel = numpy.outer([1.0, 2.0, 3.0, 2.0, 1.0],
+                             [2.0, 0.0, 1.0, 0.0, 2.0])
+        self.assertTrue(convolve._separate(kernel) is not None)
+        self.check(kernel)
+
+    def test_fft(self):
+        rnd = numpy.random.RandomState(3)
+        kernel = numpy.round(rnd.uniform(0.0, 5.0, (7, 7)))
+        self.assertTrue(convolve._separate(kernel) is None)
+        # integer weights and values, the FFT noise is rounded away
+        self.check(kernel)
+        self.check(kernel + 0.25, exact=False)
+
+    def test_neighbor_att(self):
+        # the 29x29 kernel of neighbor_att
+        r, c = numpy.mgrid[:29, :29]
+        kernel = numpy.round(10.0 / (1.0 + numpy.hypot(r - 14, c - 14)))
+        self.check(kernel)
+
+
+class TestFilter(unittest.TestCase):
+
+    def test_divisor(self):
+        kernel = numpy.round(numpy.random.RandomState(1).uniform(0, 5, (5, 5)))
+        for seed in range(3):
+            src = layer(seed)
+            for divisor in (0.0, 1.0, 4.0):
+                assert_allclose(convolve.filter_array(src, kernel, divisor),
+                                mfilter(src, kernel, divisor),
+                                rtol=1e-12, atol=0,
+                                err_msg='seed %d divisor %g' % (seed, divisor))
+
+    def test_zero_weights(self):
+        # a null under a zero weight still nulls the cell with a divisor
+        kernel = numpy.array([[0.0, 1.0, 0.0], [1.0, 1.0, 1.0],
+                              [0.0, 1.0, 0.0]])
+        src = numpy.ones((3, 3))
+        src[0, 0] = NULL
+        self.assertEqual(convolve.filter_array(src, kernel, 1.0)[1, 1], NULL)
+        self.assertEqual(convolve.filter_array(src, kernel, 0.0)[1, 1], 1.0)
+
+    def test_all_null(self):
+        src = numpy.full((5, 5), NULL)
+        src[0, 0] = 2.0
+        out = convolve.filter_array(src, numpy.ones((3, 3)), 0.0)
+        # the edge is copied, the window of (1, 1) reaches the one value
+        self.assertEqual(out[0, 0], 2.0)
+        self.assertEqual(out[1, 1], 2.0)
+        self.assertEqual(out[2, 2], NULL)
+
+    def test_edges(self):
+        src = layer(4, 12, 12)
+        out = convolve.filter_array(src, numpy.ones((5, 5)), 1.0)
+        for edge in (numpy.s_[:2], numpy.s_[-2:], numpy.s_[:, :2],
+                     numpy.s_[:, -2:]):
+            assert_array_equal(out[edge], src[edge])
+
+    def test_blocks(self):
+        # blocks smaller than the window give the result of one block
+        src = layer(5, 40, 20)
+        kernel = numpy.round(numpy.random.RandomState(2).uniform(0, 5, (7, 7)))
+        for divisor in (0.0, 1.0):
+            whole = convolve.filter_array(src, kernel, divisor)
+            for rows in (1, 3, 11):
+                assert_array_equal(
+                    convolve.filter_array(src, kernel, divisor, rows=rows),
+                    whole)
+
+    def test_out(self):
+        src = layer(6)
+        out = numpy.zeros(src.shape)
+        self.assertTrue(convolve.filter_array(src, numpy.ones((3, 3)),
+                                              out=out) is out)
+
+
+class TestSum(unittest.TestCase):
+
+    def test_sum(self):
+        for seed in range(3):
+            src = layer(seed, nulls=0.2)
+            for weights in (numpy.ones((3, 3)), convolve.circle(5),
+                            convolve.circle(11)):
+                assert_array_equal(convolve.sum_array(src, weights),
+                                   neighbors(src, weights))
+
+    def test_null(self):
+        src = numpy.full((7, 7), NULL)
+        src[0, 0] = 1.0
+        out = convolve.sum_array(src, convolve.circle(3))
+        self.assertEqual(out[0, 1], 1.0)
+        self.assertEqual(out[1, 1], NULL)   # corner outside the circle
+
+    def test_blocks(self):
+        src = layer(7, 50, 20, nulls=0.1)
+        whole = convolve.sum_array(src, convolve.circle(11))
+        for rows in (1, 4, 13):
+            assert_array_equal(
+                convolve.sum_array(src, convolve.circle(11), rows=rows), whole)
+
+
+class TestReadFilter(unittest.TestCase):
+
+    def write(self, text):
+        fd, name = tempfile.mkstemp()
+        os.write(fd, text)
+        os.close(fd)
+        self.addCleanup(os.remove, name)
+        return name
+
+    def test_read(self):
+        name = self.write('TITLE  test\nMATRIX 3\n1 2 1\n2 4 2\n1 2 1\n'
+                          'DIVISOR 16\nTYPE   P\n')
+        kernel, divisor = convolve.read_filter(name)
+        assert_array_equal(kernel, [[1, 2, 1], [2, 4, 2], [1, 2, 1]])
+        self.assertEqual(divisor, 16.0)
+
+    def test_default_divisor(self):
+        kernel, divisor = convolve.read_filter(
+            self.write('MATRIX 1\n1\n'))
+        self.assertEqual(divisor, 0.0)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, convolve.read_filter,
+                          self.write('MATRIX 3\n1 1 1\n1 1\n1 1 1\n'))
+        self.assertRaises(ValueError, convolve.read_filter,
+                          self.write('MATRIX 1\n1\nTYPE S\n'))
+        self.assertRaises(ValueError, convolve.read_filter,
+                          self.write('DIVISOR 1\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Regression tests of costdist.py against r.multicost semantics.
+
+The travel times are compared with a cell by cell Dijkstra following
+raster/r.multicost/main.c and with small surfaces computed by hand.
+Only NumPy is needed, 'costdist.py compare' checks against r.multicost
+itself within a GRASS session.
+
+Usage:
+  python bin/test_costdist.py
+"""
+import math
+import heapq
+import unittest
+
+import numpy
+from numpy.testing import assert_array_equal, assert_allclose
+
+import costdist
+
+
+def multicost(cost, start, maxcost=0, nsres=30.0, ewres=30.0):
+    """r.multicost search: the lowest cell is popped, the search stops at
+    the first cell beyond maxcost, and each neighbour is relaxed with the
+    mean of the two cell costs times the factor of the direction."""
+    nrows, ncols = cost.shape
+    fac = costdist.factors(nsres, ewres)
+    out = numpy.full(cost.shape, numpy.nan)
+    heap = []
+    for r, c in zip(*numpy.nonzero(start)):
+        out[r, c] = 0.0
+        heapq.heappush(heap, (0.0, r, c))
+
+    while heap:
+        d, r, c = heapq.heappop(heap)
+        if maxcost and d > maxcost:
+            break
+        if d > out[r, c] or numpy.isnan(cost[r, c]):
+            continue
+        for dr, dc, f in costdist.NEIGHBORS:
+            nr, nc = r + dr, c + dc
+            if not (0 <= nr < nrows and 0 <= nc < ncols):
+                continue
+            cand = d + ((cost[nr, nc] + cost[r, c]) / 2.0) * fac[f]
+            if numpy.isnan(cand):
+                continue
+            if numpy.isnan(out[nr, nc]) or cand < out[nr, nc]:
+                out[nr, nc] = cand
+                heapq.heappush(heap, (cand, nr, nc))
+    return out
+
+
+def network(seed, rows=40, cols=60, nulls=0.05):
+    """random overland costs crossed by fast roads, with null cells"""
+    rnd = numpy.random.RandomState(seed)
+    cost = 1.8 / rnd.uniform(2.0, 8.0, (rows, cols))
+    cost[rnd.randint(0, rows, 3), :] = 1.8 / 55.0
+    cost[:, rnd.randint(0, cols, 3)] = 1.8 / 55.0
+    cost[rnd.uniform(size=cost.shape) < nulls] = numpy.nan
+    start = numpy.zeros(cost.shape, dtype=bool)
+    start[rnd.randint(0, rows, 3), rnd.randint(0, cols, 3)] = True
+    return cost, start
+
+
+class TestAccumulate(unittest.TestCase):
+
+    def test_row(self):
+        # costs 1 2 3 4 from the first cell: 0, 1.5, 1.5+2.5, 4+3.5
+        cost = numpy.array([[1.0, 2.0, 3.0, 4.0]])
+        start = numpy.array([[True, False, False, False]])
+        assert_array_equal(costdist.accumulate(cost, start),
+                           [[0.0, 1.5, 4.0, 7.5]])
+
+    def test_maxcost(self):
+        # the search stops at 4.0 > 3, the cell keeps its tentative cost
+        # and the cell beyond it is never reached
+        cost = numpy.array([[1.0, 2.0, 3.0, 4.0]])
+        start = numpy.array([[True, False, False, False]])
+        assert_array_equal(costdist.accumulate(cost, start, maxcost=3),
+                           [[0.0, 1.5, 4.0, numpy.nan]])
+
+    def test_diagonal(self):
+        cost = numpy.full((3, 3), 2.0)
+        start = numpy.zeros((3, 3), dtype=bool)
+        start[1, 1] = True
+        d = 2.0 * math.sqrt(2.0)
+        assert_allclose(costdist.accumulate(cost, start),
+                        [[d, 2.0, d], [2.0, 0.0, 2.0], [d, 2.0, d]],
+                        rtol=0, atol=1e-12)
+
+    def test_resolution(self):
+        # rows twice as long as columns are wide: ns factor 2, diagonal
+        # factor sqrt(5)
+        cost = numpy.full((3, 3), 2.0)
+        start = numpy.zeros((3, 3), dtype=bool)
+        start[1, 1] = True
+        d = 2.0 * math.sqrt(5.0)
+        assert_allclose(costdist.accumulate(cost, start, nsres=60.0),
+                        [[d, 4.0, d], [2.0, 0.0, 2.0], [d, 4.0, d]],
+                        rtol=0, atol=1e-12)
+
+    def test_nulls(self):
+        # null cells are never entered, a null start cell keeps 0 but is
+        # not expanded
+        cost = numpy.array([[1.0, numpy.nan, 1.0]])
+        start = numpy.array([[True, False, False]])
+        assert_array_equal(costdist.accumulate(cost, start),
+                           [[0.0, numpy.nan, numpy.nan]])
+        start = numpy.array([[False, True, False]])
+        assert_array_equal(costdist.accumulate(cost, start),
+                           [[numpy.nan, 0.0, numpy.nan]])
+
+    def test_no_start(self):
+        cost = numpy.ones((2, 2))
+        self.assertRaises(ValueError, costdist.accumulate, cost,
+                          numpy.zeros((2, 2), dtype=bool))
+
+    def test_dijkstra(self):
+        for seed in range(5):
+            cost, start = network(seed)
+            for maxcost in (0, 5, 20):
+                assert_array_equal(
+                    costdist.accumulate(cost, start, maxcost),
+                    multicost(cost, start, maxcost),
+                    'seed %d maxcost %d' % (seed, maxcost))
+
+    def test_dijkstra_resolution(self):
+        cost, start = network(7)
+        assert_array_equal(
+            costdist.accumulate(cost, start, 10, nsres=30.0, ewres=20.0),
+            multicost(cost, start, 10, nsres=30.0, ewres=20.0))
+
+    def test_interstates(self):
+        # the second layer and the crossover cells do not change the result
+        cost, start = network(3)
+        m2 = numpy.full(cost.shape, numpy.nan)
+        m2[cost.shape[0] // 2, :] = 0.01
+        xover = numpy.zeros(cost.shape)
+        xover[cost.shape[0] // 2, ::10] = 1
+        assert_array_equal(
+            costdist.accumulate(cost, start, 20, m2=m2, xover=xover),
+            costdist.accumulate(cost, start, 20))
+
+
+class TestBufferMask(unittest.TestCase):
+
+    def brute(self, mask, dist, nsres, ewres):
+        rows, cols = numpy.indices(mask.shape)
+        out = mask.copy()
+        for r, c in zip(*numpy.nonzero(mask)):
+            d2 = ((rows - r) * nsres) ** 2 + ((cols - c) * ewres) ** 2
+            out |= d2 <= dist * dist
+        return out
+
+    def test_buffer(self):
+        rnd = numpy.random.RandomState(2)
+        mask = rnd.uniform(size=(30, 40)) < 0.01
+        mask[0, 0] = mask[-1, -1] = True
+        for dist, nsres, ewres in ((180.0, 30.0, 30.0), (90.0, 30.0, 30.0),
+                                   (100.0, 30.0, 20.0)):
+            assert_array_equal(costdist.buffer_mask(mask, dist, nsres, ewres),
+                               self.brute(mask, dist, nsres, ewres))
+
+    def test_distance_on_edge(self):
+        # r.buffer includes the cells exactly at the distance
+        mask = numpy.zeros((1, 9), dtype=bool)
+        mask[0, 0] = True
+        assert_array_equal(costdist.buffer_mask(mask, 180.0)[0],
+                           [True] * 7 + [False] * 2)
+
+
+class TestFold(unittest.TestCase):
+
+    def test_fold(self):
+        tt = numpy.array([0.0, 0.9, numpy.nan, 9.9])
+        att = numpy.array([100.0, 1.0, 0.0, 0.01])
+        dest = numpy.array([50.0, 5.0, 3.0, 0.0])
+        assert_allclose(costdist.fold(dest.copy(), tt, 1.0, 'max'),
+                        numpy.maximum(dest, att))
+        assert_allclose(costdist.fold(dest.copy(), tt, 1.0, 'grav'),
+                        dest + att)
+
+    def test_attraction(self):
+        cost, start = network(4)
+        masks = [start, numpy.zeros(cost.shape, dtype=bool)]
+        masks[1][5, 5] = True
+        empty = numpy.zeros(cost.shape, dtype=bool)
+        tt = costdist.travel_time(cost, masks[1], 30)
+
+        kept = {}
+        def keep(i, t):
+            kept[i] = t
+        result = costdist.attraction(cost,
+            [(masks[0], 1000.0), (None, 50.0, lambda: tt), (empty, 10.0)],
+            30, 'grav', keep=keep)
+
+        expected = numpy.zeros(cost.shape)
+        t0 = costdist.accumulate(cost,
+            costdist.buffer_mask(masks[0], 180.0), 30)
+        costdist.fold(expected, t0, 1000.0, 'grav')
+        costdist.fold(expected, tt, 50.0, 'grav')
+        assert_array_equal(result, expected)
+
+        self.assertEqual(sorted(kept), [0, 2])
+        assert_array_equal(kept[0], t0)
+        self.assertTrue(numpy.isnan(kept[2]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
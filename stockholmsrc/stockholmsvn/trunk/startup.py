@@ -16,37 +16,71 @@ import os
 import sys
 sys.path += ['./bin']
 
+import atexit
 import csv
 from glob import iglob
 import logging
+import multiprocessing
 from operator import itemgetter
 from optparse import OptionParser
 from osgeo import ogr
 import random
 import re
+import resource
 import shutil
 import subprocess
 import requests
 from subprocess import call
 from subprocess import check_call
 from StringIO import StringIO
+import threading
 import time
 import xml.etree.ElementTree as ET
 from zipfile import BadZipfile
 from zipfile import ZipFile
 
+from exports import BILExports
 from luc_config import LUC
+import makesched
+from leamcache import Cache, Hasher
 from leamsite import LEAMsite
+from mapsets import TempMapset
+from prefetch import config_urls, prefetch
+from runprofile import Profile
+
+# NumPy is optional, without it GRASS modules are used for raster statistics
+try:
+    import numpy
+    import bil
+    import glucmerge
+    import gridio
+    import probmap
+    import reweight
+    from zonelabels import ZoneLabels
+except ImportError:
+    numpy = None
+
+# zones of the subregional projections (see indexZones), None without NumPy
+zoneindex = None
 
 
 class RunLog:
     """Utility class that wraps the standard python logging facility
     and promotes some messages to the log maintained on portal site.
+
+    Portal updates are made from a background thread so the model never
+    waits on the portal.  Messages are buffered and the log document is
+    updated at most every <interval> seconds, headings and errors are
+    sent immediately.  The remaining messages are flushed at exit.
+
+    NOTE: mechanize browsers are not thread safe, <site> should be a
+    LEAMsite instance dedicated to the run log.
     """
-    def __init__(self, resultsdir, site, initmsg=''):
+    def __init__(self, resultsdir, site, initmsg='', interval=30):
         self.logger = self._init_logger(__name__)
         self.log = StringIO()
         self.site = site
+        self.interval = interval
 
         if initmsg:
             self.log.write('<h2 class="runlog">'+initmsg+'</h2>\n')
@@ -54,6 +88,16 @@ class RunLog:
             self.log.write('<h2 class="runlog">Run Started</h2>\n')
         self.logdoc = self.site.putDocument(self.log, resultsdir, 'Run Log')
 
+        self.lock = threading.Lock()
+        self.sending = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._flusher)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
     def _init_logger(self, name, level=logging.DEBUG, fname='run.log'):
         logger = logging.getLogger(name)
         logger.setLevel(level)
@@ -66,27 +110,66 @@ class RunLog:
         logger.addHandler(handler)
         return logger
 
+    def _write(self, html, urgent=False):
+        """buffer html for the portal log, urgent messages wake the flusher"""
+        with self.lock:
+            self.log.write(html)
+            self.pending = True
+        if urgent:
+            self.wakeup.set()
+
+    def _flusher(self):
+        """background thread that periodically flushes the log"""
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Update the portal log document if messages are pending.
+
+        Plone documents can only be replaced as a whole so all messages
+        buffered since the last update are sent with a single edit.
+        """
+        with self.sending:
+            with self.lock:
+                if not self.pending:
+                    return
+                text = self.log.getvalue()
+                self.pending = False
+            try:
+                self.site.editDocument(text, self.logdoc)
+            except Exception:
+                self.logger.exception('unable to update portal run log')
+                with self.lock:
+                    self.pending = True
+
+    def close(self):
+        """stop the background thread and flush remaining messages"""
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join(2 * self.interval)
+        self.flush()
+
     def h(self, s):
         self.logger.info('>>> '+s)
-        self.log.write('<h2 class="runlog">'+s+'</h2>\n')
-        self.site.editDocument(self.log, self.logdoc)
+        self._write('<h2 class="runlog">'+s+'</h2>\n', urgent=True)
 
     def p(self, s):
         self.logger.info(s)
-        self.log.write('<p class="runlog">'+s+'</p>\n')
-        self.site.editDocument(self.log, self.logdoc)
+        self._write('<p class="runlog">'+s+'</p>\n')
 
     def warn(self, s):
         self.logger.warn(s)
-        self.log.write('<h2 class="runlog-warn">Warning</h2>\n')
-        self.log.write('<p class="runlog-warn">' + s + '</p>\n')
-        self.site.editDocument(self.log, self.logdoc)
+        self._write('<h2 class="runlog-warn">Warning</h2>\n'
+                    '<p class="runlog-warn">' + s + '</p>\n')
 
     def error(self, s):
         self.logger.error(s)
-        self.log.write('<h2 class="runlog-err">Error Detected</h2>\n')
-        self.log.write('<p class="runlog-err">' + s + '</p>\n')
-        self.site.editDocument(self.log, self.logdoc)
+        self._write('<h2 class="runlog-err">Error Detected</h2>\n'
+                    '<p class="runlog-err">' + s + '</p>\n', urgent=True)
 
     def exception(self, s):
          self.logger.exception(s)
@@ -254,11 +337,17 @@ def interpolate(start, end):
     return results
 
 
-def getProjectionTimeSeries(proj, **kwargs):
+def getProjectionTimeSeries(proj, mode='growth', path='.', **kwargs):
     """Extract time series model results and store within the portal.
 
+    When NumPy is available the series are computed directly from the
+    GLUC output maps using getBILTimeSeries, otherwise the GRASS layers
+    created by gluc.make are scanned with getPerCellChange.
+
     Args:
       proj (dict): projection values
+      mode (str): gluc.make mode used for the run (growth, decline)
+      path (str): directory containing the gluc tree used for the run
       kwargs (dict): overrides proj values
 
     Returns: 
@@ -270,6 +359,11 @@ def getProjectionTimeSeries(proj, **kwargs):
     runlog.debug('getProjectionTimeSeries: %s, %s-%s' \
                  % (projid, startyear, endyear))
 
+    if numpy is not None:
+        return getBILTimeSeries(mode, start=startyear, end=endyear,
+            mapdir=os.path.join(path, 'gluc', 'DriverOutput', 'Maps'),
+            datadir=os.path.join(path, 'gluc', 'Data'))
+
     pop = getPerCellChange(projid+'_ppcell', projid+'_year', 
                            start=startyear, end=endyear)
     emp = getPerCellChange(projid+'_empcell', projid+'_year', 
@@ -277,7 +371,8 @@ def getProjectionTimeSeries(proj, **kwargs):
     return (pop, emp)
     
 
-def processDriverSets(dslist, prefix='', year='year'):
+def processDriverSets(dslist, prefix='', year='year', procs=None,
+                      scores=False):
     """ Process each Driver Set and generate corresponding probmap.
 
     GRASS:
@@ -288,6 +383,8 @@ def processDriverSets(dslist, prefix='', year='year'):
       dslist (list): a sequence of Driver Sets 
       prefix (str): prefixed to the probmaps filename
       year (str): key used to ensure Driver Sets are sorted
+      procs (int): number of make targets run concurrently
+      scores (bool): keep the layers needed to re-weight the probmaps
         
     Returns:
       str: the year of the earliest Driver Set
@@ -317,8 +414,18 @@ def processDriverSets(dslist, prefix='', year='year'):
         getNoGrowthLayers(drivers.get('nogrowth', []))
         grass.mapcalc('zero=0', quiet=True)
 
-        # attempts to download the cached probmap first
-        pmaps = get_rasters(drivers['download'])
+        # attempts to use the local cache first, then the probmap cached
+        # on the portal, and finally builds the probmaps
+        key = probmapKey(drivers)
+        pmaps = cache.get(key) if key else None
+        if pmaps:
+            runlog.debug('local probmap cache hit: ' + key)
+        else:
+            pmaps = get_rasters(drivers['download'])
+            if key and pmaps and all(p.endswith('.gtif') for p in pmaps):
+                cache.put(key, pmaps)
+
+        written = False
         if pmaps:
             for p in pmaps:
                 runlog.debug('cached probmap found: ' + p)
@@ -326,14 +433,17 @@ def processDriverSets(dslist, prefix='', year='year'):
 
         else:
             try:
-                buildProbmaps(drivers)
-                cacheProbmaps(drivers)
+                written = buildProbmaps(drivers, procs=procs,
+                    bils=probmapNames(prefix, drivers.get('year', '')),
+                    scores=scores)
+                cacheProbmaps(drivers, key=key)
             except Exception as e:
                 runlog.error('Unrecoverable error building probmap.')
                 runlog.exception('buildProbmaps failed')
                 sys.exit(4)
 
-        writeProbmaps(prefix, drivers.get('year', ''))
+        if not written:
+            writeProbmaps(prefix, drivers.get('year', ''))
 
         # return the startyear based on the first Driver Set
         return dslist[0][year]
@@ -393,13 +503,91 @@ def filter_regional_projection(projections, extent='county@PERMANENT'):
     return (subregional, regional)
 
 
+def indexZones(projections):
+    """Label the zones of the subregional projections in a single raster.
+
+    Each boundary is imported by getLayerMask, which rasterizes it into
+    the zone index, and the zones are labelled in projection order, so
+    the label raster is written once rather than accumulated per
+    projection.  Zones sharing cells are reported, the cells belong to
+    the later projection.  Without NumPy processProjections accumulates
+    the zones instead.
+
+    Args:
+      projections (list): growth and decline projections in the order
+        they are processed
+    """
+    if zoneindex is None:
+        return
+
+    titles = {}
+    for proj in projections:
+        boundary = proj.setdefault('boundary', getLayerMask(proj['layer']))
+        titles[boundary] = proj['title']
+    keys = [proj['boundary'] for proj in projections]
+
+    overlaps = zoneindex.build(keys)
+    for key in keys:
+        z = zoneindex.zone(key)
+        runlog.debug('zone %s: label %d, %d cells, window %s' \
+                     % (key, z.label, z.cells, z.window))
+    for (first, second), cells in sorted(overlaps.items()):
+        runlog.warn('zones of %s and %s overlap (%d cells), the cells are '
+                    'assigned to %s' % (titles[first], titles[second],
+                                        cells, titles[second]))
+
+
+def exportBoundary(boundary, bilname, window=None):
+    """Write the boundary mask of a projection as a Byte BIL file.
+
+    Zones of the zone index are written directly from their mask,
+    otherwise the GRASS mask layer is exported.
+    """
+    if zoneindex is not None and boundary in zoneindex.zones:
+        zoneindex.write_bil(boundary, bilname, window)
+    else:
+        exports.export(boundary, bilname, 'Byte')
+
+
+def exportNogrowth(bilname):
+    """Write the regional nogrowth, the nogrowth layer merged with the
+    zones of the subregional projections, as a Byte BIL file.
+
+    With the zone index the union is written from the nogrowth array and
+    the label raster, without an r.mapcalc pass and export.  Null
+    nogrowth cells are null in the r.mapcalc union, such layers are
+    merged by GRASS.
+    """
+    if zoneindex is not None and zoneindex.labels is not None:
+        ng = gridio.read('nogrowth', dtype=numpy.int32)
+        if not numpy.ma.is_masked(ng):
+            zoneindex.write_union_bil(ng.filled(0), bilname)
+            return
+
+    grass.mapcalc('ng=if(nogrowth || subzones, 1, 0)')
+    exports.export('ng', bilname, 'Byte')
+    grass.run_command('g.remove', rast='ng')
+
+
 def processProjections(mode, projections, startyear, 
-                       sanity=True, zones='subzones'):
+                       sanity=True, zones='subzones', procs=None,
+                       ranks=None, margin=None):
     """Check each projection and either run, report sanity error, or defer.
 
     Each projection is processed and model is either run or a sanity error
     is generated.
 
+    Projections that pass the sanity check are prepared in their own GLUC
+    work directory and GRASS mapset so the model runs do not overwrite
+    each other and can be executed concurrently (see runProjections).
+    The results are merged in the order the projections were given so
+    later projections take precedence, as with a sequential run.
+
+    With a margin (and NumPy) each projection is run on the bounding
+    window of its zone plus margin cells rather than the whole region.
+    The GLUC inputs are cropped to the window and the results pasted
+    back into the cumulative layers at the window's offset.
+
     No Growth Zones are handled oddly. The GLUC model only allows a single
     no growth layer during runtime.  Currently no growth layers are 
     accumulated across all Driver Sets and impact all years rather than
@@ -408,7 +596,8 @@ def processProjections(mode, projections, startyear,
     Side Effects:
       A GRASS layer is created based on an accumulation of the effective
       zones of each projection.  The subzones layer will be used as a
-      nogrowth layer during the regional model projection.
+      nogrowth layer during the regional model projection.  With NumPy
+      the layer is the label raster written by indexZones.
 
       During processing each projection is checked for reasonableness. If
       this desired change is not possible given the modeling constraints
@@ -419,9 +608,15 @@ def processProjections(mode, projections, startyear,
       mode (str): the type of projections being processed (growth or decline)
       projections (list): a list of model projections of the config file
       startyear (str): determined by the earliest Driver Set
-      sanity (bool): toggle the sanity check (default=True)
+      sanity (bool or str): toggle the sanity check, 'grass' forces the
+        GRASS based check even when NumPy is available (default=True)
       zones (str, GRASS layer): a GRASS layer where effective zones are
         accumulated. (default='subzones')
+      procs (int): maximum number of concurrent model runs (default=
+        number of CPUs)
+      ranks (int): MPI ranks of each model run (see glucRanks)
+      margin (int): cells added around the zone of a windowed run, None
+        runs every projection on the whole region (default=None)
 
     Returns:
       dict: 3 items
@@ -435,9 +630,12 @@ def processProjections(mode, projections, startyear,
     deltaemp = [0 for i in xrange(100)]
 
     # initialize zones layers if one does not exist 
-    if grass.find_file(zones)['name'] == '':
+    if zoneindex is None and grass.find_file(zones)['name'] == '':
         grass.mapcalc('$z=0', z=zones)
 
+    # projections ready to be run
+    jobs = []
+
     for proj in projections:
         runlog.h('Starting Projection '+ proj['title'])
         projid = proj.setdefault('projid', grass_safe(proj['id']))
@@ -446,8 +644,10 @@ def processProjections(mode, projections, startyear,
         proj['startyear'] = startyear
         boundary = proj.setdefault('boundary', getLayerMask(proj['layer']))
 
-        # aggregate growthzone boundaries together to be used as nogrowth layer
-        grass.mapcalc('$zones=$zones+$b', b=boundary, zones=zones)
+        # aggregate growthzone boundaries together to be used as nogrowth
+        # layer, the zone index labels them all at once (see indexZones)
+        if zoneindex is None:
+            grass.mapcalc('$zones=$zones+$b', b=boundary, zones=zones)
         
         # load density maps associated with each zone
         pop_density = proj.setdefault('popdens', import_density(projid,
@@ -464,15 +664,14 @@ def processProjections(mode, projections, startyear,
             landcover = 'landcoverBase'
             nogrowth = 'nogrowth'
 
-        # reads demand graphs, writes demand.graph file and writes the 
+        # reads demand graphs and writes the projid graph file, the
+        # demand.graphs file is written to the projection work directory
         # TODO: projid graph file should be written to config file
         endyear = proj['endyear']
         ptable.years(projid, mode, startyear, endyear)
         demand = site.getURL(proj['graph']).getvalue()
         with open('gluc/Data/%s.graphs' % projid, 'w') as f:
             f.write(demand)
-        with open('gluc/Data/demand.graphs', 'w') as f:
-            f.write(demand)
         pop = getDemandGraph(demand, ['population'], start=startyear)
         emp = getDemandGraph(demand, ['employment'], start=startyear)
         if mode == 'decline':
@@ -488,10 +687,20 @@ def processProjections(mode, projections, startyear,
         # TODO: clean this mess up
         if sanity and mode == 'growth':
             runlog.debug('starting sanity check')
-            pop_insane = sanity_check(boundary, landcover, nogrowth,
-                pop_density, pop[-1], ratio=1.0)
-            emp_insane = sanity_check(boundary, landcover, nogrowth,
-                emp_density, emp[-1], ratio=1.0)
+            with profile.phase('projection/%s/sanity' % projid):
+                if sanity == 'grass' or numpy is None:
+                    if zoneindex is not None:
+                        zoneindex.write(boundary)
+                    pop_insane = sanity_check(boundary, landcover, nogrowth,
+                        pop_density, pop[-1], ratio=1.0)
+                    emp_insane = sanity_check(boundary, landcover, nogrowth,
+                        emp_density, emp[-1], ratio=1.0)
+                else:
+                    zone = zoneindex.zone(boundary) \
+                        if zoneindex is not None else boundary
+                    pop_insane, emp_insane = sanity_check_array(zone,
+                        landcover, nogrowth, [pop_density, emp_density],
+                        [pop[-1], emp[-1]], ratio=1.0)
             if pop_insane.get('msg','') or emp_insane.get('msg',''):
                 runlog.error('Projection %s failed sanity check' \
                         % proj['title'])
@@ -505,48 +714,90 @@ def processProjections(mode, projections, startyear,
         else:
             runlog.debug('skipping sanity check, mode = ' + mode)
 
+        # each projection is given its own gluc tree and GRASS mapset
+        workdir = makeWorkdir(projid)
+        mapset = TempMapset('run_' + projid)
+        data = os.path.join(workdir, 'gluc', 'Data')
+
+        # windowed runs only see the zone and its margin
+        window, params = None, None
+        if margin is not None and numpy is not None:
+            if zoneindex is not None:
+                window = zoneindex.window(boundary, margin)
+            else:
+                window = zoneWindow(boundary, margin)
+
         # write BIL files for the gluc model
         #
         # The projection density maps are also copied to pop_density and
-        # emp_density to ensure they are set correctly for post-run
-        # calculation of ppcell and empcell.
+        # emp_density in the projection mapset to ensure they are set
+        # correctly for post-run calculation of ppcell and empcell.
         #
-        # TODO: Rewrites the landcover and nogrowth maps every time to reflect
-        # the redev flag.  With the use of dynamic gluc configuration files
-        # this section can be improved.
+        # The landcover and nogrowth maps switch between two variants
+        # depending on the redev flag, exports cache the BIL files so
+        # unchanged layers are linked rather than rewritten.
         print "Writing BIL layers for model.............."
         runlog.debug('writing BIL layers for model')
-        grass.run_command('r.out.gdal', _input=boundary, 
-            output='gluc/Data/boundary.bil', _format='EHdr', _type='Byte')
-        grass.run_command('r.out.gdal', _input=landcover,
-                output='gluc/Data/landcover.bil', _format='EHdr', _type='Byte')
-        grass.run_command('r.out.gdal', _input=nogrowth,
-                output='gluc/Data/nogrowth.bil', _format='EHdr', _type='Byte')
-        grass.run_command('g.copy', rast=[pop_density,'pop_density'])
-        grass.run_command('g.copy', rast=[emp_density,'emp_density'])
-        grass.run_command('r.out.gdal', _input=pop_density,
-                output='gluc/Data/pop_density.bil',
-                _format='EHdr', _type='Float32')
-        grass.run_command('r.out.gdal', _input=emp_density,
-                output='gluc/Data/emp_density.bil',
-                _format='EHdr', _type='Float32')
-
-        # run the GLUC model
-        print "Running the GLUC model............."
+        with profile.phase('projection/%s/export' % projid):
+            exportBoundary(boundary, os.path.join(data, 'boundary.bil'),
+                           window)
+            exports.export(landcover, os.path.join(data, 'landcover.bil'),
+                           'Byte')
+            exports.export(nogrowth, os.path.join(data, 'nogrowth.bil'),
+                           'Byte')
+            grass.run_command('g.copy', rast=[pop_density,'pop_density'],
+                env=mapset.env)
+            grass.run_command('g.copy', rast=[emp_density,'emp_density'],
+                env=mapset.env)
+            exports.export(pop_density, os.path.join(data, 'pop_density.bil'),
+                           'Float32')
+            exports.export(emp_density, os.path.join(data, 'emp_density.bil'),
+                           'Float32')
+        with open(os.path.join(data, 'demand.graphs'), 'w') as f:
+            f.write(demand)
+
+        if window:
+            runlog.debug('%s window: rows %d-%d, cols %d-%d' \
+                         % ((projid,) + window))
+            done = ['boundary.bil'] if zoneindex is not None else []
+            with profile.phase('projection/%s/crop' % projid,
+                               window=list(window)):
+                params = cropWorkdir(workdir, window, done=done)
+
         writeConfig(confname=projid, prefix=mode+'_', 
-                    start=startyear, end=endyear)
-        executeModel(projid, mode, startyear)
+                    start=startyear, end=endyear,
+                    path=os.path.join(workdir, 'gluc', 'Config'),
+                    params=params)
+        jobs.append(dict(proj=proj, projid=projid, window=window,
+                         workdir=workdir, mapset=mapset))
+
+    # run the GLUC model
+    print "Running the GLUC model............."
+    with profile.phase('projections/' + mode, count=len(jobs)):
+        runProjections(mode, startyear, jobs, procs=procs, ranks=ranks)
+
+    for job in jobs:
+        proj, projid = job['proj'], job['projid']
+        with profile.phase('projection/%s/merge' % projid):
+            mergeProjection(projid, mode, startyear, job['mapset'],
+                            job['workdir'], window=job['window'])
 
         # Extract the time series change in pop and emp from the model run
         # and accumulate it for use when setting up the regional model run.
         # For decline projections the number returned should be negative.
-        pop,emp = getProjectionTimeSeries(proj, projlen=len(deltapop))
+        with profile.phase('projection/%s/timeseries' % projid):
+            pop,emp = getProjectionTimeSeries(proj, mode=mode,
+                                              path=job['workdir'],
+                                              projlen=len(deltapop))
         ptable.population(projid, mode, 'actual', pop)
         ptable.employment(projid, mode, 'actual', emp)
 
         deltapop = [sum(x) for x in zip(deltapop, repeat_last(pop))]
         deltaemp = [sum(x) for x in zip(deltaemp, repeat_last(emp))]
 
+        job['mapset'].remove()
+        shutil.rmtree(job['workdir'])
+
     return dict(startyear=startyear, deltapop=deltapop, deltaemp=deltaemp)
 
 
@@ -554,7 +805,7 @@ def writeConfig(confname='baseline.conf',
                 start='2010', end='2040',
                 prefix='', probmaps=False,
                 tmpl='gluc/Config/baseline.tmpl',
-                path='gluc/Config'):
+                path='gluc/Config', params=None):
     """ write a GLUC config file from a template.
 
     PREFIX,START_DATE, and END_DATE are replaced in the template. PREFIX
@@ -568,6 +819,7 @@ def writeConfig(confname='baseline.conf',
     @probmaps - toggle initial and final probmaps writing 
     @tmpl - name of the temlate config file
     @path - destination for 
+    @params - dict of pm() parameters replacing the template values
     @Return - nothing
     """
     runlog.debug('writeConfig: confname=%s, prefix=%s, start=%s, end=%s' % \
@@ -583,8 +835,12 @@ def writeConfig(confname='baseline.conf',
         template = f.read()
 
     d = dict(PREFIX=prefix, START_DATE=start, END_DATE=end)
+    text = template.format(**d)
+    for name, value in (params or {}).items():
+        text = re.sub(r'(?m)^(\*\s+%s\s+)pm\(.*\)$' % name,
+                      lambda m: '%spm(%s)' % (m.group(1), value), text)
     with open(config, 'w') as f:
-        f.write(template.format(**d))
+        f.write(text)
         if probmaps:
             f.write('* INITIAL_PROB_RES_MAP    M(M, 4, initial_probmap_res)\n')
             f.write('* INITIAL_PROB_COM_MAP    M(M, 4, initial_probmap_com)\n')
@@ -592,27 +848,311 @@ def writeConfig(confname='baseline.conf',
             f.write('* FINAL_PROB_COM_MAP    M(M, 4, final_probmap_com)\n')
 
 
-def executeModel(projid, mode, start):
+def glucRanks(concurrent=1, ranks=None):
+    """Number of MPI ranks used by each GLUC run.
+
+    The rank count is taken from the scenario config (gluc_ranks), the
+    LEAM_GLUC_RANKS environmental variable (set by leampoll --ranks), or
+    the CPUs divided between the concurrent model runs, in that order.
+
+    Args:
+      concurrent (int): number of GLUC runs executed at the same time
+      ranks (str or int): rank count given by the scenario config
+
+    Returns:
+      int: ranks per GLUC run (at least 1)
+    """
+    ranks = ranks or os.environ.get('LEAM_GLUC_RANKS')
+    if ranks:
+        return max(int(ranks), 1)
+    return max(multiprocessing.cpu_count() // max(concurrent, 1), 1)
+
+
+RANK_TIMING = re.compile(r'^rank (\d+) rows (\d+)-(\d+) io ([\d.]+) '
+                         r'compute ([\d.]+) wait ([\d.]+)$')
+
+def recordRankTimings(name, fname):
+    """Add the per rank timing printed by 'gluc -t' to the run profile.
+
+    Each rank is recorded as <name>/rank/<n> with the rows it was given
+    and the seconds spent reading inputs (io), running the model
+    (compute), and waiting for the other ranks to finish (wait).
+
+    Args:
+      name (str): profile phase of the model run
+      fname (str): file holding the GLUC standard output
+    """
+    try:
+        with open(fname) as f:
+            lines = f.readlines()
+    except IOError:
+        return
+
+    for line in lines:
+        m = RANK_TIMING.match(line.strip())
+        if not m:
+            continue
+        rank, first, last = [int(v) for v in m.groups()[:3]]
+        io, compute, wait = [float(v) for v in m.groups()[3:]]
+        profile.record('%s/rank/%d' % (name, rank), wall=io + compute + wait,
+                       io=io, compute=compute, wait=wait,
+                       rows=last - first + 1)
+
+
+def executeModel(projid, mode, start, ranks=None):
     """ Run the GLUC model using gluc.make.
 
     Args:
       projid (str, simple): projection identifier used in log
       mode (str): gluc.make mode (growth, decline, region)
       start (str): start year passed as variable to gluc.make
+      ranks (int): number of MPI ranks (default see glucRanks)
 
     Returns:
       None
     """
 
-    runlog.debug('executeModel: projid = ' + projid)
+    ranks = glucRanks(ranks=ranks)
+    runlog.debug('executeModel: projid = %s, ranks = %d' % (projid, ranks))
 
     start = str(start)
 
+    # with NumPy only GLUC is run by make, see glucmerge.merge
+    if numpy is not None:
+        targets = 'model'
+    else:
+        targets = mode + ' merge'
+
     try:
         with open('%s_gluc_make.out' % projid, 'w') as out, \
                 open('%s_gluc_make.log' % projid, 'w') as err:
-            cmd = 'make -f ./bin/gluc.make %s merge PROJID=%s START=%s' \
-                % (mode, projid, start)
+            cmd = 'make -f ./bin/gluc.make %s PROJID=%s START=%s NP=%d' \
+                % (targets, projid, start, ranks)
+            check_call(cmd.split(), stdout=out, stderr=err)
+
+    except subprocess.CalledProcessError: 
+        runlog.error('GLUC Model Failure')
+        runlog.exception('check %s_gluc_make.log' % projid)
+        sys.exit(5)
+
+    recordRankTimings('regional/%s/model' % projid,
+                      '%s_gluc_make.out' % projid)
+    if numpy is not None:
+        glucmerge.merge(projid, mode, start)
+
+
+def zoneWindow(layer, margin=50, rows=1024):
+    """Bounding window of the zone cells of a layer plus a margin.
+
+    Args:
+      layer (str, GRASS layer): zone mask (non-zero cells)
+      margin (int): number of cells added on each side of the zone
+      rows (int): number of rows processed at a time
+
+    Returns:
+      tuple: first row, last row + 1, first column, and last column + 1
+        within the current region, or None when the layer is empty or
+        the window covers the region
+    """
+    data = gridio.load(layer, dtype=numpy.int32)
+    nrows, ncols = data.shape
+    first, last = None, None
+    cols = numpy.zeros(ncols, dtype=bool)
+    for r in xrange(0, nrows, rows):
+        x = numpy.asarray(data[r:r + rows])
+        zone = (x != 0) & (x != gridio.NULL)
+        hit = numpy.flatnonzero(zone.any(axis=1))
+        if len(hit):
+            first = r + hit[0] if first is None else first
+            last = r + hit[-1]
+        cols |= zone.any(axis=0)
+
+    cols = numpy.flatnonzero(cols)
+    if first is None:
+        return None
+    window = (max(first - margin, 0), min(last + margin + 1, nrows),
+              max(cols[0] - margin, 0), min(cols[-1] + margin + 1, ncols))
+    if window == (0, nrows, 0, ncols):
+        return None
+    return tuple(int(v) for v in window)
+
+
+def cropWorkdir(workdir, window, done=()):
+    """Crop the GLUC inputs of a work directory to a window.
+
+    Every BIL file of the Data directory, including the links to the
+    shared probability maps, is replaced by the window.
+
+    Args:
+      workdir (str): work directory created by makeWorkdir
+      window (tuple): see zoneWindow
+      done (list): BIL files already written for the window
+
+    Returns:
+      dict: XLLCORNER and YLLCORNER of the window for writeConfig
+    """
+    data = os.path.join(workdir, 'gluc', 'Data')
+    for fname in sorted(iglob(os.path.join(data, '*.bil'))):
+        if os.path.basename(fname) not in done:
+            bil.crop(fname, window)
+
+    r0, r1, c0, c1 = window
+    region = grass.region()
+    return dict(XLLCORNER=region['w'] + c0 * region['ewres'],
+                YLLCORNER=region['s'] + (region['rows'] - r1) * region['nsres'])
+
+
+def makeWorkdir(projid, root='runs'):
+    """Create a private GLUC directory tree for a single projection.
+
+    The Data directory is populated with links to the shared model inputs
+    (probability maps, floodplain, etc.).  The per projection inputs
+    (boundary, landcover, nogrowth, densities, and demand.graphs) and the
+    config file are written into the tree by the caller.  A link to bin
+    allows gluc.make to be run from within the work directory.
+
+    Args:
+      projid (str): projection identifier used as directory name
+      root (str): directory holding all work directories
+
+    Returns:
+      str: path to the work directory
+    """
+    private = ('boundary', 'landcover', 'nogrowth', 'pop_density',
+               'emp_density', 'demand')
+
+    workdir = os.path.join(root, projid)
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    for d in ('Config', 'Data', os.path.join('DriverOutput', 'Maps')):
+        os.makedirs(os.path.join(workdir, 'gluc', d))
+    os.symlink(os.path.abspath('bin'), os.path.join(workdir, 'bin'))
+
+    data = os.path.join('gluc', 'Data')
+    for fname in os.listdir(data):
+        if fname.split('.')[0] not in private:
+            os.symlink(os.path.abspath(os.path.join(data, fname)),
+                       os.path.join(workdir, data, fname))
+
+    return workdir
+
+
+def _runProjection(args):
+    """Run gluc.make for a single projection within its work directory.
+
+    Called from the runProjections process pool so the runlog and site
+    must not be used.
+
+    Returns:
+      tuple: projid, make return code, elapsed seconds, and the rusage
+        of make and its children
+    """
+    projid, mode, start, workdir, env, ranks = args
+
+    started = time.time()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open('%s_gluc_make.out' % projid, 'w') as out, \
+            open('%s_gluc_make.log' % projid, 'w') as err:
+        cmd = 'make -f ./bin/gluc.make %s PROJID=%s START=%s NP=%d' \
+            % (mode, projid, start, ranks)
+        rc = call(cmd.split(), cwd=workdir, env=env, stdout=out, stderr=err)
+
+    # pool workers are reused so the child usage is taken as a delta,
+    # the peak RSS is the high-water mark of the worker's children
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+    return projid, rc, time.time() - started, (cpu, after.ru_maxrss)
+
+
+def runProjections(mode, start, jobs, procs=None, ranks=None):
+    """Run the GLUC model for several projections concurrently.
+
+    Each job must provide a work directory created by makeWorkdir and a
+    TempMapset.  Without NumPy the results are left in the job's mapset
+    as <projid>_change, _summary, _ppcell, _hhcell, _empcell, and _year,
+    otherwise only the GLUC outputs in the work directory are created.
+
+    Args:
+      mode (str): gluc.make mode (growth, decline)
+      start (str): start year passed as variable to gluc.make
+      jobs (list of dict): projid, workdir, and mapset of each projection
+      procs (int): maximum number of concurrent runs (default=number
+        of CPUs)
+      ranks (int): MPI ranks of each run (default=CPUs shared between
+        the concurrent runs, see glucRanks)
+
+    Returns:
+      None
+    """
+    if not jobs:
+        return
+
+    procs = min(procs or multiprocessing.cpu_count(), len(jobs))
+    ranks = glucRanks(procs, ranks)
+    runlog.debug('runProjections: %d projections using %d processes, '
+                 '%d ranks each' % (len(jobs), procs, ranks))
+
+    # with NumPy only GLUC is run by make, see mergeProjection
+    target = 'model' if numpy is not None else mode
+    args = [(j['projid'], target, str(start), j['workdir'], j['mapset'].env,
+             ranks) for j in jobs]
+    failed = []
+    pool = multiprocessing.Pool(procs)
+    try:
+        for projid, rc, elapsed, usage in \
+                pool.imap_unordered(_runProjection, args):
+            runlog.debug('executeModel: projid = %s, rc = %d, %.1fs' \
+                         % (projid, rc, elapsed))
+            profile.record('projection/%s/model' % projid, wall=elapsed,
+                           child_cpu=usage[0], child_maxrss=usage[1],
+                           ranks=ranks, failed=bool(rc))
+            recordRankTimings('projection/%s/model' % projid,
+                              '%s_gluc_make.out' % projid)
+            if rc:
+                failed.append(projid)
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        runlog.error('GLUC Model Failure')
+        for projid in failed:
+            runlog.error('check %s_gluc_make.log' % projid)
+        sys.exit(5)
+
+
+def mergeProjection(projid, mode, start, mapset, path, window=None):
+    """Merge the results of a projection into the model result layers.
+
+    With NumPy the GLUC outputs are processed directly by glucmerge,
+    otherwise the projection layers are copied from the projection
+    mapset and merged using 'gluc.make merge'.
+
+    Args:
+      projid (str, simple): projection identifier
+      mode (str): gluc.make mode (growth, decline)
+      start (str): start year passed as variable to gluc.make
+      mapset (TempMapset): mapset used by the projection run
+      path (str): work directory used by the projection run
+      window (tuple): window of a windowed run (see zoneWindow)
+    """
+
+    runlog.debug('mergeProjection: projid = ' + projid)
+
+    if numpy is not None:
+        glucmerge.merge(projid, mode, start, path=path, window=window)
+        return
+
+    for suffix in ('change', 'summary', 'ppcell', 'hhcell', 'empcell', 'year'):
+        layer = '%s_%s' % (projid, suffix)
+        grass.run_command('g.copy', rast=[mapset.layer(layer), layer],
+                          quiet=True)
+
+    try:
+        with open('%s_gluc_make.out' % projid, 'a') as out, \
+                open('%s_gluc_make.log' % projid, 'a') as err:
+            cmd = 'make -f ./bin/gluc.make merge PROJID=%s START=%s' \
+                % (projid, start)
             check_call(cmd.split(), stdout=out, stderr=err)
 
     except subprocess.CalledProcessError: 
@@ -885,6 +1425,65 @@ def getPerCellChange(percell, time, start, end=None, mult=1000000.0):
     # always return the delta based on 'start'
     return [ts[i]-ts[start] for i in range(start,end+1)]
 
+def getBILTimeSeries(mode, start, end=None, rows=512,
+                     mapdir='gluc/DriverOutput/Maps', datadir='gluc/Data'):
+    """Compute the accumulated pop and emp change from the GLUC outputs.
+
+    Memory-maps the change and summary maps written by GLUC along with
+    the density maps used for the run and sums the per cell change for
+    each year with a weighted bincount.  Equivalent to getPerCellChange
+    on the <projid>_ppcell/_empcell and <projid>_year layers created by
+    gluc.make without creating temporary rasters or rounding the
+    densities to fixed-point.
+
+    Args:
+      mode (str): 'decline' returns negative changes
+      start (int): first year of requested time series
+      end (int): last year of requested time series, inclusive (default=
+        last year of change found in the summary map)
+      rows (int): number of rows processed at a time
+      mapdir (str): directory containing change.bil and summary.bil
+      datadir (str): directory containing pop_density.bil and
+        emp_density.bil
+
+    Returns:
+      (tuple): population and employment lists of floats, accumulated
+        change from start to end inclusive
+    """
+    change = bil.open_bil(os.path.join(mapdir, 'change.bil'))
+    summary = bil.open_bil(os.path.join(mapdir, 'summary.bil'))
+    densities = []
+    for name in ('pop_density.bil', 'emp_density.bil'):
+        fname = os.path.join(datadir, name)
+        densities.append((bil.open_bil(fname), bil.read_header(fname)))
+
+    # the summary map holds the number of years after start
+    nyears = int(summary.max()) + 1
+    totals = [numpy.zeros(nyears), numpy.zeros(nyears)]
+    for r in xrange(0, summary.shape[0], rows):
+        s = summary[r:r+rows].ravel().astype(numpy.intp)
+        c = change[r:r+rows].ravel()
+        for total, lu, (den, hdr) in zip(totals, (21, 23), densities):
+            d = den[r:r+rows].ravel()
+            w = numpy.where((c == lu) & bil.valid(d, hdr), d, 0.0)
+            total += numpy.bincount(s, weights=w, minlength=nyears)
+
+    if end == None:
+        end = start + nyears - 1
+    sign = -1.0 if mode == 'decline' else 1.0
+
+    # year 0 (summary == 0) is unchanged, the series is a delta on start
+    n = max(end - start + 1, 0)
+    series = []
+    for total in totals:
+        ts = numpy.zeros(n)
+        ts[:min(n, nyears)] = total[:n]
+        ts[:1] = 0.0
+        series.append([sign * float(x) for x in numpy.cumsum(ts)])
+
+    return tuple(series)
+
+
 def check_extent(layer, parent):
 
     parent = grass.parse_command('v.info', flags='g', map=parent)
@@ -982,6 +1581,113 @@ def sanity_check(boundary, landcover, nogrowth, density, demand, ratio=0.8):
 
     return stats 
 
+def sanity_check_array(boundary, landcover, nogrowth, densities, demands,
+                       ratio=0.8):
+    """Perform the sanity check for several densities in a single pass.
+
+    Equivalent to calling sanity_check once for each density but the
+    boundary, landcover, nogrowth and density layers are each read only
+    once as NumPy arrays and no temporary GRASS layers are created.
+    Null cells are masked so the counts and sums match r.univar.
+
+    Args:
+      boundary (str or Zone): effective zone mask, for a Zone of the
+        zone index only the cells of its window are examined
+      landcover (str): landcover layer
+      nogrowth (str): nogrowth layer
+      densities (list of str): density layers (typically pop and emp)
+      demands (list of float): demand associated with each density
+      ratio (float): fraction of the potential available for development
+
+    Returns:
+      list of dict: stats for each density as returned by sanity_check
+    """
+
+    results = [{ 'ratio': ratio, 'demand': d } for d in demands]
+    pending = [s for s in results if s['demand'] > 0.0]
+    if len(pending) < len(results):
+        runlog.debug('sanity_check: demand <= 0, should this be an error?')
+    if not pending:
+        return results
+
+    # null cells never satisfy a condition (as in r.mapcalc)
+    if isinstance(boundary, basestring):
+        window = Ellipsis
+        b = gridio.read(boundary, dtype=numpy.int32)
+        bsum = int(b.sum(dtype=numpy.int64) or 0)
+        b = b.filled(0) != 0
+    else:
+        r0, r1, c0, c1 = boundary.window or (0, 0, 0, 0)
+        window = (slice(r0, r1), slice(c0, c1))
+        b = boundary.mask()
+        bsum = boundary.cells
+    lu = gridio.read(landcover, dtype=numpy.int32)[window].filled(0)
+    ng = gridio.read(nogrowth, dtype=numpy.int32)[window]
+    ngnull = numpy.ma.getmaskarray(ng)
+    ng = ng.filled(0)
+
+    counts = dict(
+        boundary = bsum,
+        landcover = int(numpy.count_nonzero(b & (lu > 29) & (lu < 90))),
+        nogrowth = int(numpy.count_nonzero(b & (ng != 0))),
+        )
+    developable = b & (lu > 25) & (lu < 90) & (ng == 0) & ~ngnull
+    counts['developable'] = int(numpy.count_nonzero(developable))
+    del b, lu, ng, ngnull
+
+    for density, stats in zip(densities, results):
+        if not stats['demand'] > 0.0:
+            continue
+
+        # replicate the order of the checks in sanity_check
+        stats['boundary'] = counts['boundary']
+        if stats['boundary'] < 1:
+            runlog.debug('sanity_check: boundary failure')
+            stats['fail'] = 'boundary'
+            stats['msg'] = 'boundary out of the study region or malformed'
+            continue
+
+        stats['landcover'] = counts['landcover']
+        if stats['landcover'] < 1:
+            runlog.debug('sanity_check: landcover failure')
+            stats['fail'] = 'landcover'
+            stats['msg'] = str('no appropriate landcover cells (perhaps '
+                'the redevelopment flag is set in correctly)')
+            continue
+
+        stats['nogrowth'] = counts['nogrowth']
+        if stats['nogrowth'] == stats['boundary']:
+            runlog.debug('sanity_check: nogrowth failure')
+            stats['fail'] = 'nogrowth'
+            stats['msg'] = str('nogrowth layers overlaps effective zone'
+                'inhibiting development)')
+            continue
+
+        stats['developable'] = counts['developable']
+        if stats['developable'] < 1:
+            runlog.debug('sanity_check: developable failure')
+            stats['fail'] = 'developable'
+            stats['msg'] = str('no developable cells available (some '
+                'interaction of zone, landcover, and nogrowth)')
+            continue
+
+        d = gridio.read(density, dtype=numpy.float64)[window]
+        d = d[developable].compressed()
+        stats['potential'] = float(d.sum()) if d.size else 0.0
+        if stats['demand'] > ratio * stats['potential']:
+            runlog.debug('sanity_check: potential failure')
+            stats['fail'] = 'potential'
+            stats['msg'] = 'demand exceeds max potential development'
+        elif d.size:
+            stats['mean'] = str(d.mean())
+            stats['maximum'] = str(d.max())
+            stats['minimum'] = str(d.min())
+        else:
+            stats['mean'] = stats['maximum'] = stats['minimum'] = 'nan'
+
+    return results
+
+
 def sanity_report(f, title, stats):
     """Writes the results of the sanity check.  Popsane and empsane are
     the results of a r.univar run against the boundary and density maps
@@ -1059,7 +1765,12 @@ def getLayerAttr(url, attr, null='0'):
 
 
 def getLayerMask(url):
-    """Get a single shapefile and convert it into a raster mask.  """
+    """Get a single shapefile and convert it into a raster mask.
+
+    With the zone index the zone is rasterized into the index (see
+    ZoneLabels) rather than into a GRASS raster of its own.  The vector
+    layer is imported in both cases.
+    """
 
     runlog.debug('getLayerMask: ' + url)
 
@@ -1067,12 +1778,15 @@ def getLayerMask(url):
         shapefile = get_shapefile(url)
         layer = import_vectormap(shapefile)
     
-        grass.run_command('v.to.rast', input=layer, output=layer, 
-                use='val', value='1', quiet=True, overwrite=True)
-        grass.run_command('r.null', map=layer, null='0', quiet=True)
+        if zoneindex is not None:
+            zoneindex.add(layer, shapefile)
+        else:
+            grass.run_command('v.to.rast', input=layer, output=layer, 
+                    use='val', value='1', quiet=True, overwrite=True)
+            grass.run_command('r.null', map=layer, null='0', quiet=True)
     except:
-        runlog.error('Error getting effective zone: ' + proj['layer'])
-        runlog.exception('getLayerMask failed: ' + proj['layer'])
+        runlog.error('Error getting effective zone: ' + url)
+        runlog.exception('getLayerMask failed: ' + url)
         sys.exit(3)
 
     return layer
@@ -1186,9 +1900,157 @@ def getStartingResults(url):
         shell=True)
 
 
-def cacheProbmaps(drivers):
+def probmapKey(drivers):
+    """Compute the local cache key for the probmaps of a Driver Set.
+
+    The key covers the content of each driver download used to build the
+    probmaps, the GRASS location and region, along with the SFA curves
+    and the make files (including the weights) so any change to the
+    inputs results in a rebuild.
+
+    Returns:
+      str: the key, None when a driver cannot be downloaded (the
+        probmaps are not cached)
+    """
+    h = Hasher('probmaps')
+
+    def listof(v):
+        if not v:
+            return []
+        return [v] if isinstance(v, basestring) else list(v)
+
+    urls = [
+        ('landuse', drivers.get('landuse')),
+        ('dem', drivers.get('dem')),
+        ('tdm', drivers.get('tdm')),
+        ('empcenters', (drivers.get('empcenters') or {}).get('empcenter')),
+        ('popcenters', (drivers.get('popcenters') or {}).get('popcenter')),
+        ]
+    urls += [('specials', u) for u in listof(drivers.get('specials'))]
+    urls += [('nogrowth', u) for u in listof(drivers.get('nogrowth'))]
+
+    for name, url in urls:
+        try:
+            data = site.getURL(url).getvalue() if url else ''
+        except Exception:
+            runlog.warn('unable to download %s, probmaps not cached' % name)
+            return None
+        h.update(name, data)
+
+    h.update('location', grass.gisenv()['LOCATION_NAME'])
+    h.update('region', grass.read_command('g.region', flags='g'))
+
+    for fname in sorted(iglob('SFA/*')):
+        h.update_file(fname)
+    for fname in ('bin/attmaps.make', 'bin/probmaps.make', 'bin/cities.py',
+                  'bin/costdist.py', 'bin/distance.py', 'bin/sfa.py',
+                  'bin/probmap.py'):
+        h.update_file(fname)
+
+    return h.hexdigest()
+
+
+# layers derived from the road network and centers that are kept in the
+# local cache as (layer, GDAL type), cities_att and emp_att are the
+# attractors cities.py computes from the travel time surfaces
+TRAVELTIME_LAYERS = [
+    ('overlandTravelTime30', 'Float64'),
+    ('intTravelTime30', 'Float64'),
+    ('cross', 'Int32'),
+    ('cities_att', 'Float64'),
+    ('emp_att', 'Float64'),
+    ]
+
+
+def traveltimeKey(drivers):
+    """Compute the local cache key for the travel time surfaces.
+
+    The key covers the road network (tdm), the population and employment
+    centers, the landuse and study area the overland speeds are derived
+    from, lu_speeds.recode, the region, and the scripts and make file
+    that build the surfaces (including the cities.py max travel time).
+
+    Returns:
+      str: the key, None when a driver cannot be downloaded (the
+        surfaces are not cached)
+    """
+    h = Hasher('traveltime')
+
+    urls = [
+        ('landuse', drivers.get('landuse')),
+        ('tdm', drivers.get('tdm')),
+        ('empcenters', (drivers.get('empcenters') or {}).get('empcenter')),
+        ('popcenters', (drivers.get('popcenters') or {}).get('popcenter')),
+        ]
+    for name, url in urls:
+        try:
+            data = site.getURL(url).getvalue() if url else ''
+        except Exception:
+            runlog.warn('unable to download %s, travel times not cached'
+                        % name)
+            return None
+        h.update(name, data)
+
+    h.update('region', grass.read_command('g.region', flags='g'))
+    d = grass.find_file('county', element='cell')
+    if d['name']:
+        mapset = os.path.dirname(os.path.dirname(d['file']))
+        for element in ('cellhd', 'cell', 'fcell'):
+            h.update_file(os.path.join(mapset, element, d['name']),
+                          name='county/' + element)
+
+    h.update_file('SFA/lu_speeds.recode')
+    for fname in ('bin/attmaps.make', 'bin/cities.py', 'bin/costdist.py'):
+        h.update_file(fname)
+
+    return h.hexdigest()
+
+
+def getTravelTimes(key, directory='traveltime'):
+    """Import the travel time surfaces from the local cache.
+
+    Returns:
+      list: names of the layers imported, empty on a miss
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if not cache.get(key, directory):
+        return []
+
+    layers = []
+    for layer, gtype in TRAVELTIME_LAYERS:
+        fname = os.path.join(directory, layer + '.gtif')
+        if not os.path.exists(fname) or grass.run_command('r.in.gdal',
+                flags='o', input=fname, output=layer, overwrite=True,
+                quiet=True):
+            runlog.warn('travel time cache entry incomplete: ' + layer)
+            return []
+        layers.append(layer)
+    return layers
+
+
+def cacheTravelTimes(key, directory='traveltime'):
+    """store the travel time surfaces in the local cache"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    try:
+        fnames = []
+        for layer, gtype in TRAVELTIME_LAYERS:
+            fname = os.path.join(directory, layer + '.gtif')
+            if grass.run_command('r.out.gdal', input=layer, output=fname,
+                                 type=gtype, quiet=True):
+                raise RuntimeError('unable to export ' + layer)
+            fnames.append(fname)
+        cache.put(key, fnames)
+    except Exception:
+        runlog.warn('Failed Caching Travel Times Locally')
+
+
+def cacheProbmaps(drivers, key=None):
     """Write the probability maps and uploads them to the Plone site
-    for future use.
+    for future use.  If a key is provided the probability maps are also
+    stored in the local cache.
     """
     runlog.debug('caching probmaps for %s' % drivers['title'])
 
@@ -1196,6 +2058,12 @@ def cacheProbmaps(drivers):
                       output='probmap_res.gtif', _type='Float32')
     grass.run_command('r.out.gdal', _input='probmap_com', 
                       output='probmap_com.gtif', _type='Float32')
+    if key:
+        try:
+            cache.put(key, ['probmap_res.gtif', 'probmap_com.gtif'])
+        except Exception:
+            runlog.warn('Failed Caching Probmaps Locally')
+
     try:
         cmd = 'zip probmaps.zip probmap_res.gtif probmap_com.gtif'
         check_call(cmd.split())
@@ -1204,8 +2072,16 @@ def cacheProbmaps(drivers):
         runlog.warn('Failed Caching Probmaps')
 
 
-def buildProbmaps(drivers):
+def buildProbmaps(drivers, procs=None, bils=None, scores=False):
     """Builds a pair of probability maps based on given driver set.
+
+    With numpy the probmaps are composed in a single pass (probmap.py)
+    and written directly to the <bils> files.  With <scores> the layers
+    needed to re-weight the probmaps are kept in reweight/<dset_id> (see
+    reweight.py).
+
+    Returns:
+      bool: True if the <bils> files were written
     """
     
     runlog.debug('build probmaps for %s' % drivers['title'])
@@ -1287,18 +2163,72 @@ def buildProbmaps(drivers):
     # build attractor maps and probability maps
     print "Building attractor maps..............\n"
     runlog.debug('running attmaps.make')
-    with open('%s_attmaps.log' % dset_id, 'wb') as log:
-        cmd = 'make -f bin/attmaps.make attmaps'
-        check_call(cmd.split(), stdout=log, stderr=subprocess.STDOUT)
+    # the travel time surfaces and the cities and employment attractors
+    # are imported from the local cache when the network is unchanged
+    key = traveltimeKey(drivers)
+    built = getTravelTimes(key) if key else []
+    if built:
+        runlog.debug('local travel time cache hit: ' + key)
+    runTargets(dset_id, 'attmaps', 'bin/attmaps.make', ['attmaps'], procs,
+               built=built)
+    if key and not built:
+        cacheTravelTimes(key)
             
     # create special drivers
     runlog.debug('importing special drivers')
     getSpecialDrivers(drivers.get('specials', []))
 
+    if numpy is not None:
+        runlog.debug('composing probmaps')
+        with profile.phase('driversets/%s/probmaps' % dset_id):
+            probmap.compose(probmap.settings('bin/probmaps.make'), bils=bils)
+        if scores:
+            runlog.debug('saving re-weighting layers for %s' % dset_id)
+            with profile.phase('driversets/%s/scores' % dset_id):
+                reweight.ScoreCache(dset_id).save()
+        return bool(bils)
+
     runlog.debug('running probmaps.make')
-    with open('%s_probmaps.log' % dset_id, 'wb') as log:
-        cmd = 'make -f bin/probmaps.make'
-        check_call(cmd.split(), stdout=log, stderr=subprocess.STDOUT)
+    runTargets(dset_id, 'probmaps', 'bin/probmaps.make', [], procs)
+    return False
+
+
+def runTargets(dset_id, name, makefile, goals, procs=None, built=()):
+    """Build makefile goals with independent targets run concurrently,
+    each in its own temporary mapset (see makesched.py).
+
+    Per-target durations are added to the run profile and the slowest
+    targets are logged.
+
+    Args:
+      dset_id (str): driver set identifier used to name the log file
+      name (str): phase name
+      makefile (str): GRASS makefile
+      goals (list): targets to build (default first target)
+      procs (int): maximum concurrent targets (default CPU count)
+      built (list): targets already present in the mapset
+    """
+    phase = 'driversets/%s/%s' % (dset_id, name)
+    with open('%s_%s.log' % (dset_id, name), 'wb') as log, \
+            profile.phase(phase):
+        times = makesched.run(makefile, goals, jobs=procs, log=log,
+                              built=built)
+        for target, start, elapsed in times:
+            profile.record('%s/%s' % (phase, target), start=start,
+                           wall=elapsed)
+
+    slowest = sorted(times, key=itemgetter(2), reverse=True)[:5]
+    runlog.debug('%s slowest targets: %s' % (name, ', '.join(
+                 '%s %.1fs' % (t[0], t[2]) for t in slowest)))
+
+
+def probmapNames(prefix, year, directory='gluc/Data'):
+    """return the res and com probmap BIL files used by the LUC model"""
+    if prefix: prefix += '_'
+    if year: year = '_' + year
+
+    return (os.path.join(directory, '%sprobmap_res%s.bil' % (prefix, year)),
+            os.path.join(directory, '%sprobmap_com%s.bil' % (prefix, year)))
 
 
 def writeProbmaps(prefix, year, directory='gluc/Data'):
@@ -1307,11 +2237,7 @@ def writeProbmaps(prefix, year, directory='gluc/Data'):
     """
     runlog.debug('writing probmaps for %s' % year)
 
-    if prefix: prefix += '_'
-    if year: year = '_' + year
-
-    resmap = os.path.join(directory, '%sprobmap_res%s.bil' % (prefix, year))
-    commap = os.path.join(directory, '%sprobmap_com%s.bil' % (prefix, year))
+    resmap, commap = probmapNames(prefix, year, directory)
 
     grass.run_command('r.out.gdal', quiet=True, input='probmap_res',
             output=resmap, format='EHdr', type='Float32')
@@ -1397,7 +2323,7 @@ def publishResults(dest):
     site.putFileURL('model_results.zip', dest, title='Model Results')
 
 
-def get_location(uri, user, password, fname='grass.zip'):
+def get_location(uri, user, password, fname='grass.zip', staged=None):
     """get the empty GRASS location
 
     Args:
@@ -1405,16 +2331,22 @@ def get_location(uri, user, password, fname='grass.zip'):
       user (str): portal user
       password (str): portal password
       fname (str): tmp name for the GRASS location
+      staged (dict): files downloaded by the prefetch stage
     """
 
-    r = requests.get(uri, auth=(user, password), stream=True)
-    r.raise_for_status()
+    if staged and uri in staged:
+        fname, ctype = staged[uri]
 
-    with open(fname, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024*1024):
-            f.write(chunk)
+    else:
+        r = requests.get(uri, auth=(user, password), stream=True)
+        r.raise_for_status()
 
-    if r.headers.get('content-type').startswith('application/zip'):
+        with open(fname, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                f.write(chunk)
+        ctype = r.headers.get('content-type')
+
+    if ctype.startswith('application/zip'):
         with open(os.devnull, 'wb') as FNULL:
             check_call(['unzip', '-o', fname], 
                         stdout=FNULL, stderr=subprocess.STDOUT)
@@ -1455,6 +2387,11 @@ def main():
 
     jobstart = time.asctime()
 
+    # phase timing, written even when the run terminates early
+    global profile
+    profile = Profile()
+    atexit.register(profile.write)
+
     os.environ['PATH'] = ':'.join(['./bin', os.environ.get('BIN', '.'),
                                    '/bin', '/usr/bin'])
 
@@ -1472,6 +2409,21 @@ def main():
         help='Portal user name (or PORTAL_USER environmental var)')
     parser.add_option('-X', '--password', default=None,
         help='Portal password (or PORTAL_PASSWORD environmental var)')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+        help='number of projections or make targets run concurrently '
+             '(default=CPU count)')
+    parser.add_option('-f', '--fetch', type='int', default=8,
+        help='number of concurrent downloads during prefetch, 0 disables '
+             'the prefetch stage (default=8)')
+    parser.add_option('-w', '--window', type='int', default=None,
+        metavar='CELLS',
+        help='run subregional projections on the bounding window of '
+             'their zone plus CELLS on each side (requires NumPy)')
+    parser.add_option('--profile', default=False, action='store_true',
+        help='post the run profile (profile.json) with the results')
+    parser.add_option('--scores', default=False, action='store_true',
+        help='keep the Driver Set layers used to re-weight the probmaps '
+             '(see bin/reweight.py)')
 
     (options, args) = parser.parse_args()
 
@@ -1490,8 +2442,9 @@ def main():
 
     # parse the configuration file
     print "Parsing configuration file.............\n"
-    config = get_config(options.config, user, password)
-    luc = LUC(config)
+    with profile.phase('config'):
+        config = get_config(options.config, user, password)
+        luc = LUC(config)
 
     # grab some useful values from the config file
     # title = human-readable name of the scenario
@@ -1500,10 +2453,21 @@ def main():
     title = luc.scenario['title']
     scenario = luc.scenario['id']
     resultsdir = luc.scenario['results']
+    ranks = luc.scenario.get('gluc_ranks')
+
+    # download driver set and projection assets concurrently
+    staged, failed = {}, {}
+    if options.fetch > 0:
+        print "Prefetching model inputs.............\n"
+        with profile.phase('prefetch'):
+            staged, failed = prefetch(config_urls(luc), (user, password),
+                                      threads=options.fetch)
 
     # setup the GRASS environment
     print "Setting up GRASS environment.............\n"
-    get_location(luc.scenario['grass_loc'], user, password)
+    with profile.phase('get_location'):
+        get_location(luc.scenario['grass_loc'], user, password,
+                     staged=staged)
     grass_config('grass', 'model')
 
     # conection to the portal 
@@ -1511,35 +2475,65 @@ def main():
     site = LEAMsite(resultsdir, user=user, passwd=password)
 
     # create model run log file on the site that is updated dynamically
+    # (the run log uses its own connection as it is updated from a thread)
     global runlog
-    runlog = RunLog(resultsdir, site, initmsg='Scenario ' + title)
+    logsite = LEAMsite(resultsdir, user=user, passwd=password)
+    runlog = RunLog(resultsdir, logsite, initmsg='Scenario ' + title)
     runlog.p('started at '+jobstart)
 
+    # later requests for prefetched URLs are served from the staging area
+    site.stage(dict((url, v[0]) for url, v in staged.items()))
+    runlog.debug('prefetch: %d staged, %d failed' % (len(staged), len(failed)))
+    for url, err in failed.items():
+        runlog.debug('prefetch failed %s: %s' % (url, err))
+
     # maintains target and actual projections
     global ptable 
     ptable = ProjTable()
 
+    # local cache shared by model runs on this host
+    global cache
+    cache = Cache()
+
+    # BIL files exported for GLUC
+    global exports
+    exports = BILExports()
+
+    # zones of the subregional projections rasterized once (see indexZones),
+    # created once the Driver Sets have set up the region
+    global zoneindex
+
     # create results raster layers
     print "Creating result raster layers.............\n"
     runlog.debug("Initializing GRASS model layers with 'gluc.make start'")
     cmd = 'make -f ./bin/gluc.make start'
-    with open('gluc_make_start.log', 'w') as log:
+    with open('gluc_make_start.log', 'w') as log, profile.phase('start'):
         check_call(cmd.split(), stdout=log, stderr=subprocess.STDOUT)
 
     # process growth projections
     print "Processing growth projections.............\n"
     growth = dict(deltapop=[0.0], deltaemp=[0.0])
+    subregional, regional = [], []
     if luc.growth:
 
         print "Building probability maps from growth driver sets.............\n"
         runlog.h('Building Probability Maps From Growth Driver Sets')
-        startyear = processDriverSets(luc.growthmap, prefix='growth')
+        with profile.phase('driversets/growth'):
+            startyear = processDriverSets(luc.growthmap, prefix='growth',
+                                          procs=options.jobs,
+                                          scores=options.scores)
 
         # filter out regional projection from growth projections
         runlog.h('Processing Growth Projections')
+        if numpy is not None:
+            zoneindex = ZoneLabels('subzones')
         subregional, regional = filter_regional_projection(luc.growth)
         create_regional_densities(regional)
-        growth = processProjections('growth', subregional, startyear)
+        with profile.phase('zones'):
+            indexZones(subregional + luc.decline)
+        growth = processProjections('growth', subregional, startyear,
+                                    procs=options.jobs, ranks=ranks,
+                                    margin=options.window)
 
     # SANITY -- check to see if sanity report was produced
     if os.path.exists('sanity.htm'):
@@ -1558,7 +2552,10 @@ def main():
 
         if luc.declinemap:
             runlog.h('Building Probability Maps From Vacancy Driver Sets')
-            sy = processDriverSets(luc.declinemap, prefix='decline')
+            with profile.phase('driversets/decline'):
+                sy = processDriverSets(luc.declinemap, prefix='decline',
+                                       procs=options.jobs,
+                                       scores=options.scores)
     
         else:
             runlog.error('No vacancy driver sets given even though '
@@ -1567,7 +2564,13 @@ def main():
             sys.exit(3)
     
         runlog.h('Processing Vacancy Projections')
-        decline = processProjections('decline', luc.decline, sy)
+        if not luc.growth and numpy is not None:
+            zoneindex = ZoneLabels('subzones')
+            with profile.phase('zones'):
+                indexZones(luc.decline)
+        decline = processProjections('decline', luc.decline, sy,
+                                     procs=options.jobs, ranks=ranks,
+                                     margin=options.window)
 
 
     # REGIONAL -- execute for regional models
@@ -1609,13 +2612,11 @@ def main():
         # output the boundary map
         print "Outputting the boundary map.............\n"
         boundary = proj.setdefault('boundary', getLayerMask(proj['layer']))
-        grass.run_command('r.out.gdal', input=boundary, 
-            output='gluc/Data/boundary.bil', format='EHdr', type='Byte')
+        exportBoundary(boundary, 'gluc/Data/boundary.bil')
 
         # rewrites the landcover map
         print "Rewriting the landcover map.............\n"
-        grass.run_command('r.out.gdal', _input='landcoverBase',
-            output='gluc/Data/landcover.bil', _format='EHdr', _type='Byte')
+        exports.export('landcoverBase', 'gluc/Data/landcover.bil', 'Byte')
 
         # add growth zones to nogrowth layer
         print "Adding growth zones to nogrowth layer.............\n"
@@ -1623,31 +2624,28 @@ def main():
         d = grass.find_file('subzones', element='vector')
         if d['name'] == '':
             runlog.debug('no subzones layer found')
-            grass.run_command('r.out.gdal', _input='nogrowth', 
-                output='gluc/Data/nogrowth.bil', _format='EHdr', _type='Byte')
+            exports.export('nogrowth', 'gluc/Data/nogrowth.bil', 'Byte')
         else:
             runlog.debug('merging subzones layer found')
-            grass.mapcalc('ng=if(nogrowth || subzones, 1, 0)')
-            grass.run_command('r.out.gdal', _input='ng', 
-                output='gluc/Data/nogrowth.bil', _format='EHdr', _type='Byte')
-            grass.run_command('g.remove', rast='ng')
+            exportNogrowth('gluc/Data/nogrowth.bil')
 
         # ensure the projection density maps match both the _density layer
         # and the .bil file.
         grass.run_command('g.copy', rast='regional_popdens,pop_density')
         grass.run_command('g.copy', rast='regional_empdens,emp_density')
-        grass.run_command('r.out.gdal', _input='pop_density', 
-            output='gluc/Data/pop_density.bil', _type='Float32',_format='EHdr')
-        grass.run_command('r.out.gdal', _input='emp_density', 
-            output='gluc/Data/emp_density.bil', _type='Float32',_format='EHdr') 
+        exports.export('pop_density', 'gluc/Data/pop_density.bil', 'Float32')
+        exports.export('emp_density', 'gluc/Data/emp_density.bil', 'Float32')
 
         writeConfig(confname=projid, prefix='growth_', 
                     start=startyear, end=endyear)
-        executeModel(projid, 'growth', startyear)
+        with profile.phase('regional/%s/model' % projid):
+            executeModel(projid, 'growth', startyear, ranks=ranks)
 
         # extract the time series change in pop and emp from the model run
         print "Extracting the time series change............."
-        pop,emp = getProjectionTimeSeries(proj, projlen=endyear-startyear+1)
+        with profile.phase('regional/%s/timeseries' % projid):
+            pop,emp = getProjectionTimeSeries(proj,
+                                              projlen=endyear-startyear+1)
         ptable.population(projid, mode, 'actual', pop)
         ptable.employment(projid, mode, 'actual', emp)
 
@@ -1665,10 +2663,20 @@ def main():
     else:
         runlog.h('Posting Results')
         ptable.write_csv(filename='projections.csv')
-        publishProjTable(resultsdir, 'projections.csv')
-        publishSimMaps(resultsdir)
-        publishResults(resultsdir)
-        publishProbmaps(resultsdir)
+        with profile.phase('publish/projtable'):
+            publishProjTable(resultsdir, 'projections.csv')
+        with profile.phase('publish/simmaps'):
+            publishSimMaps(resultsdir)
+        with profile.phase('publish/results'):
+            publishResults(resultsdir)
+        with profile.phase('publish/probmaps'):
+            publishProbmaps(resultsdir)
+
+    # the profile is written along side projections.csv
+    profile.write('profile.json')
+    if options.profile and not options.local:
+        site.putFileURL('profile.json', resultsdir, title='Run Profile',
+                        type='application/json')
 
     # Runs the model without posting results
     print "running the model without posting results.............\n"